@@ -1,46 +1,77 @@
+import ast
+import importlib
 import logging
 import sys
 from pathlib import Path
 
 logging.basicConfig(level=logging.INFO)
 
-logging.info("Starting initialization...")
-
-from .mongo_client import *
-logging.info("mongo_client imported successfully.")
-from .call_mongodb import *
-logging.info("call_mongodb imported successfully.")
-from .expert_decision import formatting,merge_old_new,make_pretty_for_expert,make_summary_for_comparison
-logging.info("expert_decision imported successfully.")
-from .gpt_rag_asyncio import *
-logging.info("gpt_rag_asyncio imported successfully.")
-from .semantic_chunking import *
-logging.info("semantic chunking imported successfully.")
-from .process_and_embed import *
-logging.info("process_and_embed imported successfully.")
-from .gpt_retrievesieve import retrieve_sieve_references,retrieve_sieve_references_new,cleaning,add_to_existing,cleaning_initial
-logging.info("gpt_retrievesieve imported successfully.")
-from .semantic_scholar_keyword_search import search_and_retrieve_keyword,search_and_retrieve_keyword_agentic
-logging.info("semantic_scholar_keyword_search imported successfully.")
-from .process_ref import *
-logging.info("process_ref imported successfully.")
-from .pdf import *
-logging.info("pdf imported successfully.")
-from .gpt_rag import get_names,read_text_file,get_references,similiar_ref,clean_responses,rank_and_check,summarise_subdocument,locate_subdoc
-logging.info("gpt_rag imported successfully.")
-from .semantic_chunking import process_dataframe_sc1
-logging.info("semantic_chunking imported successfully.")
-from .download_paper_ss import process_and_download
-logging.info("download_paper_ss imported successfully.")
-from .search_ss import total_search_by_grouped_keywords,preprocess_paper_metadata,extract_title,extract_author,extract_year
-logging.info("search_ss imported successfully.")
-from .agent import evaluator,effectiveness_state
-logging.info("agent imported successfully.")
-from .models import *
-logging.info("models imported successfully")
-from .agentic_initial_check import *
-logging.info("agentic initial check imported successfully")
-from .match import *
-logging.info('match imported successfully')
-from .token_manager import *
-logging.info('token_manager imported successfully')
+# Submodules are imported on first attribute access (PEP 562) instead of at package import, so starting
+# uvicorn or importing the package offline does not pay for Azure, Mongo and model setup up front.
+# Entries are in the same order as the old eager imports: None means "import *", later entries win.
+_exports = [
+    ('mongo_client', None),
+    ('call_mongodb', None),
+    ('expert_decision', ['formatting', 'merge_old_new', 'make_pretty_for_expert', 'make_summary_for_comparison']),
+    ('gpt_rag_asyncio', None),
+    ('semantic_chunking', None),
+    ('process_and_embed', None),
+    ('gpt_retrievesieve', ['retrieve_sieve_references', 'retrieve_sieve_references_new', 'cleaning', 'add_to_existing', 'cleaning_initial']),
+    ('semantic_scholar_keyword_search', ['search_and_retrieve_keyword', 'search_and_retrieve_keyword_agentic']),
+    ('process_ref', None),
+    ('pdf', None),
+    ('gpt_rag', ['get_names', 'read_text_file', 'get_references', 'similiar_ref', 'clean_responses', 'rank_and_check', 'summarise_subdocument', 'locate_subdoc']),
+    ('semantic_chunking', ['process_dataframe_sc1']),
+    ('download_paper_ss', ['process_and_download']),
+    ('search_ss', ['total_search_by_grouped_keywords', 'preprocess_paper_metadata', 'extract_title', 'extract_author', 'extract_year']),
+    ('agent', ['evaluator', 'effectiveness_state']),
+    ('models', None),
+    ('agentic_initial_check', None),
+    ('match', None),
+    ('token_manager', None),
+]
+
+
+# Helper function to list the public top-level names of a submodule from its source, without importing it
+def _public_names(module_name):
+    source = (Path(__file__).parent / f'{module_name}.py').read_text(encoding='utf-8')
+    names = []
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.append(node.name)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                elements = target.elts if isinstance(target, ast.Tuple) else [target]
+                names.extend(element.id for element in elements if isinstance(element, ast.Name))
+    return [name for name in names if not name.startswith('_')]
+
+
+# Name -> owning submodule, built once on the first lookup. Later entries win, as with the old eager imports
+_owners = None
+
+
+def _owner(name):
+    global _owners
+    if _owners is None:
+        owners = {}
+        for module_name, names in _exports:
+            for exported in names if names is not None else _public_names(module_name):
+                owners[exported] = module_name
+        _owners = owners
+    return _owners.get(name)
+
+
+def __getattr__(name):
+    # Only the owning submodule is imported, undeclared names (and submodules) fall through to AttributeError
+    module_name = _owner(name) if not name.startswith('__') else None
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{module_name}', __name__), name)
+    globals()[name] = value  # Later lookups skip __getattr__
+    return value
+
+
+def __dir__():
+    _owner('')
+    return sorted(set(globals()) | set(_owners))
@@ -11,7 +11,7 @@ import os
 import certifi
 load_dotenv()
 uri = os.getenv("uri_mongo")
-client = MongoClient(uri, tls=True, tlsCAFile=certifi.where())
+client = MongoDBClient.get_client(uri)
 db = client['data']
 
 """In this script, I tried multiple ways to extract statements more accurately but ultimately came to the conclusion that adding a checker works best."""
@@ -6,13 +6,14 @@ import time
 import logging
 import asyncio
 from pymongo import MongoClient
+from .mongo_client import MongoDBClient
 from dotenv import load_dotenv
 from .agent import *
 import logging
 import pandas as pd
 load_dotenv()
 uri = os.getenv("uri_mongo")
-client = MongoClient(uri, tls=True, tlsCAFile=certifi.where())
+client = MongoDBClient.get_client(uri)
 db = client['data']
 
 
@@ -61,6 +62,14 @@ def retrieve_missing_references(valid, retry, statement_df):
 
         return missing_ref_df
 
+#read what retrieve_missing_references needs: the statements that have valid chunks and the statements to retry
+#(chunk texts and sieve outputs are not read)
+def read_valid_and_retry(valid_collection_name):
+    valid = read_dataframe(uri, db.name, valid_collection_name, {'_id': 0, 'Reference text in main article': 1})
+    valid = valid.reindex(columns=['Reference text in main article'])
+    retry = read_dataframe(uri, db.name, 'retry', {'_id': 0, 'Reference article name': 1, 'Reference text in main article': 1, 'Date': 1})
+    return valid, retry
+
 #update and send data for missing data
 def update_database_and_excel(missing_ref_df, uri, db):
     records = missing_ref_df.to_dict(orient='records')
@@ -103,40 +112,7 @@ def process_retry_logic(count, collection_processed_name, new_ref_collection,
                     top_5_new='top_5_new',top_5_original=top_5)
         move_files('retry_paper','papers')
         #we calculate missing ref df again
-        collection_valid=db[valid_collection_name]
-        collection_retry=db['retry']
-        documents_valid = list(
-            collection_valid.find(
-                {}, 
-                {
-                    '_id': 1,
-                    'Sentiment':1,
-                    'Confidence Score':1,
-                    'Sieving by gpt 4o': 1,
-                    'Reference article name': 1,
-                    'Reference text in main article': 1,
-                    'Chunk': 1,
-                    'Date': 1
-                }
-            )
-        )
-        valid=pd.DataFrame(documents_valid)
-        documents_retry = list(
-            collection_retry.find(
-                {}, 
-                {
-                    '_id': 1,
-                    'Sentiment':1,
-                    'Confidence Score':1,
-                    'Sieving by gpt 4o': 1,
-                    'Reference article name': 1,
-                    'Reference text in main article': 1,
-                    'Chunk': 1,
-                    'Date': 1
-                }
-            )
-        )
-        retry=pd.DataFrame(documents_retry)
+        valid, retry = read_valid_and_retry(valid_collection_name)
         # Update the missing references DataFrame from existing valid collection and statement collection (that already has new data added)
         missing_ref_df_new = retrieve_missing_references(valid, retry, statement_df)
         effectiveness_state(missing_ref_df_new=missing_ref_df_new,missing_ref_df_initial=missing_ref_df,prompt=old_prompt,collection='prompt')
@@ -154,57 +130,14 @@ def agentic_search(collection_processed_name,new_ref_collection,
 
     # Load collated statements and citations from the database once.
     #these are the statements from the main paper
-    codable_collection = db['collated_statements_and_citations']
-    codable_docs = list(codable_collection.find({}, {
-        '_id': 1, 'Reference article name': 1, 
+    statement_df = read_dataframe(uri, db.name, 'collated_statements_and_citations', {
+        '_id': 0, 'Reference article name': 1, 
         'Reference text in main article': 1, 'Date': 1
-    }))
-
-    # Prepare DataFrame of references
-    reference_data = [
-        (doc.get('Reference text in main article'), 
-         doc.get('Reference article name'), 
-         doc.get('Date')) 
-        for doc in codable_docs
-    ]
-    statement_df = pd.DataFrame(reference_data, columns=[
+    }).reindex(columns=[
         'Reference text in main article', 'Reference article name', 'Date'
     ])
 
-    collection_valid=db[valid_collection_name]
-    collection_retry=db['retry']
-    documents_valid = list(
-        collection_valid.find(
-            {}, 
-            {
-                '_id': 1,
-                'Sentiment':1,
-                'Confidence Score':1,
-                'Sieving by gpt 4o': 1,
-                'Reference article name': 1,
-                'Reference text in main article': 1,
-                'Chunk': 1,
-                'Date': 1
-            }
-        )
-    )
-    valid=pd.DataFrame(documents_valid)
-    documents_retry = list(
-        collection_retry.find(
-            {}, 
-            {
-                '_id': 1,
-                'Sentiment':1,
-                'Confidence Score':1,
-                'Sieving by gpt 4o': 1,
-                'Reference article name': 1,
-                'Reference text in main article': 1,
-                'Chunk': 1,
-                'Date': 1
-            }
-        )
-    )
-    retry=pd.DataFrame(documents_retry)
+    valid, retry = read_valid_and_retry(valid_collection_name)
 
     #Find out if any statements have unsatisfactory papers (all papers found unsatisfactory (below threshold for top paper)) or no papers found
     missing_ref_df = retrieve_missing_references(valid, retry, statement_df)
@@ -0,0 +1,246 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import logging
+from array import array
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+#local on-disk caches so that re-running a stage does not pay for the same GPT/embedding calls again
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+# Cache configuration (override in .env if needed)
+cache_path = os.getenv("cache_path", "cache.sqlite3")
+sieve_cache_ttl = int(os.getenv("sieve_cache_ttl", 30 * 24 * 3600))  # 30 days
+sieve_cache_max_entries = int(os.getenv("sieve_cache_max_entries", 500000))
+embedding_cache_max_entries = int(os.getenv("embedding_cache_max_entries", 2000000))
+embedding_memory_cache_size = int(os.getenv("embedding_memory_cache_size", 20000))
+
+
+def make_cache_key(*parts):
+    """
+    Content-address a cache entry by hashing every part that influences the result.
+
+    Args:
+        *parts (str): Texts that determine the cached value (e.g. chunk, statement, prompt, model).
+
+    Returns:
+        str: Hex encoded SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        encoded = str(part).encode('utf-8')
+        # Length prefix so that ('ab', 'c') and ('a', 'bc') do not collide
+        digest.update(len(encoded).to_bytes(8, 'little'))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class SQLiteCache:
+    """
+    Small key-value store on top of SQLite with TTL and size based (least recently used) eviction.
+    A single connection is shared between threads and guarded by a lock since every operation is a
+    short point read/write.
+    """
+
+    def __init__(self, path, table, ttl=None, max_entries=None):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = None
+        self._writes_since_evict = 0
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL)"
+            )
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table}(accessed)")
+        return self._conn
+
+    def get(self, key):
+        """Return the cached value or None if missing/expired."""
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connect()
+                row = conn.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                value, created = row
+                if self.ttl and now - created > self.ttl:
+                    conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                    return None
+                conn.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, key))
+                return value
+            except sqlite3.Error as e:
+                logging.warning(f"Cache read failed ({self.table}): {e}")
+                return None
+
+    def get_many(self, keys, batch_size=500):
+        """Return a dict of key -> value for every key that is cached and not expired."""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connect()
+                # Stay below SQLite's limit of bound parameters per statement
+                for start in range(0, len(keys), batch_size):
+                    batch = keys[start:start + batch_size]
+                    placeholders = ','.join('?' * len(batch))
+                    rows = conn.execute(
+                        f"SELECT key, value, created FROM {self.table} WHERE key IN ({placeholders})", batch
+                    ).fetchall()
+                    hits = []
+                    for key, value, created in rows:
+                        if self.ttl and now - created > self.ttl:
+                            continue
+                        found[key] = value
+                        hits.append((now, key))
+                    conn.executemany(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", hits)
+            except sqlite3.Error as e:
+                logging.warning(f"Cache read failed ({self.table}): {e}")
+        return found
+
+    def set(self, key, value):
+        """Store a value, evicting old entries once in a while."""
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, value, now, now)
+                )
+                self._writes_since_evict += 1
+                # Evicting on every write would be wasteful, do it in batches
+                if self._writes_since_evict >= 1000:
+                    self._evict(conn, now)
+                    self._writes_since_evict = 0
+            except sqlite3.Error as e:
+                logging.warning(f"Cache write failed ({self.table}): {e}")
+
+    def set_many(self, items):
+        """Store several (key, value) pairs in one transaction."""
+        items = list(items)
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connect()
+                with conn:
+                    conn.execute("BEGIN")
+                    conn.executemany(
+                        f"INSERT OR REPLACE INTO {self.table} (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                        [(key, value, now, now) for key, value in items]
+                    )
+                self._writes_since_evict += len(items)
+                if self._writes_since_evict >= 1000:
+                    self._evict(conn, now)
+                    self._writes_since_evict = 0
+            except sqlite3.Error as e:
+                logging.warning(f"Cache write failed ({self.table}): {e}")
+
+    def _evict(self, conn, now):
+        if self.ttl:
+            conn.execute(f"DELETE FROM {self.table} WHERE created < ?", (now - self.ttl,))
+        if self.max_entries:
+            count = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            excess = count - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN "
+                    f"(SELECT key FROM {self.table} ORDER BY accessed ASC LIMIT ?)",
+                    (excess,)
+                )
+                logging.info(f"Evicted {excess} entries from cache table {self.table}.")
+
+    def evict(self):
+        """Force TTL and size eviction."""
+        with self._lock:
+            try:
+                self._evict(self._connect(), time.time())
+            except sqlite3.Error as e:
+                logging.warning(f"Cache eviction failed ({self.table}): {e}")
+
+    def clear(self):
+        with self._lock:
+            try:
+                self._connect().execute(f"DELETE FROM {self.table}")
+            except sqlite3.Error as e:
+                logging.warning(f"Cache clear failed ({self.table}): {e}")
+
+
+class EmbeddingCache:
+    """
+    Embedding vectors keyed by model and whitespace-normalised text.
+    Vectors are kept as float32 blobs in SQLite with a small in-memory LRU in front, so the same
+    statement compared against many papers is only looked up on disk once.
+    """
+
+    def __init__(self, store, memory_size=embedding_memory_cache_size):
+        self.store = store
+        self.memory_size = memory_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text, model):
+        return make_cache_key(model, ' '.join(str(text).split()))
+
+    def _remember(self, key, vector):
+        # Caller holds the lock
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get_many(self, texts, model):
+        """
+        Returns:
+            dict: Index in `texts` -> vector (list of floats) for every cached text.
+        """
+        keys = [self.key(text, model) for text in texts]
+        vectors = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    vectors[key] = self._memory[key]
+        missing = [key for key in keys if key not in vectors]
+        if missing:
+            stored = self.store.get_many(missing)
+            with self._lock:
+                for key, blob in stored.items():
+                    vector = array('f', blob).tolist()
+                    vectors[key] = vector
+                    self._remember(key, vector)
+        return {i: vectors[key] for i, key in enumerate(keys) if key in vectors}
+
+    def set_many(self, texts, vectors, model):
+        items = []
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = self.key(text, model)
+                self._remember(key, list(vector))
+                items.append((key, array('f', vector).tobytes()))
+        self.store.set_many(items)
+
+
+# Cache of retriever_and_siever_async answers keyed by (chunk, statement, prompt, model)
+sieve_cache = SQLiteCache(cache_path, 'sieve_responses', ttl=sieve_cache_ttl, max_entries=sieve_cache_max_entries)
+# Cache of embedding vectors keyed by (model, normalised text), embeddings do not expire
+embedding_cache = EmbeddingCache(SQLiteCache(cache_path, 'embeddings', max_entries=embedding_cache_max_entries))
@@ -1,26 +1,75 @@
-from pymongo import UpdateOne, MongoClient
+from pymongo import UpdateOne, MongoClient, IndexModel
 import certifi
-
-
-def upsert_database_and_collection(uri, db_name, collection_name, records,key):
+import os
+import uuid
+import hashlib
+import logging
+import pandas as pd
+from dotenv import load_dotenv
+from .mongo_client import MongoDBClient
+
+load_dotenv()
+# Records per insert when a collection is replaced
+replace_batch_size = int(os.getenv("replace_batch_size", 1000))
+# Documents per cursor round trip when a collection is read
+read_batch_size = int(os.getenv("read_batch_size", 2000))
+
+# Natural key of the sieve outputs (valid and top 5 collections): one document per reference article, statement,
+# chunk, sentiment and classification text (a chunk can hold several classifications of one sentiment).
+# 'Chunk hash' and 'Sieved hash' (see chunk_hash) stand in for the long chunk and classification texts
+sieve_natural_key = ('Reference article name', 'Reference text in main article', 'Chunk hash', 'Sentiment', 'Sieved hash')
+
+# Key fields derived from another field of the record -> that field
+hashed_key_fields = {'Chunk hash': 'Chunk', 'Sieved hash': 'Sieving by gpt 4o'}
+
+# Collection -> natural key, used by upsert_database_and_collection when no key is given and indexed by ensure_indexes
+natural_keys = {
+    'Agentic_sieved_RAG_original': sieve_natural_key,
+    'Agentic_sieved_RAG_new_support_nosupport_confidence': sieve_natural_key,
+    'new_valid': sieve_natural_key,
+    'top_5_original': sieve_natural_key,
+    'top_5': sieve_natural_key,
+    'top_5_new': sieve_natural_key,
+}
+
+# Collection -> other fields that are queried on and indexed by ensure_indexes
+managed_indexes = {
+    'prompt': [('prompt',), ('effective',)],
+    'chunked_noembed': [('PDF File',), ('Source File',)],
+    'new_chunked_noembed': [('PDF File',), ('Source File',)],
+    'ingestion_manifest': [('collection', 'Source File')],
+}
+
+
+#helper function: short stable stand-in for a chunk (or classification) text in keys and indexes
+def chunk_hash(chunk):
+    return hashlib.sha256(str(chunk).encode('utf-8')).hexdigest()
+
+
+def upsert_database_and_collection(uri, db_name, collection_name, records, key=None):
     """
     Insert records into a MongoDB collection if they don't exist,
-    or update the records if they do, using the '_id' field when present.
+    or update the records if they do, using the '_id' field when present
+    and the natural key of the collection otherwise.
 
     Args:
         uri (str): MongoDB connection URI.
         db_name (str): Name of the database.
         collection_name (str): Name of the collection.
         records (list): List of dictionaries to be inserted or updated.
+        key (tuple): Fields identifying a record, natural_keys[collection_name] by default.
     """
     from pymongo.errors import BulkWriteError
 
     if not isinstance(records, list):
         raise TypeError("Records must be a list of dictionaries.")
 
-    client = MongoClient(uri, tls=True, tlsCAFile=certifi.where())
+    client = MongoDBClient.get_client(uri)
     db = client[db_name]
     collection = db[collection_name]
+    key = key or natural_keys.get(collection_name)
+    if key is None:
+        logging.warning(f"No natural key declared for '{collection_name}', records without '_id' are matched on every field.")
 
     try:
         # Prepare bulk operations
@@ -34,6 +83,13 @@ def upsert_database_and_collection(uri, db_name, collection_name, records,key):
                 query = {'_id': record['_id']}
                 update = {"$set": record}
                 operations.append(UpdateOne(query, update, upsert=True))
+            elif key is not None:
+                # Indexed point write on the natural key
+                for field, source in hashed_key_fields.items():
+                    if field in key and field not in record:
+                        record[field] = chunk_hash(record.get(source))
+                query = {field: record.get(field) for field in key}
+                operations.append(UpdateOne(query, {"$set": record}, upsert=True))
             else:
                 # Insert as a new document if no '_id' field
                 operations.append(UpdateOne(record, {"$setOnInsert": record}, upsert=True))
@@ -48,36 +104,130 @@ def upsert_database_and_collection(uri, db_name, collection_name, records,key):
         print("Bulk write error occurred:", bwe.details)
     except Exception as e:
         print("An error occurred:", str(e))
-    finally:
-        client.close()
 
 
 
 
 
-def replace_database_collection(uri, db_name, collection_name, records):
+def replace_database_collection(uri, db_name, collection_name, records, batch_size=None):
     """
     Replace the entire collection in the database with the new records.
+    The records are written to a staging collection in batches, which is then renamed over the target,
+    so readers see the old collection until the new one is complete.
     
     Args:
         uri (str): MongoDB connection URI.
         db_name (str): Name of the database.
         collection_name (str): Name of the collection.
-        records (list): List of dictionaries to be inserted.
+        records (iterable): Dictionaries to be inserted (a list or a generator).
+        batch_size (int): Records per insert, replace_batch_size by default.
     """
-    client = MongoClient(uri, tls=True, tlsCAFile=certifi.where())
-    db = client[db_name]
-    collection = db[collection_name]
+    staging_name = start_collection_replace(uri, db_name, collection_name)
+    try:
+        count = insert_in_batches(MongoDBClient.get_client(uri)[db_name][staging_name], records, batch_size)
+    except Exception:
+        abort_collection_replace(uri, db_name, staging_name)
+        raise
+    finish_collection_replace(uri, db_name, staging_name, collection_name)
+    print(f"Replaced collection {collection_name} with {count} records.")
+
+#helper function to write records (list or generator) in fixed-size unordered batches, records keep their '_id' (the driver sets one on records without it)
+def insert_in_batches(collection, records, batch_size=None):
+    batch_size = batch_size or replace_batch_size
+    count = 0
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            count += len(collection.insert_many(batch, ordered=False).inserted_ids)
+            batch = []
+    if batch:
+        count += len(collection.insert_many(batch, ordered=False).inserted_ids)
+    return count
+
+def start_collection_replace(uri, db_name, collection_name):
+    """
+    Creates an empty staging collection for a replacement of collection_name. Write to it, then call
+    finish_collection_replace (or abort_collection_replace on failure).
+
+    Returns:
+        str: Name of the staging collection.
+    """
+    db = MongoDBClient.get_client(uri)[db_name]
+    staging_name = f"{collection_name}__staging_{uuid.uuid4().hex[:8]}"
+    db.create_collection(staging_name)
+    return staging_name
 
-    # Drop the existing collection if it exists
+def finish_collection_replace(uri, db_name, staging_name, collection_name):
+    """
+    Builds the indexes of collection_name on the staging collection and renames it over collection_name in one step.
+    """
+    db = MongoDBClient.get_client(uri)[db_name]
+    staging = db[staging_name]
     if collection_name in db.list_collection_names():
-        db.drop_collection(collection_name)
-        print(f"Dropped existing collection: {collection_name}")
+        # Same indexes as the collection being replaced, built before readers can see the new data
+        indexes = [
+            IndexModel(spec['key'], name=name, **{option: value for option, value in spec.items() if option not in ('key', 'v', 'ns')})
+            for name, spec in db[collection_name].index_information().items() if name != '_id_'
+        ]
+        if indexes:
+            staging.create_indexes(indexes)
+    staging.rename(collection_name, dropTarget=True)
+
+def abort_collection_replace(uri, db_name, staging_name):
+    MongoDBClient.get_client(uri)[db_name].drop_collection(staging_name)
+
+#run an aggregation pipeline on the server and write its output to a collection
+def aggregate_into_collection(uri, db_name, source_collection_name, pipeline, target_collection_name, replace=True, replace_if_empty=True, batch_size=None):
+    """
+    Writes the output of an aggregation pipeline to a collection. When replacing, the output is $merged into
+    a staging collection that is renamed over the target, so no document goes through Python. Otherwise the output
+    is upserted into the target on its natural key, streamed in batches.
 
-    # Insert all records into the new collection
-    if records:
-        collection.insert_many(records)
-        print(f"Inserted {len(records)} records into {collection_name}.")
+    Args:
+        uri (str): MongoDB connection URI.
+        db_name (str): Name of the database.
+        source_collection_name (str): Collection the pipeline runs on.
+        pipeline (list): Aggregation stages, without the output stage.
+        target_collection_name (str): Collection to write to.
+        replace (bool): Replace the target collection instead of upserting into it.
+        replace_if_empty (bool): Replace the target even if the pipeline outputs nothing.
+        batch_size (int): Documents per upsert, replace_batch_size by default.
+
+    Returns:
+        int: Number of documents written.
+    """
+    db = MongoDBClient.get_client(uri)[db_name]
+    source = db[source_collection_name]
+    if replace:
+        staging_name = start_collection_replace(uri, db_name, target_collection_name)
+        try:
+            source.aggregate(list(pipeline) + [{'$merge': {'into': staging_name, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}], allowDiskUse=True)
+            count = db[staging_name].count_documents({})
+        except Exception:
+            abort_collection_replace(uri, db_name, staging_name)
+            raise
+        if count or replace_if_empty:
+            finish_collection_replace(uri, db_name, staging_name, target_collection_name)
+            print(f"Replaced collection {target_collection_name} with {count} records.")
+        else:
+            abort_collection_replace(uri, db_name, staging_name)
+        return count
+
+    batch_size = batch_size or replace_batch_size
+    count = 0
+    batch = []
+    # Without '_id' the documents are matched on the natural key of the target
+    for document in source.aggregate(list(pipeline) + [{'$project': {'_id': 0}}], allowDiskUse=True, batchSize=batch_size):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            upsert_database_and_collection(uri, db_name, target_collection_name, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        upsert_database_and_collection(uri, db_name, target_collection_name, batch)
+        count += len(batch)
+    return count
 
 #for agentic search without checking histroy
 def add_prompt_to_db(uri, db_name, collection_name, prompt):
@@ -90,7 +240,7 @@ def add_prompt_to_db(uri, db_name, collection_name, prompt):
         collection_name (str): Name of the collection.
         prompt (str): The prompt to be added.
     """
-    client = MongoClient(uri, tls=True, tlsCAFile=certifi.where())
+    client = MongoDBClient.get_client(uri)
     db = client[db_name]
     collection = db[collection_name]
 
@@ -119,7 +269,7 @@ def change_prompt_state_or_add(uri, db_name, collection_name, prompt, effective)
         prompt (str): The prompt to be added.
         effective (str): 'Y' or 'N' indicating the effective state.
     """
-    client = MongoClient(uri, tls=True, tlsCAFile=certifi.where())
+    client = MongoDBClient.get_client(uri)
     db = client[db_name]
     collection = db[collection_name]
 
@@ -146,7 +296,7 @@ def get_effective_prompts(uri, db_name, collection_name):
     Returns:
         list: A list of prompts where effective is 'Y'.
     """
-    client = MongoClient(uri)
+    client = MongoDBClient.get_client(uri)
     db = client[db_name]
     collection = db[collection_name]
     
@@ -160,44 +310,73 @@ def get_effective_prompts(uri, db_name, collection_name):
 #duplicate a collection
 def duplicate_collection(uri, db_name, source_collection_name, target_collection_name):
     """
-    Duplicate a collection in MongoDB.
+    Duplicate a collection in MongoDB. The copy is made on the server, documents are not read into Python.
 
     Args:
         uri (str): MongoDB connection URI.
         db_name (str): Name of the database.
         source_collection_name (str): Name of the source collection to duplicate.
         target_collection_name (str): Name of the target collection where data will be copied.
+
+    Returns:
+        int: Number of documents copied.
     """
-    # Establish a secure connection to MongoDB
-    client = MongoClient(uri, tls=True, tlsCAFile=certifi.where())
-    db = client[db_name]
-    
-    source_collection = db[source_collection_name]
-    target_collection = db[target_collection_name]
+    db = MongoDBClient.get_client(uri)[db_name]
 
     # Check if the target collection already exists
     if target_collection_name in db.list_collection_names():
         print(f"The target collection '{target_collection_name}' already exists.")
-        # Optionally, you can drop the target collection if you want to overwrite it
-        # db.drop_collection(target_collection_name)
-        # print(f"Dropped existing collection '{target_collection_name}'.")
-        # target_collection = db[target_collection_name]
     else:
         print(f"Creating target collection '{target_collection_name}'.")
 
-    # Fetch all documents from the source collection
-    documents = list(source_collection.find())
-    print(f"Fetched {len(documents)} documents from '{source_collection_name}'.")
+    return merge_collection(uri, db_name, source_collection_name, target_collection_name)
 
-    if documents:
-        # Insert documents into the target collection
-        target_collection.insert_many(documents)
-        print(f"Inserted {len(documents)} documents into '{target_collection_name}'.")
-    else:
-        print(f"No documents found in '{source_collection_name}' to duplicate.")
+#aggregation pipeline appending the documents it reads to another collection as new documents
+def merge_pipeline(target_collection_name, fields=None):
+    """
+    Args:
+        target_collection_name (str): Collection to append to (created if needed).
+        fields (list): Fields to copy, every field if None.
 
-    # Close the connection
-    client.close()
+    Returns:
+        list: Pipeline stages. '_id' is dropped so the server gives every copy a new one: documents copied
+            before are appended again instead of being matched and skipped.
+    """
+    pipeline = []
+    if fields:
+        pipeline.append({'$project': {field: 1 for field in fields}})
+    pipeline.append({'$unset': '_id'})
+    pipeline.append({'$merge': {'into': target_collection_name, 'whenMatched': 'fail', 'whenNotMatched': 'insert'}})
+    return pipeline
+
+#append the documents of one collection to another
+def merge_collection(uri, db_name, source_collection_name, target_collection_name, fields=None, clear_source=False):
+    """
+    Appends the documents of a collection to another one with a $merge pipeline run by the server,
+    only the count comes back. Every document is appended under a new '_id' (see merge_pipeline).
+
+    Args:
+        uri (str): MongoDB connection URI.
+        db_name (str): Name of the database.
+        source_collection_name (str): Collection to copy from.
+        target_collection_name (str): Collection to append to (created if needed).
+        fields (list): Fields to copy, every field if None.
+        clear_source (bool): Empty the source collection afterwards.
+
+    Returns:
+        int: Number of documents in the source collection.
+    """
+    db = MongoDBClient.get_client(uri)[db_name]
+    source = db[source_collection_name]
+    count = source.count_documents({})
+    if count:
+        source.aggregate(merge_pipeline(target_collection_name, fields))
+        print(f"Merged {count} documents from '{source_collection_name}' into '{target_collection_name}'.")
+    else:
+        print(f"No documents found in '{source_collection_name}' to merge.")
+    if clear_source:
+        source.delete_many({})
+    return count
 
 #function to delete for agentic rag test. ONLY FOR THAT very specific test so yeah
 def delete_documents_by_reference_text(uri, db_name, collection_name, reference_text):
@@ -210,8 +389,7 @@ def delete_documents_by_reference_text(uri, db_name, collection_name, reference_
         collection_name (str): Name of the collection.
         reference_text (str): The value of 'Reference text in main article' to match for deletion.
     """
-    # Establish a secure connection to MongoDB
-    client = MongoClient(uri, tls=True, tlsCAFile=certifi.where())
+    client = MongoDBClient.get_client(uri)
     db = client[db_name]
     collection = db[collection_name]
 
@@ -229,8 +407,6 @@ def delete_documents_by_reference_text(uri, db_name, collection_name, reference_
         result = collection.delete_many(query)
         print(f"Deleted {result.deleted_count} document(s) from '{collection_name}'.")
 
-    # Close the connection
-    client.close()
 
 
 
@@ -250,7 +426,7 @@ def insert_documents(uri, db_name, collection_name, records):
     if not isinstance(records, list):
         raise TypeError("Records must be a list of dictionaries.")
 
-    client = MongoClient(uri, tls=True, tlsCAFile=certifi.where())
+    client = MongoDBClient.get_client(uri)
     db = client[db_name]
     collection = db[collection_name]
 
@@ -269,8 +445,6 @@ def insert_documents(uri, db_name, collection_name, records):
         print("Bulk write error occurred:", bwe.details)
     except Exception as e:
         print("An error occurred:", str(e))
-    finally:
-        client.close()
 
 #clear all documents in a collection
 def clear_collection(uri, db_name, collection_name):
@@ -282,13 +456,197 @@ def clear_collection(uri, db_name, collection_name):
         db_name (str): Name of the database.
         collection_name (str): Name of the collection.
     """
-    client = MongoClient(uri, tls=True, tlsCAFile=certifi.where())
+    client = MongoDBClient.get_client(uri)
     db = client[db_name]
     collection = db[collection_name]
     
     collection.delete_many({})
     print(f"Cleared all documents from collection: {collection_name}")
     
-    # Close the connection
-    client.close()
 
+
+#ingestion manifest: one entry per (collection, PDF file) with the SHA-256 of the file and the chunker version it was chunked with
+manifest_collection_name = 'ingestion_manifest'
+
+def get_ingestion_manifest(uri, db_name, collection_name):
+    """
+    Returns the manifest entries of a chunk collection.
+
+    Args:
+        uri (str): MongoDB connection URI.
+        db_name (str): Name of the database.
+        collection_name (str): Name of the chunk collection.
+
+    Returns:
+        dict: 'Source File' -> manifest entry.
+    """
+    client = MongoDBClient.get_client(uri)
+    manifest = client[db_name][manifest_collection_name]
+    entries = {entry['Source File']: entry for entry in manifest.find({'collection': collection_name}, {'_id': 0})}
+    return entries
+
+def update_ingestion_manifest(uri, db_name, collection_name, entries):
+    """
+    Upserts manifest entries (dicts with 'Source File', 'Source Hash', 'chunker_version', ...) of a chunk collection.
+    """
+    if not entries:
+        return
+    client = MongoDBClient.get_client(uri)
+    manifest = client[db_name][manifest_collection_name]
+    operations = [
+        UpdateOne({'collection': collection_name, 'Source File': entry['Source File']},
+                  {'$set': dict(entry, collection=collection_name)}, upsert=True)
+        for entry in entries
+    ]
+    manifest.bulk_write(operations, ordered=False)
+
+def remove_ingested_files(uri, db_name, collection_name, files, clear=False):
+    """
+    Deletes the chunks of the given source files from a chunk collection and drops their manifest entries.
+
+    Args:
+        files (list): 'Source File' values to remove.
+        clear (bool): Drop every manifest entry of the collection instead (used before a full rebuild).
+
+    Returns:
+        list: _id of every deleted chunk (to drop them from the collection's vector index).
+    """
+    client = MongoDBClient.get_client(uri)
+    db = client[db_name]
+    removed = []
+    if clear:
+        db[manifest_collection_name].delete_many({'collection': collection_name})
+    elif files:
+        query = {'Source File': {'$in': list(files)}}
+        removed = [doc['_id'] for doc in db[collection_name].find(query, {'_id': 1})]
+        db[collection_name].delete_many({'_id': {'$in': removed}})
+        db[manifest_collection_name].delete_many({'collection': collection_name, 'Source File': {'$in': list(files)}})
+        print(f"Removed {len(removed)} chunks of {len(files)} changed or deleted files from '{collection_name}'.")
+    return removed
+
+def move_ingestion_manifest(uri, db_name, source_collection_name, target_collection_name):
+    """
+    Re-labels the manifest entries of a chunk collection whose chunks were merged into another collection.
+    """
+    client = MongoDBClient.get_client(uri)
+    manifest = client[db_name][manifest_collection_name]
+    operations = [
+        UpdateOne({'collection': target_collection_name, 'Source File': entry['Source File']},
+                  {'$set': dict(entry, collection=target_collection_name)}, upsert=True)
+        for entry in manifest.find({'collection': source_collection_name}, {'_id': 0})
+    ]
+    if operations:
+        manifest.bulk_write(operations, ordered=False)
+    manifest.delete_many({'collection': source_collection_name})
+
+#encoder backend of the chunk embeddings of a collection ('embed_backend' is stored with every 'embed_v3')
+def get_embedding_backend(uri, db_name, collection_name):
+    """
+    Returns the encoder backend ('azure' or 'local') the embeddings of a chunk collection were made with,
+    None if the collection has no embeddings. Vectors of different encoders cannot be compared, so a
+    collection mixing them raises a ValueError.
+    """
+    collection = MongoDBClient.get_client(uri)[db_name][collection_name]
+    embedded = {'embed_v3': {'$type': 'array'}}
+    backends = set(collection.distinct('embed_backend', embedded))
+    # Chunks embedded before the backend was recorded come from Azure
+    if collection.find_one(dict(embedded, embed_backend={'$exists': False}), {'_id': 1}) is not None:
+        backends.add('azure')
+    if len(backends) > 1:
+        raise ValueError(f"Collection '{collection_name}' mixes embeddings of the encoder backends {sorted(backends)}, re-ingest it with one backend.")
+    return next(iter(backends), None)
+
+""" Call this function at startup to create the natural key and query indexes of the managed collections (idempotent)."""
+def ensure_indexes(uri, db_name):
+    db = MongoDBClient.get_client(uri)[db_name]
+    for collection_name, key in natural_keys.items():
+        collection = db[collection_name]
+        # Documents written before a hashed key field existed get it, so that upserts find them
+        for field, source in hashed_key_fields.items():
+            if field in key:
+                backfill = [
+                    UpdateOne({'_id': document['_id']}, {'$set': {field: chunk_hash(document.get(source))}})
+                    for document in collection.find({field: {'$exists': False}}, {source: 1})
+                ]
+                if backfill:
+                    collection.bulk_write(backfill, ordered=False)
+        # Not unique: replaced collections are written as the sieve parsed them, and one output can repeat a classification
+        spec = [(field, 1) for field in key]
+        existing = collection.index_information().get('natural_key')
+        if existing is not None and [(field, int(direction)) for field, direction in existing['key']] != spec:
+            # The key changed since the index was built
+            collection.drop_index('natural_key')
+        collection.create_index(spec, name='natural_key')
+    for collection_name, indexes in managed_indexes.items():
+        for fields in indexes:
+            db[collection_name].create_index([(field, 1) for field in fields])
+    logging.info("MongoDB indexes are in place.")
+
+
+#readers: stream a cursor (projection and filter applied by the server) straight into columns, without a list of documents
+def _append_document(columns, document, count):
+    for key, value in document.items():
+        column = columns.get(key)
+        if column is None:
+            # Field first seen now: earlier documents did not have it
+            column = columns[key] = [float('nan')] * count
+        column.append(value)
+    for column in columns.values():
+        if len(column) == count:
+            column.append(float('nan'))
+
+def stream_dataframes(uri, db_name, collection_name, projection=None, query=None, batch_size=None):
+    """
+    Reads a collection as consecutive DataFrames of at most batch_size rows, so memory stays bounded by one batch.
+
+    Args:
+        uri (str): MongoDB connection URI.
+        db_name (str): Name of the database.
+        collection_name (str): Name of the collection.
+        projection (dict): Fields to read, ask only for the columns the stage needs.
+        query (dict): Filter applied by the server.
+        batch_size (int): Documents per cursor round trip and per DataFrame, read_batch_size by default.
+    """
+    batch_size = batch_size or read_batch_size
+    cursor = MongoDBClient.get_client(uri)[db_name][collection_name].find(query or {}, projection, batch_size=batch_size)
+    columns = {}
+    count = 0
+    for document in cursor:
+        _append_document(columns, document, count)
+        count += 1
+        if count == batch_size:
+            yield pd.DataFrame(columns)
+            columns = {}
+            count = 0
+    if count:
+        yield pd.DataFrame(columns)
+
+def read_dataframe(uri, db_name, collection_name, projection=None, query=None, batch_size=None):
+    """
+    Reads a whole collection (or the documents matching query) into one DataFrame, same result as
+    pd.DataFrame(list(collection.find(query, projection))) without holding every document as a dict.
+    The collection is read as DataFrame batches (stream_dataframes) that are concatenated, so only one
+    batch is ever held as Python lists next to the result.
+    """
+    batches = list(stream_dataframes(uri, db_name, collection_name, projection, query, batch_size))
+    if not batches:
+        return pd.DataFrame()
+    if len(batches) == 1:
+        return batches[0]
+    # A column that is all missing in some batch comes back as object, infer its type again on the whole
+    return pd.concat(batches, ignore_index=True).infer_objects()
+
+def read_filtered_dataframe(uri, db_name, collection_name, keep, projection=None, query=None, batch_size=None):
+    """
+    Streams a collection and keeps only the rows selected by keep, for filters the server cannot apply
+    (e.g. on normalised paper names). Memory is bounded by one batch plus the kept rows.
+
+    Args:
+        keep (callable): Takes a batch DataFrame, returns a boolean Series of the rows to keep.
+    """
+    kept = []
+    for df in stream_dataframes(uri, db_name, collection_name, projection, query, batch_size):
+        mask = keep(df)
+        if mask.any():
+            kept.append(df[mask])
+    return pd.concat(kept, ignore_index=True) if kept else pd.DataFrame()
@@ -5,6 +5,7 @@ import pandas as pd
 from .embedding import *
 from tqdm import tqdm
 from pymongo import MongoClient
+from .mongo_client import MongoDBClient
 from dotenv import load_dotenv
 import os
 import certifi
@@ -12,7 +13,7 @@ from .call_mongodb import *
 
 load_dotenv()
 uri = os.getenv("uri_mongo")
-client = MongoClient(uri, tls=True, tlsCAFile=certifi.where())
+client = MongoDBClient.get_client(uri)
 db = client['data']
 collection="Extracted_Retracted"
 
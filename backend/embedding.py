@@ -1,7 +1,7 @@
 import os
+import logging
 from openai import AzureOpenAI
 from dotenv import load_dotenv
-import subprocess
 import pandas as pd
 import re
 import tiktoken
@@ -9,30 +9,55 @@ import numpy as np
 import re
 from num2words import num2words
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from openai import AuthenticationError, RateLimitError
+from .token_manager import token_manager
+from .rate_limiter import RateLimiter, retry_after_seconds
+from .cache import embedding_cache
+from .similarity import SimilarityIndex, to_float32_vector
+from .vector_index import VectorIndex, vector_index_path
+from .local_encoder import encode_texts as local_encode_texts
 
 
 #Normal embedder (not semantic chunker) that uses set tokens to embed, page to embed etc
 
 load_dotenv()
 
-az_path = os.getenv("az_path")
-
-# Fetch Azure OpenAI access token
-result = subprocess.run([az_path, 'account', 'get-access-token', '--resource', 'https://cognitiveservices.azure.com', '--query', 'accessToken', '-o', 'tsv'], stdout=subprocess.PIPE)
-token = result.stdout.decode('utf-8').strip()
-
-# Set environment variables
-os.environ['AZURE_OPENAI_ENDPOINT'] = os.getenv('endpoint')
-os.environ['AZURE_OPENAI_API_KEY'] = token
-
-
-client = AzureOpenAI(
-  api_key = os.getenv("AZURE_OPENAI_API_KEY"),  
-  api_version = os.getenv("ver"),
-  azure_endpoint =os.getenv("AZURE_OPENAI_ENDPOINT") 
-)
+# Limits of one embeddings request (Azure accepts up to 2048 inputs) and the quota of the embedding deployment
+embed_max_inputs = int(os.getenv("embed_max_inputs", 2048))
+embed_max_tokens = int(os.getenv("embed_max_tokens", 300000))
+embed_requests_per_minute = int(os.getenv("embed_rpm", 600))
+embed_tokens_per_minute = int(os.getenv("embed_tpm", 350000))
+embed_max_workers = int(os.getenv("embed_max_workers", 8))
+# Default encoder of a job: 'azure' (Azure OpenAI embeddings) or 'local' (offline CPU encoder, see local_encoder.py)
+encoder_backend = os.getenv("encoder_backend", "azure")
+encoder_backends = ('azure', 'local')
+# The embedding deployment has its own quota, so it gets its own process-wide limiter
+embed_rate_limiter = RateLimiter(embed_requests_per_minute, embed_tokens_per_minute, name='embeddings')
+
+# Client and tokenizer are created on first use so importing the package needs neither Azure CLI nor network
+client = None
+tokenizer = None
+
+def get_embedding_client():
+    global client
+    token = token_manager.get_token_blocking()
+    if client is None:
+        client = AzureOpenAI(
+          api_key = token,  
+          api_version = os.getenv("ver"),
+          azure_endpoint =os.getenv("endpoint") 
+        )
+    elif token and client.api_key != token:
+        # Swap the refreshed token in place
+        client.api_key = token
+    return client
 
-tokenizer = tiktoken.get_encoding("cl100k_base")
+def get_tokenizer():
+    global tokenizer
+    if tokenizer is None:
+        tokenizer = tiktoken.get_encoding("cl100k_base")
+    return tokenizer
 
 # excel_file = 'processed.xlsx'
 # df = pd.read_excel(excel_file)
@@ -72,11 +97,12 @@ def splitting(df, title):
 """ Call this function to tokenize content  """
 def tokenize(df, title):
     tqdm.pandas(desc='Tokenizing chunks')
-    df['n_tokens']=df[title].progress_apply(lambda x: len(tokenizer.encode(x)))
+    df['n_tokens']=df[title].progress_apply(lambda x: len(get_tokenizer().encode(x)))
     return df
 
 # helper function
 def chunk_text(text, max_tokens):
+    tokenizer = get_tokenizer()
     tokens = tokenizer.encode(text)
     chunks = []
     for i in range(0, len(tokens), max_tokens):
@@ -89,19 +115,120 @@ def chunk_text(text, max_tokens):
 def chunking(df, title, tokens):
     tqdm.pandas(desc='chunking text for token limit')
     df['Text Chunks'] = df[title].progress_apply(lambda x: chunk_text(x, tokens))
+    if 'embed_v3' in df:
+        # An embedding made at chunking time only describes texts that were not cut further
+        df['embed_v3'] = [vector if len(pieces) == 1 else None for vector, pieces in zip(df['embed_v3'], df['Text Chunks'])]
     df = df.explode('Text Chunks').reset_index(drop=True)
-    df['n_tokens'] = df["Text Chunks"].progress_apply(lambda x: len(tokenizer.encode(x)))
+    df['n_tokens'] = df["Text Chunks"].progress_apply(lambda x: len(get_tokenizer().encode(x)))
     return df
 
 
+#helper function to group inputs into requests that respect the per-request input and token limits
+def pack_batches(n_tokens, max_inputs=embed_max_inputs, max_tokens=embed_max_tokens):
+    """
+    Args:
+        n_tokens (list[int]): Token count of every input, in order.
+
+    Returns:
+        list[list[int]]: Indices of the inputs that go into each request.
+    """
+    batches = []
+    current = []
+    current_tokens = 0
+    for i, count in enumerate(n_tokens):
+        if current and (len(current) >= max_inputs or current_tokens + count > max_tokens):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(i)
+        current_tokens += count
+    if current:
+        batches.append(current)
+    return batches
+
+#helper function to send one embeddings request through the shared limiter
+def embed_batch(texts, tokens, model=os.getenv("embed_model"), max_retries=5, retry_delay=10):
+    for attempt in range(max_retries):
+        embed_rate_limiter.acquire_blocking(tokens)
+        try:
+            raw_response = get_embedding_client().embeddings.with_raw_response.create(input=texts, model=model)
+            embed_rate_limiter.update_from_headers(raw_response.headers)
+            data = raw_response.parse().data
+            # Results carry the index of their input, do not rely on the order
+            return [item.embedding for item in sorted(data, key=lambda item: item.index)]
+        except RateLimitError as e:
+            delay = retry_after_seconds(e.response.headers) if e.response is not None else None
+            logging.warning(f"Embedding rate limit hit (attempt {attempt + 1}/{max_retries}).")
+            embed_rate_limiter.block_for(delay or retry_delay)
+        except AuthenticationError:
+            logging.warning("401 Unauthorized error. Refreshing token...")
+            token_manager.get_token_blocking(force=True)
+    raise RuntimeError(f"Embedding request of {len(texts)} inputs failed after {max_retries} attempts.")
+
+#helper function to pick the encoder of a job, the process default when none is given
+def resolve_backend(backend=None):
+    backend = backend or encoder_backend
+    if backend not in encoder_backends:
+        raise ValueError(f"Unknown encoder backend '{backend}', expected one of {encoder_backends}.")
+    return backend
+
+""" Call this function to embed a list of texts with as few requests as possible. Output is a list of vectors in input order."""
+def embed_texts(texts, n_tokens=None, model=os.getenv("embed_model"), desc="Generating embeddings", use_cache=True, backend=None):
+    # The endpoint rejects empty inputs
+    texts = [text if isinstance(text, str) and text else ' ' for text in texts]
+    if not texts:
+        return []
+    if resolve_backend(backend) == 'local':
+        # Cheaper to recompute than to cache
+        return local_encode_texts(texts).tolist()
+    embeddings = [None] * len(texts)
+    # Only texts that were never embedded with this model are sent
+    if use_cache:
+        for i, vector in embedding_cache.get_many(texts, model).items():
+            embeddings[i] = vector
+    missing = [i for i, vector in enumerate(embeddings) if vector is None]
+    if not missing:
+        return embeddings
+    if n_tokens is None:
+        tokenizer = get_tokenizer()
+        missing_tokens = [len(tokenizer.encode(texts[i])) for i in missing]
+    else:
+        missing_tokens = [int(n_tokens[i]) for i in missing]
+    batches = [[missing[j] for j in batch] for batch in pack_batches(missing_tokens)]
+    token_counts = dict(zip(missing, missing_tokens))
+    with ThreadPoolExecutor(max_workers=min(embed_max_workers, len(batches))) as executor:
+        futures = {
+            executor.submit(embed_batch, [texts[i] for i in batch], sum(token_counts[i] for i in batch), model): batch
+            for batch in batches
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            batch = futures[future]
+            vectors = future.result()
+            for i, vector in zip(batch, vectors):
+                embeddings[i] = vector
+            if use_cache:
+                embedding_cache.set_many([texts[i] for i in batch], vectors, model)
+    return embeddings
+
 #helper function
-def generate_embeddings(text, model=os.getenv("embed_model")): # model = "deployment_name"
-    embed=client.embeddings.create(input = [text], model=model).data[0].embedding
-    return embed
+def generate_embeddings(text, model=os.getenv("embed_model"), backend=None): # model = "deployment_name"
+    return embed_texts([text], model=model, desc="Embedding text", backend=backend)[0]
 """ Call this function to generate embeddings """
-def embed(df):
-    tqdm.pandas(desc="Generating embeddings")
-    df['embed_v3'] = df["Text Chunks"].progress_apply(lambda x : generate_embeddings (x, model = os.getenv("embed_model")))
+def embed(df, backend=None):
+    # Chunks that already carry an embedding from semantic chunking are not embedded again
+    if 'embed_v3' not in df:
+        df['embed_v3'] = None
+    missing = [i for i, vector in enumerate(df['embed_v3']) if not isinstance(vector, (list, np.ndarray))]
+    # The encoder is recorded with the vectors, retrieval embeds its queries with the same one
+    df['embed_backend'] = resolve_backend(backend)
+    if missing:
+        # n_tokens is computed by tokenize/chunking and used to pack requests
+        n_tokens = df['n_tokens'].iloc[missing].tolist() if 'n_tokens' in df else None
+        vectors = embed_texts(df["Text Chunks"].iloc[missing].tolist(), n_tokens, model=os.getenv("embed_model"), backend=backend)
+        embeddings = df['embed_v3'].tolist()
+        for i, vector in zip(missing, vectors):
+            embeddings[i] = vector
+        df['embed_v3'] = embeddings
     #df['embed_name']=df['PDF File'].apply(lambda x : generate_embeddings (x, model = os.getenv("embed_model")))
     return df
 
@@ -118,9 +245,8 @@ def send_excel(df,directory, filename):
 def cosine_similarity(a, b):
     return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 #helper function
-def get_embedding(text, model=os.getenv("embed_model")): # model = "deployment_name"
-    embed=client.embeddings.create(input = [text], model=model).data[0].embedding
-    return embed
+def get_embedding(text, model=os.getenv("embed_model"), backend=None): # model = "deployment_name"
+    return generate_embeddings(text, model=model, backend=backend)
 
 
 
@@ -129,50 +255,52 @@ def convert_to_float_array(obj):
     """
     Convert an object (e.g., list or string representation of a list) to a numpy array of floats.
     """
-    if isinstance(obj, str):
-        # Convert string representation of a list to a list
-        obj = eval(obj)
-    return np.array(obj, dtype=float)
-
+    # Strings are parsed as literals, never evaluated
+    return to_float32_vector(obj, dtype=float)
+
+
+#helper function to make the chunk embeddings of a DataFrame comparable with queries of the given encoder backend.
+#Stored embeddings of that backend are used as they are, chunks without one or with one of another encoder are (re)embedded
+def encode_chunks(df, backend=None):
+    backend = resolve_backend(backend)
+    embeddings = df['embed_v3'].tolist() if 'embed_v3' in df else [None] * len(df)
+    # Embeddings stored before the backend was recorded are Azure ones
+    recorded = df['embed_backend'].where(df['embed_backend'].notna(), 'azure').tolist() if 'embed_backend' in df else ['azure'] * len(df)
+    stale = [position for position, (embedding, embedded_with) in enumerate(zip(embeddings, recorded))
+             if embedded_with != backend or not isinstance(embedding, (list, tuple, np.ndarray, str))]
+    if stale:
+        column = 'Text Chunks' if 'Text Chunks' in df else 'Text Content'
+        texts = df[column].tolist()
+        for position, vector in zip(stale, embed_texts([texts[position] for position in stale], backend=backend)):
+            embeddings[position] = vector
+    df['embed_v3'] = embeddings
+    df['embed_backend'] = backend
+    return df
 
 #helper function
-def search_docs_text(df, user_query, top_n, to_print=True):
+def search_docs_text(df, user_query, top_n, to_print=True, backend=None):
     df=df.copy()
     embedding = get_embedding(
         user_query,
-        model=os.getenv("embed_model") # model should be set to the deployment name you chose when you deployed the model
-    )
-    df.loc[:, 'embed_v3'] = df['embed_v3'].apply(convert_to_float_array)
-    df.loc[:,"similarities_text"] = df.embed_v3.apply(lambda x: cosine_similarity(x, embedding)) 
-    
-    res = (
-        df.sort_values("similarities_text", ascending=False)
-        .head(top_n)
+        model=os.getenv("embed_model"), # model should be set to the deployment name you chose when you deployed the model
+        backend=backend
     )
+    df = encode_chunks(df, backend)
+    res = SimilarityIndex(df).search(embedding, top_n)
     # if to_print:
     #     print(res) 
     return res
 #add extra threshold to above helper function
-def search_docs_text_threshold(df, user_query, top_n, threshold, to_print=True):
+def search_docs_text_threshold(df, user_query, top_n, threshold, to_print=True, backend=None):
     df=df.copy()
     embedding = get_embedding(
         user_query,
-        model=os.getenv("embed_model") # model should be set to the deployment name you chose when you deployed the model
+        model=os.getenv("embed_model"), # model should be set to the deployment name you chose when you deployed the model
+        backend=backend
     )
-    df.loc[:, 'embed_v3'] = df['embed_v3'].apply(convert_to_float_array)
-    df.loc[:,"similarities_text"] = df.embed_v3.apply(lambda x: cosine_similarity(x, embedding)) 
-    filtered_df = df[df["similarities_text"] > threshold]
-    if filtered_df.empty:
-        # If no document has a similarity above the threshold, return the top similarity
-        top_similarity = df["similarities_text"].max()
-        res = df[df["similarities_text"] == top_similarity]
-    else:
-        # Otherwise, return the top N documents above the threshold
-        res = (
-            filtered_df.sort_values("similarities_text", ascending=False)
-            .head(top_n)
-        )
-    
+    df = encode_chunks(df, backend)
+    # Top N documents above the threshold, or the top similarity if none is above it
+    res = SimilarityIndex(df).search(embedding, top_n, threshold)
     # if to_print:
     #     print(res) 
     return res
@@ -180,6 +308,29 @@ def search_docs_text_threshold(df, user_query, top_n, threshold, to_print=True):
 def normalize_string(s):
     return re.sub(r'\s+', '', s).lower()
 
+""" Call this function to (re)build or extend the vector index of a chunk collection. Records need '_id', 'PDF File' and 'embed_v3' or 'Text Content'."""
+#backend is the encoder the embeddings were made with: the index's own when extending it, the process default for a new index
+def index_chunks(collection_name, records, rebuild=False, backend=None):
+    path = vector_index_path(collection_name)
+    index = None if rebuild else VectorIndex.load(path)
+    if index is None and not rebuild:
+        # Collections without an index (e.g. chunks that are never embedded) are left alone
+        return None
+    backend = resolve_backend(backend or (index.backend if index is not None else None))
+    records = [record for record in records if '_id' in record]
+    # Chunks stored without an embedding are embedded here (mostly cache hits)
+    missing = [record for record in records if not isinstance(record.get('embed_v3'), (list, np.ndarray))]
+    if missing:
+        vectors = embed_texts([record.get('Text Content') for record in missing], desc="Embedding chunks for the index", backend=backend)
+        for record, vector in zip(missing, vectors):
+            record['embed_v3'] = vector
+    vectors = [record['embed_v3'] for record in records]
+    ids = [record['_id'] for record in records]
+    papers = [normalize_string(str(record.get('PDF File', ''))) for record in records]
+    if index is None:
+        return VectorIndex.build(path, vectors, ids, papers, backend)
+    return index.add(vectors, ids, papers, backend)
+
 """ Call this functon to focus on the pdf  """
 #each input is an element containing [text,name, year]
 def retrieve_pdf(df,name_and_text_and_year):
@@ -19,6 +19,7 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 from .mongo_client import MongoDBClient
+from .records import ReplaceResult, EditResult, SummaryResult, AuthoredSummaryResult, RecordColumns
 
 
 load_dotenv()
@@ -33,19 +34,16 @@ async def process_row_async_final(row,text):
     original_statement=row['Statement']
     ans=await call_convert_to_replace(r,text)
     newrow=ast.literal_eval(ans)
-    new_row=pd.DataFrame({
-        'statement':[original_statement],
-        'Statement':[newrow[0]],
-        'Reference':[newrow[1]]
-    })
+    new_row=ReplaceResult(original_statement=original_statement, statement=newrow[0], reference=newrow[1])
     return new_row
 
 async def final_async(df_replacee,text):
     """Main function to run the parallelized process using asyncio and the async OpenAI client."""
-    output=[]
+    # Results are collected column by column, the DataFrame is built once at the end
+    output=RecordColumns(ReplaceResult)
     # Process each row asynchronously using the process_row_async function
-    # Define a semaphore to limit the number of concurrent tasks (added because VPN cause my tasks to throttle, you can try to remove from this line onwards to)
-    semaphore = asyncio.Semaphore(20)  # Adjust the number as needed
+    # Semaphore only caps in-flight requests, the pace is set by the shared rate limiter in gpt_rag_asyncio
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
 
     async def process_row_with_semaphore(row,text):
         """Wrapper function to use semaphore for each task."""
@@ -53,15 +51,11 @@ async def final_async(df_replacee,text):
             return await process_row_async_final(row,text)
     # Create tasks with semaphore-wrapped function
     tasks = [process_row_with_semaphore(row,text) for _, row in df_replacee.iterrows()]
-    #this line then replace with
-    #tasks = [process_row_async(row) for _, row in df_replacee.iterrows()]
-    #for quicker times (for context, without the vpn a 8 hours task takes 2 hours)
     
     # Use tqdm_asyncio to track progress of async tasks
     for new_row in await tqdm_asyncio.gather(*tasks, desc='Processing rows in parallel'):
         output.append(new_row)
-    # Concatenate valid rows
-    output_df = pd.concat(output, ignore_index=True) if output else pd.DataFrame()
+    output_df = output.to_dataframe()
 
 
     return output_df
@@ -84,19 +78,16 @@ async def process_row_async_edit(row,text):
     statement=row['statement']
     ans=await call_edit_citationer(r,text)
     newrow=ast.literal_eval(ans)
-    new_row=pd.DataFrame({
-        'statement':[statement],
-        'Edit':[newrow[0]],
-        'Reference':[newrow[1]]
-    })
+    new_row=EditResult(statement=statement, edit=newrow[0], reference=newrow[1])
     return new_row
 
 async def edit_async(df_edit,text):
     """Main function to run the parallelized process using asyncio and the async OpenAI client."""
-    output=[]
+    # Results are collected column by column, the DataFrame is built once at the end
+    output=RecordColumns(EditResult)
     # Process each row asynchronously using the process_row_async function
-    # Define a semaphore to limit the number of concurrent tasks (added because VPN cause my tasks to throttle, you can try to remove from this line onwards to)
-    semaphore = asyncio.Semaphore(20)  # Adjust the number as needed
+    # Semaphore only caps in-flight requests, the pace is set by the shared rate limiter in gpt_rag_asyncio
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
 
     async def process_row_with_semaphore(row,text):
         """Wrapper function to use semaphore for each task."""
@@ -104,15 +95,11 @@ async def edit_async(df_edit,text):
             return await process_row_async_edit(row,text)
     # Create tasks with semaphore-wrapped function
     tasks = [process_row_with_semaphore(row,text) for _, row in df_edit.iterrows()]
-    #this line then replace with
-    #tasks = [process_row_async(row) for _, row in df_replacee.iterrows()]
-    #for quicker times (for context, without the vpn a 8 hours task takes 2 hours)
     
     # Use tqdm_asyncio to track progress of async tasks
     for new_row in await tqdm_asyncio.gather(*tasks, desc='Processing rows in parallel'):
         output.append(new_row)
-    # Concatenate valid rows
-    output_df = pd.concat(output, ignore_index=True) if output else pd.DataFrame()
+    output_df = output.to_dataframe()
 
 
     return output_df
@@ -144,22 +131,21 @@ async def process_row_async_summary(row,got_authors):
         if isinstance(chunk, str):
             chunk = ast.literal_eval(chunk)
         date=row.loc['Date']
-        await asyncio.sleep(10)
-        # Use the async wrapper to call the GPT service with retry logic
+        # Use the async wrapper to call the GPT service with retry logic (paced by the shared rate limiter)
         #ans = await call_summarizer_scorer_async(list_of_sieved_chunks,statement,sentiment)
         ans = await call_summarizer_scorer_async(chunk,statement,sentiment)
         
-        new_row = pd.DataFrame({
-            'Sentiment':[sentiment],
-            'Sieving by gpt 4o': [list_of_sieved_chunks],
-            'Chunk':[chunk],
-            'Reference article name': [name],
-            'Reference text in main article': [statement],
-            'Summary':[ans],
-            'authors':[authors],
-            'Date':[date],
-            'Paper Id':[paper]
-        })
+        new_row = AuthoredSummaryResult(
+            sentiment=sentiment,
+            sieved=list_of_sieved_chunks,
+            chunk=chunk,
+            article_name=name,
+            statement=statement,
+            summary=ans,
+            authors=authors,
+            date=date,
+            paper_id=paper
+        )
     #for old top 5 where no authors added
     else:
         """Async function to process each row in the DataFrame using the async Azure OpenAI call."""
@@ -173,29 +159,29 @@ async def process_row_async_summary(row,got_authors):
         if isinstance(chunk, str):
             chunk = ast.literal_eval(chunk)
         date=row.loc['Date']
-        await asyncio.sleep(10)
-        # Use the async wrapper to call the GPT service with retry logic
+        # Use the async wrapper to call the GPT service with retry logic (paced by the shared rate limiter)
         #ans = await call_summarizer_scorer_async(list_of_sieved_chunks,statement,sentiment)
         ans = await call_summarizer_scorer_async(chunk,statement,sentiment)
         
-        new_row = pd.DataFrame({
-            'Sentiment':[sentiment],
-            'Sieving by gpt 4o': [list_of_sieved_chunks],
-            'Chunk':[chunk],
-            'Reference article name': [name],
-            'Reference text in main article': [statement],
-            'Summary':[ans],
-            'Date':[date]
-        })
+        new_row = SummaryResult(
+            sentiment=sentiment,
+            sieved=list_of_sieved_chunks,
+            chunk=chunk,
+            article_name=name,
+            statement=statement,
+            summary=ans,
+            date=date
+        )
     return new_row
 
 
 async def summarize_score_async(df_replacee,got_authors):
     """Main function to run the parallelized process using asyncio and the async OpenAI client."""
-    output=[]
+    # Results are collected column by column, the DataFrame is built once at the end
+    output=RecordColumns(AuthoredSummaryResult if got_authors else SummaryResult)
     # Process each row asynchronously using the process_row_async function
-    # Define a semaphore to limit the number of concurrent tasks (added because VPN cause my tasks to throttle, you can try to remove from this line onwards to)
-    semaphore = asyncio.Semaphore(20)  # Adjust the number as needed
+    # Semaphore only caps in-flight requests, the pace is set by the shared rate limiter in gpt_rag_asyncio
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
 
     async def process_row_with_semaphore(row,got_authors=got_authors):
         """Wrapper function to use semaphore for each task."""
@@ -203,15 +189,11 @@ async def summarize_score_async(df_replacee,got_authors):
             return await process_row_async_summary(row,got_authors=got_authors)
     # Create tasks with semaphore-wrapped function
     tasks = [process_row_with_semaphore(row,got_authors=got_authors) for _, row in df_replacee.iterrows()]
-    #this line then replace with
-    #tasks = [process_row_async(row) for _, row in df_replacee.iterrows()]
-    #for quicker times (for context, without the vpn a 8 hours task takes 2 hours)
     
     # Use tqdm_asyncio to track progress of async tasks
     for new_row in await tqdm_asyncio.gather(*tasks, desc='Processing rows in parallel'):
         output.append(new_row)
-    # Concatenate valid rows
-    output_df = pd.concat(output, ignore_index=True) if output else pd.DataFrame()
+    output_df = output.to_dataframe()
 
 
     return output_df
@@ -250,43 +232,29 @@ def switch_sentiment(df_replacee):
 #include authors for citation
 #Remove row where score == irrelevant
 def make_pretty_for_expert(top_5, new_ref_collection, expert):
-    collection_top5 = db[top_5]
-    documents = list(
-        collection_top5.find(
-            {}, 
-            {
-                '_id': 1,
-                'Sentiment': 1,
-                'Confidence Score': 1,
-                'Sieving by gpt 4o': 1,
-                'Reference article name': 1,
-                'Reference text in main article': 1,
-                'Chunk': 1,
-                'Date': 1
-            }
-        )
-    )
-    df_top5 = pd.DataFrame(documents)
-
-    collection_metadata = db[new_ref_collection]
-    documents1 = list(
-        collection_metadata.find(
-            {},
-            {
-                '_id': 1,
-                'Title of original reference article': 1,
-                'Text in main article referencing reference article': 1,
-                'Year reference article released': 1,
-                'Keywords for graph paper search': 1,
-                'Paper Id of new reference article found': 1,
-                'Title of new reference article found': 1,
-                'Year new reference article found published': 1,
-                'authors': 1
-            }
-        )
-    )
+    df_top5 = read_dataframe(uri, db.name, top_5, {
+        '_id': 1,
+        'Sentiment': 1,
+        'Confidence Score': 1,
+        'Sieving by gpt 4o': 1,
+        'Reference article name': 1,
+        'Reference text in main article': 1,
+        'Chunk': 1,
+        'Date': 1
+    })
+
+    df_metadata = read_dataframe(uri, db.name, new_ref_collection, {
+        '_id': 1,
+        'Title of original reference article': 1,
+        'Text in main article referencing reference article': 1,
+        'Year reference article released': 1,
+        'Keywords for graph paper search': 1,
+        'Paper Id of new reference article found': 1,
+        'Title of new reference article found': 1,
+        'Year new reference article found published': 1,
+        'authors': 1
+    })
 
-    df_metadata = pd.DataFrame(documents1)
 
     # Handle duplicates in 'Title of new reference article found'
     df_metadata['authors'] = df_metadata['authors'].apply(
@@ -335,23 +303,16 @@ def make_pretty_for_expert(top_5, new_ref_collection, expert):
 
 #To make summary of original references in order to compare and see if new references found should supplement or replace the old references based on summary of retrieved content that supports statements
 def make_summary_for_comparison(top_5,expert):
-    collection_top5 = db[top_5]
-    documents = list(
-        collection_top5.find(
-            {}, 
-            {
-                '_id': 1,
-                'Sentiment':1,
-                'Confidence Score':1,
-                'Sieving by gpt 4o': 1,
-                'Reference article name': 1,
-                'Reference text in main article': 1,
-                'Chunk': 1,
-                'Date': 1
-            }
-        )
-    )
-    df_top5=pd.DataFrame(documents)
+    df_top5 = read_dataframe(uri, db.name, top_5, {
+        '_id': 1,
+        'Sentiment':1,
+        'Confidence Score':1,
+        'Sieving by gpt 4o': 1,
+        'Reference article name': 1,
+        'Reference text in main article': 1,
+        'Chunk': 1,
+        'Date': 1
+    })
     grouped_chunks = df_top5.groupby(
         ['Sentiment', 'Reference article name', 'Reference text in main article','Date']
     ).agg({
@@ -397,59 +358,38 @@ def make_summary_for_comparison(top_5,expert):
     
 #merge selected new data w old data based on inner join statements for comparison
 def merge_old_new(expert_new, expert_old, statements, name):
-    collection_statements = db[statements]
-    documents_statements = list(
-        collection_statements.find(
-            {},
-            {
-                'Reference article name': 1,
-                'Reference text in main article': 1,
-                'Date': 1,
-                'Name of authors': 1
-            }
-        )
-    )
-    df_statement = pd.DataFrame(documents_statements)
+    df_statement = read_dataframe(uri, db.name, statements, {
+        'Reference article name': 1,
+        'Reference text in main article': 1,
+        'Date': 1,
+        'Name of authors': 1
+    })
 
     # Fetch new data
-    collection_new = db[expert_new]
-    documents_new = list(
-        collection_new.find(
-            {},
-            {
-                'sentiment': 1,
-                'sievingByGPT4o': 1,
-                'chunk': 1,
-                'articleName': 1,
-                'statement': 1,
-                'summary': 1,
-                'authors': 1,
-                'date': 1,
-                'rating': 1
-            }
-        )
-    )
-    df_new = pd.DataFrame(documents_new)
+    df_new = read_dataframe(uri, db.name, expert_new, {
+        'sentiment': 1,
+        'sievingByGPT4o': 1,
+        'chunk': 1,
+        'articleName': 1,
+        'statement': 1,
+        'summary': 1,
+        'authors': 1,
+        'date': 1,
+        'rating': 1
+    })
     df_new['state'] = 'new'  # Add state column for new data
 
     # Fetch old data
-    collection_old = db[expert_old]
-    documents_old = list(
-        collection_old.find(
-            {},
-            {
-                'Sentiment': 1,
-                'Sieving by gpt 4o': 1,
-                'Chunk': 1,
-                'Reference article name': 1,
-                'Reference text in main article': 1,
-                'Summary': 1,
-                'Date': 1,
-                'score': 1
-            }
-        )
-    )
-    df_old = pd.DataFrame(documents_old)
+    df_old = read_dataframe(uri, db.name, expert_old, {
+        'Sentiment': 1,
+        'Sieving by gpt 4o': 1,
+        'Chunk': 1,
+        'Reference article name': 1,
+        'Reference text in main article': 1,
+        'Summary': 1,
+        'Date': 1,
+        'score': 1
+    })
     df_old = df_old.rename(columns={
         'Sentiment': 'sentiment',
         'Sieving by gpt 4o': 'sievingByGPT4o',
@@ -976,38 +916,24 @@ def edit_paper(df_main,text,remove_ref,add_ref):
 #update main article based on selection
 def formatting():
     #main paper data
-    collection_main = db['collated_statements_and_citations']
-    documents_main = list(
-        collection_main.find(
-            {},
-            {
-                'Reference article name': 1,
-                'Reference text in main article': 1,
-                'Date': 1,
-                'Name of authors': 1
-            }
-        )
-    )
+    df_main = read_dataframe(uri, db.name, 'collated_statements_and_citations', {
+        'Reference article name': 1,
+        'Reference text in main article': 1,
+        'Date': 1,
+        'Name of authors': 1
+    })
     text = read_text_file('extracted.txt')
     print('Processing main df')
-    df_main=pd.DataFrame(documents_main)
     df_main=df_main.rename(columns={'Reference article name':'articleName','Reference text in main article':'statement','Date':'date','Name of authors':'authors'})
     df_main['edits']=''
     print('Processing updates')
     """For edits"""
-    edit=db['edit']
-    documents_edit=list(list(
-        edit.find(
-            {},
-            {
-                '_id':1,
-               'statement': 1,
-               'edits':1,
-               'newReferences': 1,  
-            }
-        )
-    ))
-    df_edit=pd.DataFrame(documents_edit)
+    df_edit = read_dataframe(uri, db.name, 'edit', {
+        '_id':1,
+        'statement': 1,
+        'edits':1,
+        'newReferences': 1
+    })
     if df_edit.empty:
         df_edition=df_edit
     else:
@@ -1036,19 +962,11 @@ def formatting():
 
 
     """For addition"""
-    addition=db['addition']
-    documents_add=list(list(
-        addition.find(
-                {}, 
-                {
-                    '_id': 1,             
-                    'statement': 1,       
-                    'newReferences': 1,   
-                }
-            )
-        )
-    )
-    df_add = pd.DataFrame(documents_add)
+    df_add = read_dataframe(uri, db.name, 'addition', {
+        '_id': 1,
+        'statement': 1,
+        'newReferences': 1
+    })
     if df_add.empty:
         df_addition=df_add
     else:
@@ -1078,19 +996,12 @@ def formatting():
     """
     For replacement
     """
-    replace = db['replace']
-    documents_new = list(
-        replace.find(
-            {}, 
-            {
-                '_id': 1,             
-                'statement': 1,       
-                'oldReferences': 1,   
-                'newReferences': 1,   
-            }
-        )
-    )
-    df_replacee = pd.DataFrame(documents_new)
+    df_replacee = read_dataframe(uri, db.name, 'replace', {
+        '_id': 1,
+        'statement': 1,
+        'oldReferences': 1,
+        'newReferences': 1
+    })
     if df_replacee.empty:
         df_replace=df_replacee
     else:
@@ -89,8 +89,15 @@ def initialize_client():
         logging.error(f"Failed to initialize Azure OpenAI client: {e}")
         exit(1)
 
-# Initialize the client
-initialize_client()
+# Get the client, initializing it on first use instead of at import
+def get_client():
+    if client is None:
+        initialize_client()
+    else:
+        refresh_token_if_needed()
+        if client.api_key != access_token:
+            client.api_key = access_token  # Swap the refreshed token in place
+    return client
 
 # Function to retry operations with token refresh on Unauthorized error
 def retry_on_exception(func, *args, max_retries=3, retry_delay=2, **kwargs):
@@ -139,7 +146,7 @@ def retry_on_exception(func, *args, max_retries=3, retry_delay=2, **kwargs):
 # Get names of all PDF articles
 def naming(text):
     def func():
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model="gpt-4o",
             temperature=0,
             messages=[
@@ -166,22 +173,24 @@ def read_text_file(file_path):
     return content
 
 
-#Replaces the numeric naming of files to the actual names of files using gpt 4o
-def get_names(processed_texts,directory):
+#Gets the actual name of an article from its (cleaned) text using gpt 4o
+def get_name(cleaned_text):
     def split_text_if_necessary(text, token_limit):
         tokens = text.split()
         if len(tokens) > token_limit:
             half_index = len(tokens) // 2
             return ' '.join(tokens[:half_index])
         return text
+    return str(naming(split_text_if_necessary(cleaned_text, token_limit=2000)))
+
+#Replaces the numeric naming of files to the actual names of files using gpt 4o
+def get_names(processed_texts,directory):
     for i in range(len(processed_texts)):
         input_path = os.path.join(directory, processed_texts[i])
         with open(input_path, 'r', encoding='utf-8') as f:
             processed_text = f.read()
             cleaned_text = ''.join(char for char in processed_text if unicodedata.category(char)[0] != 'C')
-            cleaned_text = split_text_if_necessary(cleaned_text, token_limit=2000)
-            name = naming(cleaned_text)
-            processed_texts[i] = str(name)
+            processed_texts[i] = get_name(cleaned_text)
     
     return processed_texts
 
@@ -194,7 +203,7 @@ system_prompt="In the following text, what are the full texts of each reference
 # Get the references and the cited articles' names in the main article
 def get_references(text):
     def func():
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model="gpt-4o",
             temperature=0,
             messages=[
@@ -212,7 +221,7 @@ def similiar_ref(text, ref):
     def func():
         # query = "You are a reference fact checker. You check if the reference can be found in the abstract of the article in terms of semantic meaning. If yes, you highlight the information in the abstract of the article exactly as it is (Don't summarise or change anything). Output the semantically similar information only."
         query='Extract the sentence or sentences in the abstract that is most semantically similiar to the reference.'
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model="gpt-4o",
             temperature=0,
             messages=[
@@ -229,7 +238,7 @@ def similiar_ref(text, ref):
 def clean_responses(sentence):
     def func():
         query = "Tidy up the following text to output sentence(s). Don't include unnecessary jargons like Text Content and PDF..."
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model="gpt-4o",
             temperature=0,
             messages=[
@@ -274,7 +283,7 @@ def clean_responses(sentence):
 
 def rank_and_check(text, list):
     def func():
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model="gpt-4o",
             temperature=0,
             messages=[
@@ -341,7 +350,7 @@ def rank_and_check(text, list):
 def summarise_subdocument(text):
     def func():
         query='Provide a summary of the text.'
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model="gpt-4o",
             temperature=0,
             messages=[
@@ -358,7 +367,7 @@ def locate_subdoc(summary, ref):
     def func():
         # query = "You are a reference fact checker. You check if the reference can be found in the abstract of the article in terms of semantic meaning. If yes, you highlight the information in the abstract of the article exactly as it is (Don't summarise or change anything). Output the semantically similar information only."
         query='You are a relation checker. Output yes if the Summary and Reference is related. Output no otherwise'
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model="gpt-4o",
             temperature=0,
             messages=[
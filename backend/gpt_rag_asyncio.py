@@ -5,9 +5,15 @@ import logging
 import time
 from dotenv import load_dotenv
 from openai import AsyncAzureOpenAI
-from openai import AuthenticationError
+from openai import AuthenticationError, RateLimitError
 import httpx
-from .token_manager import get_or_refresh_token  
+import tiktoken
+import threading
+import weakref
+import importlib.util
+from .token_manager import get_or_refresh_token, token_manager
+from .cache import sieve_cache, make_cache_key
+from .rate_limiter import RateLimiter, retry_after_seconds
 
 #asynchronous GPT functions
 # Load environment variables
@@ -20,10 +26,19 @@ api_version = os.getenv("ver")
 
 # Global state and synchronization tools
 async_client = None
-iteration_count = 0
-max_iterations_before_reset = 50
 retry_queue = []  # Store failed tasks for retry
 
+# Shared, process-wide limiter for the GPT deployment. Set these to the quota of your Azure deployment.
+gpt_requests_per_minute = int(os.getenv("gpt_rpm", 300))
+gpt_tokens_per_minute = int(os.getenv("gpt_tpm", 150000))
+expected_completion_tokens = int(os.getenv("gpt_expected_completion_tokens", 400))
+# Upper bound of in-flight requests per fan-out, the limiter decides the actual pace
+max_concurrent_requests = int(os.getenv("max_concurrent_requests", 50))
+rate_limiter = RateLimiter(gpt_requests_per_minute, gpt_tokens_per_minute, name='gpt')
+
+# Tokenizer used to estimate prompt size before dispatch (loaded lazily since tiktoken may download the encoding)
+_encoding = None
+
 
 # Ensure token is valid
 async def ensure_valid_token():
@@ -35,53 +50,131 @@ async def ensure_valid_token():
         logging.error("Failed to get access token.")
         return None
 
-# Initialize the async client
-async def initialize_client():
-    access_token = await ensure_valid_token()
-    if access_token:
-        global async_client
-        async_client = AsyncAzureOpenAI(
+# Long-lived async clients. httpx connection pools are bound to the event loop that opened them and
+# the pipeline runs stages with asyncio.run, so one client (and one warm pool) is kept per event loop.
+# On token refresh the key is swapped in place instead of rebuilding the client and its connections.
+class AsyncClientManager:
+    def __init__(self):
+        self._clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _build(self, access_token):
+        http_client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,  # HTTP/2 needs the optional h2 package
+            limits=httpx.Limits(
+                max_connections=max_concurrent_requests + 10,
+                max_keepalive_connections=max_concurrent_requests,
+                keepalive_expiry=120
+            )
+        )
+        client = AsyncAzureOpenAI(
             azure_endpoint=endpoint,
             api_key=access_token,
-            api_version=api_version
+            api_version=api_version,
+            http_client=http_client
         )
         logging.info("Async Azure OpenAI client initialized.")
+        return client
+
+    def get_client(self, access_token):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.get(loop)
+            if client is None:
+                client = self._build(access_token)
+                self._clients[loop] = client
+            elif client.api_key != access_token:
+                client.api_key = access_token
+        return client
+
+    def set_token(self, access_token):
+        with self._lock:
+            for client in self._clients.values():
+                client.api_key = access_token
+
+    async def close_client(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.pop(loop, None)
+        if client is not None:
+            await client.close()
+
+client_manager = AsyncClientManager()
+# Swap every refreshed token into the live clients
+token_manager.add_listener(client_manager.set_token)
+
+# Get the client of the running event loop with a valid token
+async def get_async_client():
+    global async_client
+    access_token = await ensure_valid_token()
+    if access_token:
+        async_client = client_manager.get_client(access_token)
+    return async_client
 
-# Reset client after max iterations
-async def check_and_reset_client():
-    global iteration_count
-    if iteration_count >= max_iterations_before_reset:
-        logging.info("Resetting client after max iterations.")
-        await initialize_client()
-        iteration_count = 0
+# Initialize the async client (cheap once the client of this event loop exists)
+async def initialize_client():
+    await get_async_client()
+
+# Close the client of the running event loop (on shutdown)
+async def close_client():
+    await client_manager.close_client()
 
 # Extract Retry-After delay
 def extract_retry_after(exception):
     if hasattr(exception, 'response') and exception.response is not None:
-        retry_after = exception.response.headers.get('Retry-After')
-        if retry_after:
-            try:
-                return int(retry_after)
-            except ValueError:
-                logging.warning(f"Retry-After header not an integer: {retry_after}")
+        return retry_after_seconds(exception.response.headers)
     return None
 
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model("gpt-4o")
+        except KeyError:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding
+
+# Count prompt tokens of a chat request (plus the expected completion) for the limiter
+def estimate_request_tokens(data):
+    texts = []
+    for message in data.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            texts.extend(part.get("text", "") for part in content if isinstance(part, dict))
+    try:
+        encoding = get_encoding()
+        prompt_tokens = sum(len(encoding.encode(text)) for text in texts)
+    except Exception as e:
+        # Fall back to a rough estimate if the tokenizer cannot be loaded (e.g. offline)
+        logging.warning(f"Could not load tokenizer, estimating tokens: {e}")
+        prompt_tokens = sum(len(text) for text in texts) // 4
+    # Every message carries a few tokens of overhead
+    return prompt_tokens + 4 * len(texts) + data.get("max_tokens", expected_completion_tokens)
+
+# Every chat completion goes through here so that the shared limiter sees all traffic
+async def create_chat_completion(data):
+    client = await get_async_client()
+    await rate_limiter.acquire(estimate_request_tokens(data))
+    raw_response = await client.chat.completions.with_raw_response.create(**data)
+    rate_limiter.update_from_headers(raw_response.headers)
+    return raw_response.parse()
+
 # Asynchronous retry function with storage of failed tasks
 async def async_retry_on_exception(func, *args, max_retries=3, retry_delay=10, **kwargs):
-    global iteration_count, retry_queue
+    global retry_queue
     attempt = 0
 
     while attempt < max_retries:
         try:
             logging.info(f"Attempt {attempt + 1}/{max_retries} for {func.__name__}...")
             await ensure_valid_token()  # Ensure token is valid
-            await check_and_reset_client()
 
             result = await func(*args, **kwargs)  # Execute the function
-            iteration_count += 1
             return result
 
-        except (RuntimeError, AuthenticationError, httpx.HTTPStatusError) as e:
+        except (RuntimeError, AuthenticationError, RateLimitError, httpx.HTTPStatusError) as e:
             if isinstance(e, RuntimeError) and "Event loop is closed" in str(e):
                 logging.warning("Caught 'Event loop is closed' error. Adding to retry queue.")
                 retry_queue.append((func, args, kwargs))
@@ -90,13 +183,18 @@ async def async_retry_on_exception(func, *args, max_retries=3, retry_delay=10, *
             if isinstance(e, AuthenticationError) or \
                (isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 401):
                 logging.warning("401 Unauthorized error. Refreshing token...")
+                await token_manager.refresh_token(force=True)
                 await initialize_client()
 
-            elif isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 429:
+            elif isinstance(e, RateLimitError) or \
+                 (isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 429):
                 retry_after = extract_retry_after(e)
                 delay = retry_after if retry_after else retry_delay * 2
                 logging.warning(f"Rate limit hit. Retrying in {delay} seconds...")
-                await asyncio.sleep(delay)
+                # Pause the shared limiter so every in-flight task backs off, not just this one
+                rate_limiter.block_for(delay)
+                attempt += 1
+                continue
 
         except Exception as e:
             logging.error(f"Unexpected error: {e}")
@@ -119,9 +217,19 @@ async def process_retry_queue():
     retry_queue = []
 
 #retriever and siever for new reference (with classification)
-async def call_retrieve_sieve_with_async(chunk, ref):
-    await initialize_client()
-    return await async_retry_on_exception(retriever_and_siever_async, chunk, ref)
+#answers are cached on disk by content so re-runs and retries of a stage do not re-judge the same pairs
+#the SQLite lookups run in a worker thread so the fan-out does not wait on the disk or the cache lock
+async def call_retrieve_sieve_with_async(chunk, ref, use_cache=True):
+    key = make_cache_key(chunk, ref, retrieve_sieve_prompt, endpoint, retrieve_sieve_model)
+    if use_cache:
+        cached = await asyncio.to_thread(sieve_cache.get, key)
+        if cached is not None:
+            return cached
+    result = await async_retry_on_exception(retriever_and_siever_async, chunk, ref)
+    # Only cache real answers, failed calls return None and should be retried next run
+    if use_cache and result is not None:
+        await asyncio.to_thread(sieve_cache.set, key, result)
+    return result
 
 # #retriever and siever for sanity checking (no classification)
 # async def call_retrieve_sieve_with_async_check(chunk, ref):
@@ -130,7 +238,6 @@ async def call_retrieve_sieve_with_async(chunk, ref):
 
 # Keyword search function
 async def call_keyword_search_async(text, prompt=None):
-    await initialize_client()
     result = await async_retry_on_exception(keyword_search_async, text, prompt)
     return result
 #Get the statements, reference article titles, authors of reference articles and year reference articles released
@@ -140,13 +247,11 @@ async def call_get_ref_async(text,prompt=None):
 
 #agent to regenerate prompt for better keyword generation
 async def call_rewritter_async(prompt):
-    await initialize_client()
     result = await async_retry_on_exception(rewritter, prompt)
     return result
 
 # agent to select best prompt from db for agentic search
 async def call_selector_async(list_of_prompts):
-    await initialize_client()
     result = await async_retry_on_exception(selector, list_of_prompts)
     return result
 
@@ -241,10 +346,9 @@ async def call_format_async(output):
     result=await async_retry_on_exception(format,output)
     return result
 
-# support or oppose included, used to classify the new ref
-# Classification included
-async def retriever_and_siever_async(chunk, ref):
-    pro_w_confidence="""
+# Prompt and deployment for retriever and siever (module level so the sieve cache can hash them)
+retrieve_sieve_model = os.getenv("gpt_deployment", "gpt-4o")
+retrieve_sieve_prompt="""
 
     Compare the ‘Reference Article Text’ (which is a chunk of the reference article) to the ‘Text Referencing The Reference Article’ (which cites the reference article). Identify which parts of the ‘Reference Article Text’ are being cited, referenced, or opposed by the ‘Text Referencing The Reference Article.’ Additionally, assign a confidence score (0-100) to each comparison and place it in brackets next to ‘Support’ or ‘Oppose’ if any part of the text 'Support' or 'Oppose' the ‘Text Referencing The Reference Article’.
 
@@ -303,17 +407,21 @@ async def retriever_and_siever_async(chunk, ref):
 
     Output ONLY the extraction. (the quoted texts after Output: in examples shown).
     """
+
+# support or oppose included, used to classify the new ref
+# Classification included
+async def retriever_and_siever_async(chunk, ref):
     data = {
-        "model": "gpt-4o",
+        "model": retrieve_sieve_model,
         "messages": [
-            {"role": "system", "content": pro_w_confidence},
+            {"role": "system", "content": retrieve_sieve_prompt},
             {"role": "user", "content": f"Reference Article Text: {chunk}, Text Referencing The Reference Article: {ref}"}
         ],
         "temperature": 0
     }
 
     # Make an asynchronous API call using the async client
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content.lower()
 
 #no support or oppose classification (for sanity checking) (depreciated)
@@ -401,7 +509,7 @@ async def keyword_search_async(text, prompt=None):
             ],
             "temperature":0
         }
-        response = await async_client.chat.completions.create(**data)
+        response = await create_chat_completion(data)
         return response.choices[0].message.content.lower()
     else:
         data={
@@ -413,7 +521,7 @@ async def keyword_search_async(text, prompt=None):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content.lower()
 
 
@@ -429,7 +537,7 @@ async def get_references_async(text,prompt=None):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 
@@ -458,7 +566,7 @@ async def rewritter(old_prompt):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 
@@ -490,7 +598,7 @@ async def selector(list_of_prompts):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 
@@ -562,7 +670,7 @@ async def summarizer_scorer(list_of_sieved_chunks,statement,sentiment):
             ],
             "temperature":0
         }
-        response = await async_client.chat.completions.create(**data)
+        response = await create_chat_completion(data)
     else:
         summarizer_prompt_oppose="""
         You are an expert summarizer and evaluator. Your role is to help determine whether a single paper is relevant in opposing the statement
@@ -626,7 +734,7 @@ async def summarizer_scorer(list_of_sieved_chunks,statement,sentiment):
             ],
             "temperature":0
         }
-        response = await async_client.chat.completions.create(**data)
+        response = await create_chat_completion(data)
 
 
     return response.choices[0].message.content
@@ -660,7 +768,7 @@ async def extract_to_edit(file_content):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 async def extract_statement_citation(text, new_statements):
@@ -687,7 +795,7 @@ async def extract_statement_citation(text, new_statements):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 
@@ -742,7 +850,7 @@ async def convert_to_replace(row,text):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 
@@ -772,7 +880,7 @@ async def find_to_edit_statement(text,statement_list):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 
@@ -794,7 +902,7 @@ async def find_reference_list(text):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 
@@ -860,7 +968,7 @@ async def replace_reference_list(reference_list,remove_list,add_list):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     print(response.choices[0].message.content)
     return response.choices[0].message.content
 
@@ -880,7 +988,7 @@ async def citation_extractor(whole_statement):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 
@@ -935,7 +1043,7 @@ async def edit_citationer(row,text):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 
@@ -962,7 +1070,7 @@ async def add_edits(list,text):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 async def check_statement_extraction(output,text):
@@ -1021,7 +1129,7 @@ async def check_statement_extraction(output,text):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 async def edit_mistakes(mistakes):
@@ -1041,7 +1149,7 @@ async def edit_mistakes(mistakes):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 
@@ -1097,7 +1205,7 @@ async def check_only_statement_extraction(output,text):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 async def improve_initial_extraction_prompt(prompt,output,text,failure_reason):
@@ -1158,7 +1266,7 @@ OUTPUT THE IMPROVED PROMPT ONLY
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 
 #make sure list of prompt is a string first
@@ -1188,7 +1296,7 @@ async def selector_initial_extraction(list_of_prompts):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 #extract all satement citation and reference first in any format
 async def pre_check(text):
@@ -1201,7 +1309,7 @@ async def pre_check(text):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 #check if extraction successful
 async def check_pre_check(output,text):
@@ -1218,7 +1326,7 @@ async def check_pre_check(output,text):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
 #format the successful extraction
 async def format(output):
@@ -1233,5 +1341,5 @@ async def format(output):
         ],
         "temperature":0
     }
-    response = await async_client.chat.completions.create(**data)
+    response = await create_chat_completion(data)
     return response.choices[0].message.content
\ No newline at end of file
@@ -17,6 +17,10 @@ import ast
 import re
 from rapidfuzz import fuzz
 from .mongo_client import MongoDBClient
+from .embedding import index_chunks
+from .vector_index import VectorIndex, vector_index_path
+from .records import SieveResult, RecordColumns
+from .pre_retrieval import pre_retrieve, pre_retrieval_recall, pre_retrieval_mode
 
 load_dotenv()
 client = MongoDBClient.get_client()
@@ -29,20 +33,13 @@ async def process_row_async(row, code):
     chunk = row['Text Content']
     ref = code[0]
     
-    await asyncio.sleep(10)
-    # Use the async wrapper to call the GPT service with retry logic
+    # Use the async wrapper to call the GPT service with retry logic (paced by the shared rate limiter)
     ans = await call_retrieve_sieve_with_async(chunk, ref)
 
 
     
     # Create a new row regardless of the answer
-    new_row = pd.DataFrame({
-        'Reference article name': [code[1]],
-        'Reference text in main article': [code[0]],
-        'Sieving by gpt 4o': [ans],
-        'Chunk': [chunk],
-        'Date': [code[2]]
-    })
+    new_row = SieveResult(article_name=code[1], statement=code[0], sieved=ans, chunk=chunk, date=code[2])
     
     # Determine which category the result falls into
     if ans not in ["'no'", "'no.'", "'"+ref.lower()+"'", "no", "no.", '', None]:
@@ -79,86 +76,68 @@ async def process_row_async(row, code):
 #         return 'no', new_row
 
 
-async def retrieve_sieve_async(df, code):
-    """Main function to run the parallelized process using asyncio and the async OpenAI client."""
-    valid_dfs = []
-    non_valid_dfs = []  # Initialize the non-valid list
-    no_dfs = []
-
-    # Process each row asynchronously using the process_row_async function
-    # Define a semaphore to limit the number of concurrent tasks (added because VPN cause my tasks to throttle, you can try to remove from this line onwards to)
-    semaphore = asyncio.Semaphore(20)  # Adjust the number as needed
-
-    async def process_row_with_semaphore(row):
-        """Wrapper function to use semaphore for each task."""
-        async with semaphore:
-            return await process_row_async(row, code)
-    # Create tasks with semaphore-wrapped function
-    tasks = [process_row_with_semaphore(row) for _, row in df.iterrows()]
-    #this line then replace with
-    #tasks = [process_row_async(row) for _, row in df.iterrows()]
-    #for quicker times (for context, without the vpn a 8 hours task takes 2 hours)
-    
-    # Use tqdm_asyncio to track progress of async tasks
-    for result_type, new_row in await tqdm_asyncio.gather(*tasks, desc='Processing rows in parallel'):
-        if result_type == 'valid':
-            valid_dfs.append(new_row)
-        elif result_type == 'no':
-            no_dfs.append(new_row)
-        else:
-            non_valid_dfs.append(new_row)  # Collect non-valid rows if the result is not 'valid' or 'no'
-    
-    # Concatenate valid rows
-    valid_output_df = pd.concat(valid_dfs, ignore_index=True) if valid_dfs else pd.DataFrame()
-
-    # Concatenate non-valid rows if no valid chunks found
-    non_valid_output_df = pd.concat(non_valid_dfs, ignore_index=True) if non_valid_dfs else pd.DataFrame()
-
-    # Concatenate no rows
-    no_df = pd.concat(no_dfs, ignore_index=True) if no_dfs else pd.DataFrame()
+async def retrieve_sieve_many_async(jobs, embedding_backend=None):
+    """
+    Run retrieval and sieving for many (paper chunks, statement) pairs on one event loop.
+    Chunk-level tasks of every pair share one concurrency budget, so the quota stays saturated
+    instead of idling between papers.
 
-    return valid_output_df, non_valid_output_df, no_df
+    Args:
+        jobs (list): List of (df, code) tuples where df holds the chunks of one paper and code is [text, name, year].
+        embedding_backend (str): Encoder the chunk embeddings were made with, used by the pre-retrieval to embed statements.
 
+    Returns:
+        tuple: valid, non valid and no RecordColumns of SieveResult (to_records gives the Mongo batch).
+    """
+    # Results are collected column by column, the DataFrame or Mongo batch is built once at the end
+    valid_rows = RecordColumns(SieveResult)
+    non_valid_rows = RecordColumns(SieveResult)  # Initialize the non-valid rows
+    no_rows = RecordColumns(SieveResult)
 
-async def retrieve_sieve_async_check(df, code):
-    """Main function to run the parallelized process using asyncio and the async OpenAI client."""
-    valid_dfs = []
-    non_valid_dfs = []  # Initialize the non-valid list
-    no_dfs = []
+    # One client for the whole stage
+    await initialize_client()
 
-    # Process each row asynchronously using the process_row_async function
-    # Define a semaphore to limit the number of concurrent tasks (added because VPN cause my tasks to throttle, you can try to remove from this line onwards to)
-    semaphore = asyncio.Semaphore(20)  # Adjust the number as needed
+    # Semaphore only caps in-flight requests, the pace is set by the shared rate limiter in gpt_rag_asyncio
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
 
-    async def process_row_with_semaphore(row):
+    async def process_row_with_semaphore(row, code):
         """Wrapper function to use semaphore for each task."""
         async with semaphore:
             return await process_row_async(row, code)
-    # Create tasks with semaphore-wrapped function
-    tasks = [process_row_with_semaphore(row) for _, row in df.iterrows()]
-    #this line then replace with
-    #tasks = [process_row_async(row) for _, row in df.iterrows()]
-    #for quicker times (for context, without the vpn a 8 hours task takes 2 hours)
+    # Optional pre-retrieval: only the best scoring chunks of every pair are sieved (see pre_retrieval.py)
+    selected = await asyncio.to_thread(pre_retrieve, jobs, backend=embedding_backend)
+
+    # Create tasks with semaphore-wrapped function for every chunk of every pair
+    tasks = []
+    audited = []  # (task, forwarded) of the chunks of pairs sieved in full to measure recall
+    for df, code, forwarded in selected:
+        for position, (_, row) in enumerate(df.iterrows()):
+            if forwarded is not None:
+                audited.append((len(tasks), bool(forwarded[position])))
+            tasks.append(process_row_with_semaphore(row, code))
     
     # Use tqdm_asyncio to track progress of async tasks
-    for result_type, new_row in await tqdm_asyncio.gather(*tasks, desc='Processing rows in parallel'):
+    results = await tqdm_asyncio.gather(*tasks, desc='Retrieving and Sieving with an agent')
+    pre_retrieval_recall([(forwarded, results[task][0] == 'valid') for task, forwarded in audited])
+    for result_type, new_row in results:
         if result_type == 'valid':
-            valid_dfs.append(new_row)
+            valid_rows.append(new_row)
         elif result_type == 'no':
-            no_dfs.append(new_row)
+            no_rows.append(new_row)
         else:
-            non_valid_dfs.append(new_row)  # Collect non-valid rows if the result is not 'valid' or 'no'
+            non_valid_rows.append(new_row)  # Collect non-valid rows if the result is not 'valid' or 'no'
     
-    # Concatenate valid rows
-    valid_output_df = pd.concat(valid_dfs, ignore_index=True) if valid_dfs else pd.DataFrame()
+    return valid_rows, non_valid_rows, no_rows
 
-    # Concatenate non-valid rows if no valid chunks found
-    non_valid_output_df = pd.concat(non_valid_dfs, ignore_index=True) if non_valid_dfs else pd.DataFrame()
 
-    # Concatenate no rows
-    no_df = pd.concat(no_dfs, ignore_index=True) if no_dfs else pd.DataFrame()
+async def retrieve_sieve_async(df, code):
+    """Main function to run the parallelized process using asyncio and the async OpenAI client."""
+    return tuple(rows.to_dataframe() for rows in await retrieve_sieve_many_async([(df, code)]))
+
 
-    return valid_output_df, non_valid_output_df, no_df
+async def retrieve_sieve_async_check(df, code):
+    """Main function to run the parallelized process using asyncio and the async OpenAI client."""
+    return tuple(rows.to_dataframe() for rows in await retrieve_sieve_many_async([(df, code)]))
 
 def retrieve_sieve(df, code):
     """Synchronous wrapper function for calling async operations."""
@@ -176,40 +155,58 @@ def retrieve_sieve_check(df, code):
         print(f"An error occurred: {e}")
         # Handle exceptions or re-raise
 
+def retrieve_sieve_many(jobs, embedding_backend=None):
+    """Synchronous wrapper that runs every (paper, statement) pair of a stage on a single event loop."""
+    try:
+        return asyncio.run(retrieve_sieve_many_async(jobs, embedding_backend))
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        raise
+
+
 
+#helper function: the chunk embeddings are only read when the pre-retrieval compares them
+def pre_retrieval_fields():
+    return {'embed_v3': 1} if pre_retrieval_mode in ('embedding', 'hybrid') else {}
+
+#helper function: the chunks of the cited papers, streamed from the chunk collection without holding the rest of it
+def read_cited_chunks(collection_processed_name, names, projection, rename=None):
+    """
+    Args:
+        names (list): Paper names cited by the statements, matched like retrieve_pdf (normalize_string).
+        projection (dict): Fields to read.
+        rename (callable): Applied to every batch before matching (e.g. paper ids to titles).
+    """
+    wanted = {normalize_string(str(name)) for name in names}
+
+    def cited(batch):
+        # A batch whose documents all lack the field cannot hold a cited chunk
+        if 'PDF File' not in batch:
+            return pd.Series(False, index=batch.index)
+        if rename is not None:
+            batch['PDF File'] = rename(batch)['PDF File']
+        return batch['PDF File'].astype(str).map(normalize_string).isin(wanted)
+
+    return read_filtered_dataframe(uri, db.name, collection_processed_name, cited, projection)
+
+#helper function: encoder of the chunk embeddings of a collection, statements are embedded with it by the pre-retrieval
+def pre_retrieval_backend(collection_processed_name):
+    if pre_retrieval_mode not in ('embedding', 'hybrid'):
+        return None
+    return get_embedding_backend(uri, db.name, collection_processed_name)
 
 # Sanity checking existing references by performing RAG w GPT 4o as the retriever on uploaded, existing references
 def retrieve_sieve_references(collection_processed_name, valid_collection_name, invalid_collection_name):
     try:
         output_directory = 'backend'  # Fixed output directory
         
-        # Get collections from MongoDB
-        collection_processed = db[collection_processed_name]
-
-        # Fetch documents from MongoDB
-        documents = list(collection_processed.find({}, {
-            '_id': 1, 'PDF File': 1, 'Text Content': 1, 'n_tokens': 1, 'Text Chunks': 1
-        }))
-        
-        if not documents:
-            print("No documents found in MongoDB.")
-            return
-        
-        df = pd.DataFrame(documents)
-        codable_collection = db['collated_statements_and_citations']
-        codable_df = list(
-            codable_collection.find(
-                {},  # No filter, retrieve all documents
-                {
-                    '_id': 1,
-                    'Reference article name': 1,
-                    'Reference text in main article': 1,
-                    'Date': 1,
-                    'Name of authors': 1
-                }
-            )
-        )
-        codable_df = pd.DataFrame(codable_df, columns=[
+        codable_df = read_dataframe(uri, db.name, 'collated_statements_and_citations', {
+            '_id': 0,
+            'Reference article name': 1,
+            'Reference text in main article': 1,
+            'Date': 1,
+            'Name of authors': 1
+        }).reindex(columns=[
             'Reference text in main article',
             'Reference article name',
             'Date',
@@ -217,48 +214,42 @@ def retrieve_sieve_references(collection_processed_name, valid_collection_name,
         ])
         
         codable = codable_df.values.tolist()
+
+        # Fetch the chunks of the cited papers only (streamed, only the fields the sieve needs)
+        df = read_cited_chunks(collection_processed_name, [code[1] for code in codable], {
+            '_id': 1, 'PDF File': 1, 'Text Content': 1, 'n_tokens': 1, 'Text Chunks': 1, **pre_retrieval_fields()
+        })
+        
+        if df.empty:
+            print("No documents found in MongoDB.")
+            return
         
         # Remove duplicates and check retractions/corrections
         unique_dict = {item[1]: item for item in codable}
         unique_list = list(unique_dict.values())
         df_extract_retract = df_check(unique_list)
         
-        valid_dfs = []
-        non_valid_dfs = []
-        not_dfs = []
-
-        # Already using tqdm for the loop
-        for code in tqdm(codable, desc="Retrieving and Sieving with an agent"):
+        # Pair every statement with the chunks of its paper, then sieve all pairs on one event loop
+        jobs = []
+        for code in codable:
             pdf = retrieve_pdf(df, code)
             if pdf.empty:
                 print(f"No PDF found for code: {code}")
                 continue
+            jobs.append((pdf, code))
 
-            # Retrieve and sieve
-            valid, non_valid, no_df = retrieve_sieve_check(pdf, code)
-
-            if not valid.empty:
-                valid_dfs.append(valid)
-            if not non_valid.empty:
-                non_valid_dfs.append(non_valid)
-            if not no_df.empty:
-                not_dfs.append(no_df)
+        valid_rows, non_valid_rows, no_rows = retrieve_sieve_many(jobs, pre_retrieval_backend(collection_processed_name))
 
         # Concatenate non-valid results
-        if non_valid_dfs:
-            non_valid_output_df = pd.concat(non_valid_dfs, ignore_index=True)
+        if len(non_valid_rows):
             non_valid = invalid_collection_name + '.xlsx'
-            records = non_valid_output_df.to_dict(orient='records')
+            records = non_valid_rows.to_records()
             replace_database_collection(uri, db.name, invalid_collection_name, records)
 
-        if not_dfs:
-            not_df = pd.concat(not_dfs, ignore_index=True)
-
         # Send valid results to MongoDB
-        if valid_dfs:
-            valid_output_df = pd.concat(valid_dfs, ignore_index=True)
+        if len(valid_rows):
             valid = valid_collection_name + '.xlsx'
-            records = valid_output_df.to_dict(orient='records')
+            records = valid_rows.to_records()
             replace_database_collection(uri, db.name, valid_collection_name, records)
 
         print("Process completed and data sent to MongoDB.")
@@ -278,25 +269,7 @@ def retrieve_sieve_references_new(
     change_to_add=False
 ):
     try:
-        # Get collections from MongoDB
-        collection_processed = db[collection_processed_name]
-        collection_f = db[new_ref_collection]
-
-        # Fetch documents from MongoDB
-        documents1 = list(collection_processed.find({}, {
-            '_id': 1,
-            'PDF File': 1,
-            'Text Content': 1,
-            'n_tokens': 1,
-            'Text Chunks': 1
-        }))
-        if not documents1:
-            print(f"No documents found in '{collection_processed_name}'. Skipping further processing.")
-            return  # Exit the function early
-
-        df = pd.DataFrame(documents1)
-
-        documents2 = list(collection_f.find({}, {
+        df_found = read_dataframe(uri, db.name, new_ref_collection, {
             '_id': 1,
             'Title of original reference article': 1,
             'Text in main article referencing reference article': 1,
@@ -310,10 +283,9 @@ def retrieve_sieve_references_new(
             'externalId_of_undownloadable_paper': 1,
             'reason_for_failure': 1,
             'pdf_url': 1
-        }))
-
-        df_found = pd.DataFrame(documents2)
-        df = replace_pdf_file_with_title(df, df_found)
+        })
+        # Chunks are stored under the paper id, they are renamed to the title they are cited under
+        id_to_title = df_found[['Paper Id of new reference article found', 'Title of new reference article found']]
         df_found = update_downloadable_status_invalid(df_found)
         df_found = df_found[df_found['downloadable'] != 'no']
         df_found = df_found[df_found['Paper Id of new reference article found'] != '']
@@ -325,64 +297,61 @@ def retrieve_sieve_references_new(
             year = row['Year new reference article found published']
             codable.append([text, title, year])
 
-        valid_dfs = []
-        non_valid_dfs = []
-        not_dfs = []
+        # Fetch the chunks of the cited papers only (streamed, only the fields the sieve needs)
+        df = read_cited_chunks(collection_processed_name, [code[1] for code in codable], {
+            '_id': 1,
+            'PDF File': 1,
+            'Text Content': 1,
+            'n_tokens': 1,
+            'Text Chunks': 1,
+            **pre_retrieval_fields()
+        }, rename=lambda batch: replace_pdf_file_with_title(batch, id_to_title))
+        if df.empty:
+            print(f"No documents found in '{collection_processed_name}'. Skipping further processing.")
+            return  # Exit the function early
 
-        # Use tqdm for the loop
-        for code in tqdm(codable, desc="Retrieving and Sieving with an agent"):
+        # Pair every statement with the chunks of its paper, then sieve all pairs on one event loop
+        jobs = []
+        for code in codable:
             pdf = retrieve_pdf(df, code)
             if pdf.empty:
                 print(f"No PDF found for code: {code}")
                 continue
+            jobs.append((pdf, code))
 
-            # Retrieve and sieve
-            valid, non_valid, no_df = retrieve_sieve(pdf, code)
-
-            if not valid.empty:
-                valid_dfs.append(valid)
-            if not non_valid.empty:
-                non_valid_dfs.append(non_valid)
-            if not no_df.empty:
-                not_dfs.append(no_df)
+        valid_rows, non_valid_rows, no_rows = retrieve_sieve_many(jobs, pre_retrieval_backend(collection_processed_name))
 
         if change_to_add:
             # Insert logic
-            if non_valid_dfs:
-                non_valid_output_df = pd.concat(non_valid_dfs, ignore_index=True)
+            if len(non_valid_rows):
                 non_valid = invalid_collection_name + '.xlsx'
-                records = non_valid_output_df.to_dict(orient='records')
+                records = non_valid_rows.to_records()
                 insert_documents(uri, db.name, invalid_collection_name, records)
 
-            if not_dfs:
-                not_df = pd.concat(not_dfs, ignore_index=True)
+            if len(no_rows):
                 reject = not_match + '.xlsx'
-                records = not_df.to_dict(orient='records')
+                records = no_rows.to_records()
                 insert_documents(uri, db.name, not_match, records)
 
-            if valid_dfs:
-                valid_output_df = pd.concat(valid_dfs, ignore_index=True)
+            if len(valid_rows):
                 valid = valid_collection_name + '.xlsx'
-                records = valid_output_df.to_dict(orient='records')
+                records = valid_rows.to_records()
                 insert_documents(uri, db.name, valid_collection_name, records)
         else:
             # Replace logic
-            if non_valid_dfs:
-                non_valid_output_df = pd.concat(non_valid_dfs, ignore_index=True)
+            if len(non_valid_rows):
                 non_valid = invalid_collection_name + '.xlsx'
-                records = non_valid_output_df.to_dict(orient='records')
+                records = non_valid_rows.to_records()
                 replace_database_collection(uri, db.name, invalid_collection_name, records)
 
-            if not_dfs:
-                not_df = pd.concat(not_dfs, ignore_index=True)
+            if len(no_rows):
                 reject = not_match + '.xlsx'
-                records = not_df.to_dict(orient='records')
+                records = no_rows.to_records()
                 replace_database_collection(uri, db.name, not_match, records)
 
-            if valid_dfs:
-                valid_output_df = pd.concat(valid_dfs, ignore_index=True)
+            if len(valid_rows):
                 valid = valid_collection_name + '.xlsx'
-                records = valid_output_df.to_dict(orient='records')
+                records = valid_rows.to_records()
                 replace_database_collection(uri, db.name, valid_collection_name, records)
 
         print("Process completed and data sent to MongoDB.")
@@ -392,209 +361,216 @@ def retrieve_sieve_references_new(
         tqdm._instances.clear()
 
 
-# Function to extract valid classifications and scores
-def extract_classification(text):
-    if not isinstance(text, str) or not text.strip():
-        return None  # Handle None or empty inputs
-
-    # Improved regex to handle multiple spaces/newlines
-    pattern = r"\s*(support|oppose)\s*\((\d+)\):\s*(.*?)\s*(?=\s*support|\s*oppose|\Z)"
-    matches = re.findall(pattern, text, re.DOTALL | re.IGNORECASE)
-
-    if matches:
-        # Create a DataFrame with each match as a separate row
-        rows = [
-            {
-                'Sentiment': match[0], 
-                'Confidence Score': int(match[1]), 
-                'Sieving by gpt 4o': match[2].strip()
-            }
-            for match in matches
-        ]
-        return pd.DataFrame(rows)
-    else:
-        return None  # No valid matches found
-
+# Classifications in a sieve output, e.g. "support (85): <quoted text> oppose (60): <quoted text>"
+# (improved regex to handle multiple spaces/newlines)
+classification_pattern = re.compile(r"\s*(support|oppose)\s*\((\d+)\):\s*(.*?)\s*(?=\s*support|\s*oppose|\Z)", re.DOTALL | re.IGNORECASE)
+sieved_fields = ['Reference article name', 'Reference text in main article', 'Sieving by gpt 4o', 'Chunk', 'Date']
 
-def top_5_or_all_top_scores(group, threshold):
+# Function to extract valid classifications and scores of every row at once
+def extract_classifications(df):
     """
-    Returns all rows with the top score if more than 5 rows have the top score 
-    and all scores are above the threshold. Otherwise, returns up to 5 rows 
-    where all scores are above the threshold.
+    Args:
+        df (pd.DataFrame): Sieve outputs with the sieved_fields columns.
+
+    Returns:
+        tuple: (one row per classification, rows without a valid classification).
     """
-    # Sort the group by 'Confidence Score' in descending order
-    sorted_group = group.sort_values(by='Confidence Score', ascending=False)
-    # Filter rows where 'Confidence Score' is above the threshold
-    filtered_group = sorted_group[sorted_group['Confidence Score'] >= threshold]
-    
-    if filtered_group.empty:
-        # If no rows meet the threshold, return an empty DataFrame
-        return filtered_group
-    
-    # Get the top score from the filtered group
-    top_score = filtered_group['Confidence Score'].iloc[0]
-    # Check how many rows have the top score
-    top_score_count = (filtered_group['Confidence Score'] == top_score).sum()
-    
-    if top_score_count > 5:
-        # If more than 5 rows have the top score, return all rows with that top score
-        return filtered_group[filtered_group['Confidence Score'] == top_score]
-    else:
-        # Otherwise, return all rows up to the top 5 that are above the threshold
-        return filtered_group.head(5)
+    # Non-string outputs are read as empty and never match
+    texts = df['Sieving by gpt 4o'].where(df['Sieving by gpt 4o'].map(lambda text: isinstance(text, str)), '').astype(object)
+    matches = texts.str.extractall(classification_pattern)
+    rows = matches.index.get_level_values(0)
+
+    valid_df = pd.DataFrame({
+        'Sentiment': matches[0].to_numpy(),
+        'Confidence Score': matches[1].astype(int).to_numpy(),
+        # An empty classification text is NaN after extractall, the per-row parser read it as ''
+        'Sieving by gpt 4o': matches[2].fillna('').str.strip().to_numpy(),
+    })
+    source = df.loc[rows]
+    for column in ['Reference article name', 'Reference text in main article', 'Chunk']:
+        valid_df[column] = source[column].to_numpy()
+    # One hash per sieved chunk, shared by its classifications
+    hashes = df.loc[rows.unique(), 'Chunk'].map(chunk_hash)
+    valid_df['Chunk hash'] = hashes.loc[rows].to_numpy()
+    valid_df['Sieved hash'] = valid_df['Sieving by gpt 4o'].map(chunk_hash)
+    valid_df['Date'] = source['Date'].to_numpy()
 
-#get top score of each grp and check if below threshold
+    invalid_df = df[~df.index.isin(rows)]
+    return valid_df, invalid_df
 
-#check if that particular statement's new ref article none of chunks meet threshold OR all chunks are negative
-def check_for_retry(group, threshold):
-    # Check if all sentiments are negative
-    all_negative_sentiment = (group['Sentiment'] == 'negative').all()
-
-    # Check if the group contains positive sentiments
-    has_positive_sentiment = (group['Sentiment'] == 'positive').any()
-
-    # Initialize flag to decide whether to retry
-    should_retry = False
-
-    # Condition 1: For groups with positive sentiments, check if max score < threshold
-    if has_positive_sentiment:
-        # Filter positive sentiments within the group
-        positive_group = group[group['Sentiment'] == 'positive']
-        max_score = positive_group['Confidence Score'].max()
-        if max_score < threshold:
-            should_retry = True
-
-    # Condition 2: If all sentiments are negative
-    if all_negative_sentiment:
-        should_retry = True
-
-    if should_retry:
-        return group
-    else:
-        return pd.DataFrame()
 
+# Groups of the sieve outputs: rows are ranked within a (reference article, statement, sentiment) group and
+# retried per (reference article, statement). Both run on the server ($setWindowFields needs MongoDB 5.0+)
+sieve_statement_partition = {'article': '$Reference article name', 'statement': '$Reference text in main article'}
+sieve_sentiment_partition = dict(sieve_statement_partition, sentiment='$Sentiment')
 
+def top_5_stages(threshold):
+    """
+    Aggregation stages keeping, in every (article, statement, sentiment) group, the rows with a
+    'Confidence Score' above the threshold: all rows with the top score if more than 5 rows have it,
+    otherwise up to 5 rows, best first.
+    """
+    return [
+        {'$match': {'Confidence Score': {'$gte': threshold}}},
+        {'$setWindowFields': {
+            'partitionBy': sieve_sentiment_partition,
+            'sortBy': {'Confidence Score': -1},
+            'output': {'score_rank': {'$rank': {}}, 'score_position': {'$documentNumber': {}}},
+        }},
+        # Number of rows sharing the top score of the group
+        {'$setWindowFields': {
+            'partitionBy': sieve_sentiment_partition,
+            'output': {'top_score_count': {'$sum': {'$cond': [{'$eq': ['$score_rank', 1]}, 1, 0]}}},
+        }},
+        {'$match': {'$expr': {'$cond': [
+            {'$gt': ['$top_score_count', 5]},
+            {'$eq': ['$score_rank', 1]},
+            {'$lte': ['$score_position', 5]},
+        ]}}},
+        {'$unset': ['score_rank', 'score_position', 'top_score_count']},
+    ]
 
+#check if that particular statement's new ref article none of chunks meet threshold OR all chunks are negative
+def retry_flag_stages(threshold):
+    """
+    Aggregation stages setting 'retry' on every row of an (article, statement) group whose sentiments are all
+    negative, or whose best positive score is below the threshold.
+    """
+    return [
+        {'$setWindowFields': {
+            'partitionBy': sieve_statement_partition,
+            'output': {
+                'group_rows': {'$sum': 1},
+                'group_negatives': {'$sum': {'$cond': [{'$eq': ['$Sentiment', 'negative']}, 1, 0]}},
+                # $max skips the nulls of the other sentiments, so it stays null without positive rows
+                'group_best_positive': {'$max': {'$cond': [{'$eq': ['$Sentiment', 'positive']}, '$Confidence Score', None]}},
+            },
+        }},
+        {'$set': {'retry': {'$or': [
+            {'$eq': ['$group_negatives', '$group_rows']},
+            {'$and': [{'$ne': ['$group_best_positive', None]}, {'$lt': ['$group_best_positive', threshold]}]},
+        ]}}},
+        {'$unset': ['group_rows', 'group_negatives', 'group_best_positive']},
+    ]
 
 
 #to remove hallucination of model outputing the statement
-def contains_reference_text(row):
-    pattern = re.compile(re.escape(row['Reference text in main article']), re.IGNORECASE)
-    return bool(pattern.search(row['Sieving by gpt 4o']))
+def contains_reference_text(df):
+    """
+    Returns a boolean Series, True where the classification text quotes the statement (case-insensitive).
+    """
+    statements = df['Reference text in main article'].fillna('').astype(str).str.casefold()
+    texts = df['Sieving by gpt 4o'].fillna('').astype(str).str.casefold()
+    return pd.Series([statement in text for statement, text in zip(statements, texts)], index=df.index, dtype=bool)
 
 
-def cleaning(valid_collection_name, not_match, top_5, threshold=75, change_to_add=False):
-    # Fetch documents from the collection
-    collection_valid = db[valid_collection_name]
-    documents = list(
-        collection_valid.find(
-            {}, 
-            {
-                'Reference article name': 1, 
-                'Reference text in main article': 1, 
-                'Sieving by gpt 4o': 1, 
-                'Chunk': 1, 
-                'Date': 1
-            }
-        )
-    )
-
-    # Convert documents to a DataFrame
-    df = pd.DataFrame(documents)
-    print(df.columns)
-
-    # Initialize lists for valid and invalid rows
-    valid_rows = []
-    invalid_rows = []
+#parse the raw sieve outputs of a collection batch by batch into one row per classification
+def parse_sieved_collection(valid_collection_name, parsed_collection_name, unmatched_collection_name, keep_matches=False):
+    """
+    Streams the sieve outputs of valid_collection_name, writes the parsed rows to parsed_collection_name and the rows
+    without a classification (and the hallucinated ones) to unmatched_collection_name. Memory stays bounded by one read batch.
 
-    
+    Args:
+        keep_matches (bool): Also keep the rows quoting the statement in the parsed rows.
 
-    # Iterate through rows and classify them
-    for idx, row in df.iterrows():
-        extracted_df = extract_classification(row['Sieving by gpt 4o'])
-
-        if extracted_df is not None:
-            # Add additional columns to the valid DataFrame
-            extracted_df['Reference article name'] = row['Reference article name']
-            extracted_df['Reference text in main article'] = row['Reference text in main article']
-            extracted_df['Chunk'] = row['Chunk']
-            extracted_df['Date'] = row['Date']
-            valid_rows.append(extracted_df)
+    Returns:
+        int: Number of parsed rows written.
+    """
+    parsed = db[parsed_collection_name]
+    unmatched = db[unmatched_collection_name]
+    count = 0
+    for df in stream_dataframes(uri, db.name, valid_collection_name, {field: 1 for field in sieved_fields}):
+        # Fields missing from every document of the batch are read as empty
+        df = df.reindex(columns=['_id'] + sieved_fields)
+        valid_df, invalid_df = extract_classifications(df)
+        matches_df = pd.DataFrame()
+
+        if not valid_df.empty:
+            # Identify rows where reference text is found within the content and remove them (hallucinations)
+            is_match = contains_reference_text(valid_df)
+            matches_df = valid_df[is_match]
+            if not keep_matches:
+                valid_df = valid_df[~is_match]
+            count += insert_in_batches(parsed, valid_df.to_dict(orient='records'))
+
+        # Combine invalid rows and matches into one DataFrame, they get new ids in not_match
+        invalid_df = pd.concat([invalid_df.drop(columns=['_id']), matches_df], ignore_index=True)
+        if not invalid_df.empty:
+            insert_in_batches(unmatched, invalid_df.to_dict(orient='records'))
+    return count
+
+#rank the parsed rows on the server into the top 5 (and retry) collections, then make them the valid collection
+def rank_sieved_collection(valid_collection_name, not_match, top_5, threshold=75, change_to_add=False, retry_collection_name=None, keep_matches=False):
+    """
+    Every output is prepared in a staging collection and published only once the ranking has succeeded,
+    so a failed run leaves nothing behind and can simply be run again.
+
+    Args:
+        valid_collection_name (str): Collection of raw sieve outputs, replaced by (or upserted with) the parsed rows.
+        not_match (str): Collection receiving the rows without a classification and the hallucinated ones.
+        top_5 (str): Collection receiving the top ranked rows of every group.
+        threshold (int): Minimum confidence score.
+        change_to_add (bool): Upsert into the valid and top 5 collections instead of replacing them.
+        retry_collection_name (str): Collection receiving the groups to retry, no retry check if None.
+        keep_matches (bool): Rank the hallucinated rows as well.
+    """
+    # The parsed rows go to a staging collection of the valid collection: the ranking pipelines read it,
+    # and it replaces the valid collection at the end
+    parsed_name = start_collection_replace(uri, db.name, valid_collection_name)
+    unmatched_name = start_collection_replace(uri, db.name, not_match)
+    retry_name = start_collection_replace(uri, db.name, retry_collection_name) if retry_collection_name is not None else None
+    stagings = [name for name in (parsed_name, unmatched_name, retry_name) if name is not None]
+    try:
+        count = parse_sieved_collection(valid_collection_name, parsed_name, unmatched_name, keep_matches)
+        if count:
+            parsed = db[parsed_name]
+            if retry_name is not None:
+                # Flag the groups to retry in place, only '_id' and the flag travel through $merge
+                parsed.aggregate(retry_flag_stages(threshold) + [
+                    {'$project': {'retry': 1}},
+                    {'$merge': {'into': parsed_name, 'on': '_id', 'whenMatched': 'merge', 'whenNotMatched': 'discard'}},
+                ], allowDiskUse=True)
+                parsed.aggregate([
+                    {'$match': {'retry': True}},
+                    {'$unset': 'retry'},
+                    {'$merge': {'into': retry_name, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}},
+                ], allowDiskUse=True)
+                # Remove rows belonging to the retry groups to get the final valid rows
+                parsed.delete_many({'retry': True})
+                parsed.update_many({}, {'$unset': {'retry': ''}})
+
+            aggregate_into_collection(uri, db.name, parsed_name, top_5_stages(threshold), top_5, replace=not change_to_add)
+            if change_to_add:
+                aggregate_into_collection(uri, db.name, parsed_name, [], valid_collection_name, replace=False)
+    except Exception:
+        for name in stagings:
+            abort_collection_replace(uri, db.name, name)
+        raise
+
+    if count == 0:
+        # If nothing was parsed, skip filtering and retry logic
+        print("No valid rows found. Skipping filtering and retry logic.")
+        abort_collection_replace(uri, db.name, parsed_name)
+    elif change_to_add:
+        abort_collection_replace(uri, db.name, parsed_name)
+    else:
+        count = db[parsed_name].count_documents({})
+        finish_collection_replace(uri, db.name, parsed_name, valid_collection_name)
+        print(f"Replaced collection {valid_collection_name} with {count} records.")
+
+    if retry_name is not None:
+        # The previous retry collection is kept if there is nothing to retry
+        if db[retry_name].count_documents({}):
+            finish_collection_replace(uri, db.name, retry_name, retry_collection_name)
         else:
-            # Store invalid rows if no valid classification is found
-            invalid_rows.append(row)
+            abort_collection_replace(uri, db.name, retry_name)
+    # Rows without a classification are appended to not_match last
+    merge_collection(uri, db.name, unmatched_name, not_match)
+    abort_collection_replace(uri, db.name, unmatched_name)
 
-    # Combine valid rows into a DataFrame
-    valid_df = pd.concat(valid_rows, ignore_index=True) if valid_rows else pd.DataFrame()
+def cleaning(valid_collection_name, not_match, top_5, threshold=75, change_to_add=False):
+    rank_sieved_collection(valid_collection_name, not_match, top_5, threshold, change_to_add, retry_collection_name='retry')
 
-    # If valid_df is empty, skip filtering and retry logic
-    if valid_df.empty:
-        print("No valid rows found. Skipping filtering and retry logic.")
-        # Export invalid data if required
-        invalid_df = pd.concat([pd.DataFrame(invalid_rows)], ignore_index=True)
-        records3 = invalid_df.to_dict(orient='records')
-        insert_documents(uri, db.name, not_match, records3)
-        return  # Exit the function early as there's no valid data to process further
-
-    # Identify rows where reference text is found within the content and remove them (hallucinations)
-    matches_df = valid_df[valid_df.apply(contains_reference_text, axis=1)]
-    filtered_df = valid_df[~valid_df.apply(contains_reference_text, axis=1)]
-
-    # Apply the modified check_for_retry function without initial sentiment filtering
-    retry_df = (
-        filtered_df
-        .groupby(
-            ['Reference article name', 'Reference text in main article'], as_index=False
-        )
-        .apply(check_for_retry, threshold=threshold)
-        .reset_index(drop=True)
-    )
-
-    # Remove rows belonging to retry_df from filtered_df to get the final valid_df
-    if not retry_df.empty:
-        common_columns = filtered_df.columns.intersection(retry_df.columns).tolist()
-        valid_df = filtered_df.merge(
-            retry_df[common_columns], 
-            how='outer', 
-            indicator=True
-        ).query('_merge == "left_only"').drop('_merge', axis=1)
-    else:
-        valid_df = filtered_df.copy()
-
-    # Group the remaining valid rows and apply the top 5 or all top scores logic
-    top_ranked_with_ties_df = (
-        valid_df.groupby(
-            ['Reference article name', 'Reference text in main article', 'Sentiment'], as_index=False
-        ).apply(top_5_or_all_top_scores, threshold=threshold).reset_index(drop=True)
-    )
-
-    if change_to_add:
-        # Send top-ranked output to an Excel file
-        xlsx = top_5 + '.xlsx'
-        records1 = top_ranked_with_ties_df.to_dict(orient='records')
-        upsert_database_and_collection(uri, db.name, top_5, records1)
-        valid_xlsx = valid_collection_name + '.xlsx'
-        records2 = valid_df.to_dict(orient='records')
-        upsert_database_and_collection(uri, db.name, valid_collection_name, records2)
-    else:
-        # Send top-ranked output to an Excel file
-        xlsx = top_5 + '.xlsx'
-        records1 = top_ranked_with_ties_df.to_dict(orient='records')
-        replace_database_collection(uri, db.name, top_5, records1)
-        valid_xlsx = valid_collection_name + '.xlsx'
-        records2 = valid_df.to_dict(orient='records')
-        replace_database_collection(uri, db.name, valid_collection_name, records2)
-
-    # Combine invalid rows and matches into one DataFrame
-    invalid_df = pd.concat([pd.DataFrame(invalid_rows), matches_df], ignore_index=True)
-    invalid_xlsx = not_match + '.xlsx'
-    records3 = invalid_df.to_dict(orient='records')
-    insert_documents(uri, db.name, not_match, records3)
-
-    # If retry_df is not empty, save it
-    if not retry_df.empty:
-        records4 = retry_df.to_dict(orient='records')
-        replace_database_collection(uri, db.name, 'retry', records4)
 
 #add new data found from agentic RAG to DB of data (respectively)
 def add_to_existing(collection_processed_name_new, collection_processed_name_original,
@@ -603,91 +579,56 @@ def add_to_existing(collection_processed_name_new, collection_processed_name_ori
                     invalid_collection_name_new, invalid_collection_name_original,
                     not_match_new, not_match_original,
                     top_5_new,top_5_original):
-    collection_processed = db[collection_processed_name_new]
-    collection_f = db[new_ref_collection_new]
-    collection_valid = db[valid_collection_name_new]
-    collection_invalid = db[invalid_collection_name_new]
-    collection_notmatch = db[not_match_new]
-    collection_top5=db[top_5_new]
-    
-    # Fetch documents from MongoDB
-    # Fetch documents from MongoDB
-    documents1 = list(collection_processed.find({}, {
-        '_id': 1, 'PDF File': 1, 'Text Content': 1, 'n_tokens': 1, 'Text Chunks': 1
-    }))
-    documents2 = list(collection_f.find({}, {
-        '_id': 1,
-        'Title of original reference article': 1,
-        'Text in main article referencing reference article': 1,
-        'Year reference article released': 1,
-        'Keywords for graph paper search': 1,
-        'Paper Id of new reference article found': 1,
-        'Title of new reference article found': 1,
-        'Year new reference article found published': 1,
-        'authors':1,
-        'downloadable': 1,
-        'externalId_of_undownloadable_paper': 1,
-        'reason_for_failure': 1,
-        'pdf_url': 1
-    }))
-    documents3 = list(collection_valid.find({}, {
-        '_id': 1,
-        'Sentiment':1,
-        'Confidence Score':1,
-        'Sieving by gpt 4o': 1,
-        'Reference article name': 1,
-        'Reference text in main article': 1,
-        'Chunk': 1,
-        'Date': 1
-    }))
-    documents4 = list(collection_invalid.find({}, {
-        '_id': 1,
-        'Reference article name': 1,
-        'Reference text in main article': 1,
-        'Sieving by gpt 4o': 1,
-        'Chunk': 1,
-        'Date': 1
-    }))
-    documents5 = list(collection_notmatch.find({}, {
-        '_id': 1,
-        'Reference article name': 1,
-        'Reference text in main article': 1,
-        'Sieving by gpt 4o': 1,
-        'Chunk': 1,
-        'Date': 1
-    }))
-
-    documents6 = list(collection_top5.find({}, {
-        '_id': 1,
-        'Sentiment':1,
-        'Confidence Score':1,
-        'Sieving by gpt 4o': 1,
-        'Reference article name': 1,
-        'Reference text in main article': 1,
-        'Chunk': 1,
-        'Date': 1
-    }))
-    
-    # Insert documents into the original collections then clear the new collection such that 
-    # if there are no new data found in this iteration, the previous iteration of data will not be added due to 
+    # Fields kept from each new collection (same as the original collections)
+    processed_fields = ['PDF File', 'Text Content', 'n_tokens', 'Text Chunks', 'Source File', 'embed_v3', 'embed_backend']
+    new_ref_fields = [
+        'Title of original reference article',
+        'Text in main article referencing reference article',
+        'Year reference article released',
+        'Keywords for graph paper search',
+        'Paper Id of new reference article found',
+        'Title of new reference article found',
+        'Year new reference article found published',
+        'authors',
+        'downloadable',
+        'externalId_of_undownloadable_paper',
+        'reason_for_failure',
+        'pdf_url'
+    ]
+    ranked_fields = ['Sentiment', 'Confidence Score', 'Sieving by gpt 4o', 'Reference article name', 'Reference text in main article', 'Chunk', 'Chunk hash', 'Sieved hash', 'Date']
+    unranked_fields = ['Reference article name', 'Reference text in main article', 'Sieving by gpt 4o', 'Chunk', 'Date']
+
+    # Embeddings of different encoders cannot share a collection, nothing is merged if they differ
+    new_backend = get_embedding_backend(uri, db.name, collection_processed_name_new)
+    original_backend = get_embedding_backend(uri, db.name, collection_processed_name_original)
+    if new_backend is not None and original_backend is not None and new_backend != original_backend:
+        raise ValueError(f"'{collection_processed_name_new}' holds '{new_backend}' embeddings but '{collection_processed_name_original}' "
+                         f"holds '{original_backend}' ones, re-ingest the new papers with '{original_backend}'.")
+
+    # Append the new collections to the original collections then clear them such that
+    # if there are no new data found in this iteration, the previous iteration of data will not be added due to
     # it not being cleared in the previous iteration
-    insert_documents(uri, db.name, collection_processed_name_original, documents1)
-    clear_collection(uri, db.name, collection_processed_name_new)
-    
-    insert_documents(uri, db.name, new_ref_collection_original, documents2)
-    clear_collection(uri, db.name, new_ref_collection_new)
-    
-    insert_documents(uri, db.name, valid_collection_name_original, documents3)
-    clear_collection(uri, db.name, valid_collection_name_new)
-    
-    insert_documents(uri, db.name, invalid_collection_name_original, documents4)
-    clear_collection(uri, db.name, invalid_collection_name_new)
-    
-    insert_documents(uri, db.name, not_match_original, documents5)
-    clear_collection(uri, db.name, not_match_new)
-
-    insert_documents(uri, db.name, top_5_original, documents6)
-    clear_collection(uri, db.name, top_5_new)
+    counts = {}
+    indexed_chunks = None
+    if VectorIndex.load(vector_index_path(collection_processed_name_original)) is not None:
+        # The original collection has a vector index to keep in step: the new chunks are appended from Python
+        # to learn the _id they get, everything else is merged by the server
+        indexed_chunks = list(db[collection_processed_name_new].find({}, {'_id': 0, **{field: 1 for field in processed_fields}}))
+        counts['chunks'] = insert_in_batches(db[collection_processed_name_original], indexed_chunks)
+        db[collection_processed_name_new].delete_many({})
+    else:
+        counts['chunks'] = merge_collection(uri, db.name, collection_processed_name_new, collection_processed_name_original, processed_fields, clear_source=True)
+    # The merged PDFs now belong to the original collection, so re-ingesting them is skipped
+    move_ingestion_manifest(uri, db.name, collection_processed_name_new, collection_processed_name_original)
+    counts['new references'] = merge_collection(uri, db.name, new_ref_collection_new, new_ref_collection_original, new_ref_fields, clear_source=True)
+    counts['valid'] = merge_collection(uri, db.name, valid_collection_name_new, valid_collection_name_original, ranked_fields, clear_source=True)
+    counts['invalid'] = merge_collection(uri, db.name, invalid_collection_name_new, invalid_collection_name_original, unranked_fields, clear_source=True)
+    counts['not matched'] = merge_collection(uri, db.name, not_match_new, not_match_original, unranked_fields, clear_source=True)
+    counts['top 5'] = merge_collection(uri, db.name, top_5_new, top_5_original, ranked_fields, clear_source=True)
+    # The index is extended once every collection is merged, so a failure to index cannot leave the other merges undone
+    if indexed_chunks is not None:
+        index_chunks(collection_processed_name_original, indexed_chunks, backend=new_backend)
+    return counts
 
 #for easy debugging for developer side. Meant to send final collections to excel for viewing if you dont have mongo shell installed 
 def send_excel_all(collection_processed_name,new_ref_collection,valid_collection_name,invalid_collection_name,not_match,top_5):
@@ -766,91 +707,4 @@ def send_excel_all(collection_processed_name,new_ref_collection,valid_collection
 
 #cleaning without retry logic since this is initial reference articles so we just clean    
 def cleaning_initial(valid_collection_name, not_match, top_5, threshold=75, change_to_add=False):
-    # Fetch documents from the collection
-    collection_valid = db[valid_collection_name]
-    documents = list(
-        collection_valid.find(
-            {}, 
-            {
-                'Reference article name': 1, 
-                'Reference text in main article': 1, 
-                'Sieving by gpt 4o': 1, 
-                'Chunk': 1, 
-                'Date': 1
-            }
-        )
-    )
-
-    # Convert documents to a DataFrame
-    df = pd.DataFrame(documents)
-
-    # Initialize lists for valid and invalid rows
-    valid_rows = []
-    invalid_rows = []
-
-    
-
-    # Iterate through rows and classify them
-    for idx, row in df.iterrows():
-        extracted_df = extract_classification(row['Sieving by gpt 4o'])
-
-        if extracted_df is not None:
-            # Add additional columns to the valid DataFrame
-            extracted_df['Reference article name'] = row['Reference article name']
-            extracted_df['Reference text in main article'] = row['Reference text in main article']
-            extracted_df['Chunk'] = row['Chunk']
-            extracted_df['Date'] = row['Date']
-            valid_rows.append(extracted_df)
-        else:
-            # Store invalid rows if no valid classification is found
-            invalid_rows.append(row)
-
-    # Combine valid rows into a DataFrame
-    valid_df = pd.concat(valid_rows, ignore_index=True) if valid_rows else pd.DataFrame()
-
-    # If valid_df is empty, skip filtering and retry logic
-    if valid_df.empty:
-        print("No valid rows found. Skipping filtering and retry logic.")
-        # Export invalid data if required
-        invalid_df = pd.concat([pd.DataFrame(invalid_rows)], ignore_index=True)
-        records3 = invalid_df.to_dict(orient='records')
-        insert_documents(uri, db.name, not_match, records3)
-        return  # Exit the function early as there's no valid data to process further
-
-    # Identify rows where reference text is found within the content and remove them (hallucinations)
-    matches_df = valid_df[valid_df.apply(contains_reference_text, axis=1)]
-    filtered_df = valid_df[~valid_df.apply(contains_reference_text, axis=1)]
-
-    
-
-    # Group the valid rows and apply the top 5 or all top scores logic
-    top_ranked_with_ties_df = (
-        valid_df.groupby(
-            ['Reference article name', 'Reference text in main article', 'Sentiment'], as_index=False
-        ).apply(top_5_or_all_top_scores, threshold=threshold).reset_index(drop=True)
-    )
-
-    if change_to_add:
-        # Send top-ranked output to an Excel file
-        xlsx = top_5 + '.xlsx'
-        records1 = top_ranked_with_ties_df.to_dict(orient='records')
-        upsert_database_and_collection(uri, db.name, top_5, records1)
-        valid_xlsx = valid_collection_name + '.xlsx'
-        records2 = valid_df.to_dict(orient='records')
-        upsert_database_and_collection(uri, db.name, valid_collection_name, records2)
-    else:
-        # Send top-ranked output to an Excel file
-        xlsx = top_5 + '.xlsx'
-        records1 = top_ranked_with_ties_df.to_dict(orient='records')
-        replace_database_collection(uri, db.name, top_5, records1)
-        valid_xlsx = valid_collection_name + '.xlsx'
-        records2 = valid_df.to_dict(orient='records')
-        replace_database_collection(uri, db.name, valid_collection_name, records2)
-
-    # Combine invalid rows and matches into one DataFrame
-    invalid_df = pd.concat([pd.DataFrame(invalid_rows), matches_df], ignore_index=True)
-    invalid_xlsx = not_match + '.xlsx'
-    records3 = invalid_df.to_dict(orient='records')
-    insert_documents(uri, db.name, not_match, records3)
-
-    
+    rank_sieved_collection(valid_collection_name, not_match, top_5, threshold, change_to_add, keep_matches=True)
@@ -0,0 +1,50 @@
+import os
+import numpy as np
+from dotenv import load_dotenv
+
+#offline CPU encoder: signed hashed character n-grams, no network, token or quota needed
+#vectors only compare with vectors of the same encoder, never with the Azure embeddings
+load_dotenv()
+
+local_encoder_dim = int(os.getenv("local_encoder_dim", 1024))
+local_encoder_name = "local-hashed-ngrams"
+
+ngram_sizes = (3, 4, 5)
+_base = np.uint64(1000003)
+
+
+# Helper function to hash every n-gram of a string (given as code points) with a rolling polynomial hash
+def hash_ngrams(codes, n):
+    count = len(codes) - n + 1
+    hashes = np.zeros(count, dtype=np.uint64)
+    for k in range(n):
+        # uint64 arithmetic wraps around, which is what the hash wants
+        hashes = hashes * _base + codes[k:k + count]
+    # Mix the bits (murmur3 finaliser) so that the bucket and the sign are independent
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xff51afd7ed558ccd)
+    hashes ^= hashes >> np.uint64(33)
+    return hashes
+
+
+def encode_text(text, dim=local_encoder_dim):
+    text = ' ' + ' '.join(str(text).lower().split()) + ' '
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    vector = np.zeros(dim, dtype=np.float64)
+    for n in ngram_sizes:
+        if len(codes) < n:
+            continue
+        hashes = hash_ngrams(codes, n)
+        signs = np.where(hashes >> np.uint64(63), -1.0, 1.0)
+        vector += np.bincount((hashes % np.uint64(dim)).astype(np.intp), weights=signs, minlength=dim)
+    # Sublinear term frequency so that long texts are not dominated by frequent n-grams
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).astype(np.float32)
+
+
+""" Call this function to embed a list of texts on the CPU. Output is a float32 matrix with one unit-length row per text."""
+def encode_texts(texts, dim=local_encoder_dim):
+    if len(texts) == 0:
+        return np.zeros((0, dim), dtype=np.float32)
+    return np.vstack([encode_text(text, dim) for text in texts])
@@ -8,6 +8,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, EmailStr
 from typing import List, Optional
 from .call_mongodb import *
+from .mongo_client import mongo_client_options
 from .expert_decision import *
 import certifi
 import datetime as datetime
@@ -23,6 +24,7 @@ from .semantic_scholar_keyword_search import search_and_retrieve_keyword
 from .agentic_search_system import agentic_search
 from .gpt_rag_asyncio import *
 from .semantic_chunking import *
+from .token_manager import token_manager
 import asyncio
 import aiosmtplib
 from email.message import EmailMessage
@@ -50,7 +52,7 @@ async def verify_internet_connection():
         )
 
 uri = os.getenv("uri_mongo")
-client = AsyncIOMotorClient(uri, tls=True, tlsCAFile=certifi.where())  
+client = AsyncIOMotorClient(uri, **mongo_client_options())
 db = client['data']
 collection_take = db["expert_data"] 
 collection_compare = db['merged']
@@ -98,8 +100,9 @@ async def startup_event():
         asyncio.create_task(monitor_internet_connection())
         logging.info("Internet monitoring started.")
 
-        # Refresh token
+        # Refresh token, then keep refreshing it in the background ahead of expiry
         await get_or_refresh_token()
+        token_manager.start_background_refresh()
 
         # Initialize GPT
         await initialize_client()
@@ -107,6 +110,12 @@ async def startup_event():
         # Initialize Chunker
         await initialize_encoder()
 
+        # Natural key and query indexes of the pipeline collections
+        try:
+            await asyncio.to_thread(ensure_indexes, uri, 'data')
+        except Exception as e:
+            logging.warning(f"Could not create MongoDB indexes: {e}")
+
         logging.info("Initialization complete. All systems ready.")
     except Exception as e:
         logging.error(f"Initialization failed: {e}")
@@ -873,3 +882,5 @@ async def get_edits():
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+    # Close the pooled GPT client of the server event loop
+    await close_client()
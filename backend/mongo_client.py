@@ -2,17 +2,52 @@ from pymongo import MongoClient
 import certifi
 from dotenv import load_dotenv
 import os
+import threading
 
 load_dotenv()
 
-#universal MongoDB client 
+#universal MongoDB client: one pooled client per URI and per process, shared by every module and call_mongodb helper
+
+# Connection pool of each client (connections are opened on demand, up to the max)
+mongo_max_pool_size = int(os.getenv("mongo_max_pool_size", 50))
+mongo_min_pool_size = int(os.getenv("mongo_min_pool_size", 0))
+# Wire compression, in order of preference. zstd and snappy need their python packages and are skipped without them
+mongo_compressors = os.getenv("mongo_compressors", "zlib")
+
+
+def mongo_client_options():
+    """Options shared by the pymongo and motor clients."""
+    return {
+        'tls': True,
+        'tlsCAFile': certifi.where(),
+        'maxPoolSize': mongo_max_pool_size,
+        'minPoolSize': mongo_min_pool_size,
+        'compressors': mongo_compressors,
+        'retryWrites': True,
+    }
+
 
 class MongoDBClient:
-    _client = None
+    _clients = {}
+    _lock = threading.Lock()
 
     @staticmethod
-    def get_client():
-        if MongoDBClient._client is None:
-            uri = os.getenv("uri_mongo")
-            MongoDBClient._client = MongoClient(uri, tls=True, tlsCAFile=certifi.where())
-        return MongoDBClient._client
+    def get_client(uri=None):
+        uri = uri or os.getenv("uri_mongo")
+        with MongoDBClient._lock:
+            client = MongoDBClient._clients.get(uri)
+            if client is None:
+                # connect=False: nothing is opened until the first operation, so importing a module stays offline
+                client = MongoClient(uri, connect=False, **mongo_client_options())
+                MongoDBClient._clients[uri] = client
+        return client
+
+    @staticmethod
+    def _reset_after_fork():
+        # Connections cannot be shared with a forked child (e.g. PDF workers): the child opens its own clients
+        MongoDBClient._clients = {}
+        MongoDBClient._lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=MongoDBClient._reset_after_fork)
@@ -10,10 +10,19 @@ import os
 from dotenv import *
 import pandas as pd
 import shutil
+import time
+import hashlib
+from collections import deque
+import multiprocessing
+import multiprocessing.connection
 from typing import AsyncGenerator, Generator, Iterable, TypeVar, Union, List, Dict, Any, Optional
 from pathlib import Path
 load_dotenv()
 
+# PDF extraction fans out over processes, a PDF that takes longer than pdf_timeout seconds is treated as invalid
+pdf_workers = int(os.getenv("pdf_workers", os.cpu_count() or 1))
+pdf_timeout = float(os.getenv("pdf_timeout", 120))
+
 """Every functions deals w the main PDF in terms of extracted text etc"""
 
 #get list of pdf file location in the directory
@@ -65,6 +74,207 @@ def extract_text_from_pdf_specific(pdf_path):
     
 
 
+def extract_pdf_pages(pdf_path, timeout=pdf_timeout):
+    """
+    Open a PDF once, validating and extracting it in the same pass (runs in a worker process).
+
+    Args:
+    - pdf_path (str): Path to the PDF file.
+    - timeout (float): Stop after this many seconds, checked between pages.
+
+    Returns:
+    - tuple: (pdf_path, list of page texts or None if the file is invalid, error message or None)
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        with fitz.open(pdf_path) as pdf_document:
+            extracted_text = []
+            for page in pdf_document:
+                if time.monotonic() > deadline:
+                    return pdf_path, None, f"timed out after {timeout:.0f} seconds"
+                extracted_text.append(page.get_text())
+        return pdf_path, extracted_text, None
+    except Exception as e:
+        return pdf_path, None, str(e)
+
+
+# Worker process: extracts the PDFs sent over conn one at a time until it receives None
+def _extraction_worker(conn, timeout):
+    try:
+        for pdf_path in iter(conn.recv, None):
+            conn.send(extract_pdf_pages(pdf_path, timeout)[1:])
+    except (EOFError, KeyboardInterrupt):
+        pass
+
+
+class _ExtractionWorker:
+    """
+    One worker process fed one PDF at a time, so the deadline of a file runs from when its extraction
+    starts and a worker stuck on it can be killed and replaced on its own.
+    """
+
+    def __init__(self, context, timeout):
+        self.timeout = timeout
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_extraction_worker, args=(child_conn, timeout), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None  # (index in pdf_list, pdf_path, deadline) of the file being extracted
+        self.done = 0
+
+    def submit(self, index, pdf_path, deadline):
+        self.task = (index, pdf_path, deadline)
+        try:
+            self.conn.send(pdf_path)
+        except OSError:
+            pass  # The worker died, poll reports it
+
+    def poll(self, now):
+        """
+        Returns (text_list, error, reusable) once the current file is extracted, failed or past its deadline,
+        None while it is still running. reusable is False if the worker has to be replaced.
+        """
+        if self.conn.poll():
+            try:
+                return (*self.conn.recv(), True)
+            except EOFError:
+                return None, "worker process exited", False
+        if not self.process.is_alive():
+            return None, "worker process exited", False
+        if now >= self.task[2]:
+            return None, f"timed out after {self.timeout:.0f} seconds", False
+        return None
+
+    def stop(self, kill=False):
+        if kill:
+            self.process.kill()
+        else:
+            try:
+                self.conn.send(None)
+            except OSError:
+                self.process.kill()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+def extract_pdfs(pdf_list, workers=pdf_workers, timeout=pdf_timeout):
+    """
+    Extract many PDFs across CPU cores. Results are yielded in the order of pdf_list as soon as they
+    are ready, so callers can stream them.
+
+    A page that hangs inside PyMuPDF cannot be interrupted cooperatively, so the parent also gives every
+    file a deadline from the moment a worker starts on it. A worker past its deadline is killed and
+    replaced, and the file is reported as invalid.
+
+    Args:
+    - pdf_list (list): List of PDF file paths.
+    - workers (int): Number of worker processes.
+    - timeout (float): Seconds allowed per file.
+
+    Yields:
+    - tuple: (pdf_path, list of page texts or None if the file is invalid)
+    """
+    pdf_list = list(pdf_list)
+    if not pdf_list:
+        return
+    # Workers are started with forkserver (spawn where it is missing) rather than fork, forking the threaded
+    # FastAPI server can leave locks held in the child. workflow.py guards its top level for this
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    context = multiprocessing.get_context(start_method)
+    if start_method == 'forkserver':
+        # Workers are forked from a server that already imported this module
+        context.set_forkserver_preload([__name__])
+    pool = [_ExtractionWorker(context, timeout) for _ in range(max(1, min(workers, len(pdf_list))))]
+    # Only a few files per worker are finished but not yet yielded, so memory does not grow with the size of the folder
+    window = len(pool) * 4
+    finished = {}
+    submitted = yielded = 0
+    try:
+        while yielded < len(pdf_list):
+            for worker in pool:
+                if worker.task is None and submitted < min(len(pdf_list), yielded + window):
+                    # Grace period over the cooperative check between pages in the worker
+                    worker.submit(submitted, pdf_list[submitted], time.monotonic() + timeout + 5)
+                    submitted += 1
+
+            busy = [worker for worker in pool if worker.task is not None]
+            if busy:
+                wait = max(0.0, min(worker.task[2] for worker in busy) - time.monotonic())
+                multiprocessing.connection.wait([worker.conn for worker in busy] + [worker.process.sentinel for worker in busy], wait)
+            now = time.monotonic()
+            for position, worker in enumerate(pool):
+                if worker.task is None:
+                    continue
+                result = worker.poll(now)
+                if result is None:
+                    continue
+                text_list, error, reusable = result
+                index, pdf_path, _ = worker.task
+                finished[index] = (pdf_path, text_list, error)
+                worker.task = None
+                worker.done += 1
+                # A stuck or dead worker is replaced, healthy ones are recycled now and then so PyMuPDF memory is given back
+                if not reusable or worker.done >= 50:
+                    worker.stop(kill=not reusable)
+                    pool[position] = _ExtractionWorker(context, timeout)
+
+            while yielded in finished:
+                pdf_path, text_list, error = finished.pop(yielded)
+                if error:
+                    print(f"Error extracting text from {pdf_path}: {error}")
+                yield pdf_path, text_list
+                yielded += 1
+    finally:
+        for worker in pool:
+            worker.stop(kill=True)
+
+
+# Unicode category C characters (control, format, private use, unassigned...) are stripped from extracted text.
+# The translation table fills itself on first sight of each character, so cleaning is one str.translate call
+class _ControlCharTable(dict):
+    def __missing__(self, codepoint):
+        value = None if unicodedata.category(chr(codepoint))[0] == 'C' else codepoint
+        self[codepoint] = value
+        return value
+
+control_char_table = _ControlCharTable()
+
+def remove_control_characters(text):
+    return text.translate(control_char_table)
+
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def pages_to_text(text_list):
+    """
+    Join the pages of a PDF the way save_text writes them and clean the result the way
+    read_processed_texts does, without going through a file.
+    """
+    return remove_control_characters(''.join(
+        f"Text on page {page_number + 1}:\n{text}\n\n" for page_number, text in enumerate(text_list)
+    ))
+
+
+def stream_pdf_texts(pdf_list, invalid_pdfs_dir='invalid_pdfs'):
+    """
+    Yield (pdf_path, cleaned text) for every valid PDF, moving invalid ones to invalid_pdfs_dir.
+    """
+    for pdf_path, text_list in extract_pdfs(pdf_list):
+        if text_list is None:
+            move_invalid_pdf(pdf_path, invalid_pdfs_dir)
+        else:
+            yield pdf_path, pages_to_text(text_list)
+
+
 def invalid_pdf(pdf_path):
     text_list = extract_text_from_pdf_specific(pdf_path)
     invalid_pdfs_dir='invalid_pdfs'
@@ -79,8 +289,9 @@ def process_invalid_pdfs(pdf_list):
     Args:
     - pdf_list (list): List of PDF file paths.
     """
-    for pdf_path in pdf_list:
-        invalid_pdf(pdf_path)
+    for pdf_path, text_list in extract_pdfs(pdf_list):
+        if text_list is None:
+            move_invalid_pdf(pdf_path, 'invalid_pdfs')
 
 def save_text(text_list, filename, output_dir):
     """
@@ -125,19 +336,28 @@ def full_cycle_specific(pdf_path, filename, output_dir, invalid_pdfs_dir='invali
 
 def process_and_save_pdfs(pdf_list, output_dir):
     """
-    Process each PDF file, save the processed text to the specified output directory.
+    Process each PDF file in parallel, save the processed text to the specified output directory and
+    move invalid PDFs to invalid_pdfs. Valid files are numbered consecutively (0.txt, 1.txt, ...) so that
+    the numbering matches the PDFs left in the folder.
     
     Args:
         pdf_list (list): List of PDF file paths.
         output_dir (str): Directory to save processed text files.
+
+    Returns:
+        list: Paths of the valid PDFs, in the order of their text files.
     """
     os.makedirs(output_dir, exist_ok=True)  # Ensure the output directory exists
     
-    for i, pdf_path in enumerate(pdf_list):
-        # Process the PDF and get the processed text
-        file_content = full_cycle_specific(pdf_path, filename=str(i), output_dir=output_dir)
-
-        # Optionally, you can print the content or do additional processing here
+    valid_pdfs = []
+    for pdf_path, text_list in extract_pdfs(pdf_list):
+        if text_list is None:
+            # Move the invalid PDF if extraction failed
+            move_invalid_pdf(pdf_path, 'invalid_pdfs')
+        else:
+            save_text(text_list, f"{len(valid_pdfs)}.txt", output_dir)
+            valid_pdfs.append(pdf_path)
+    return valid_pdfs
 
 
 
@@ -158,7 +378,7 @@ def read_processed_texts(directory,filenames):
         input_path = os.path.join(directory, filename)
         with open(input_path, 'r', encoding='utf-8') as f:
             processed_text = f.read()
-            cleaned_text = ''.join(char for char in processed_text if unicodedata.category(char)[0] != 'C')
+            cleaned_text = remove_control_characters(processed_text)
             processed_texts.append(cleaned_text)
 
     return processed_texts
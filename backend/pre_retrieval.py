@@ -0,0 +1,213 @@
+import os
+import re
+import math
+import logging
+import numpy as np
+from collections import Counter
+from dotenv import load_dotenv
+from .embedding import embed_texts, resolve_backend
+from .similarity import normalize_rows, to_float32_vector
+
+#optional pre-retrieval ahead of the GPT sieve: the chunks of a paper are scored against the statement with BM25
+#and/or the stored chunk embeddings, only the best ones are sieved
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+# off, bm25, embedding or hybrid (mean of both scores)
+pre_retrieval_mode = os.getenv("pre_retrieval", "off")
+pre_retrieval_modes = ('off', 'bm25', 'embedding', 'hybrid')
+# Chunks forwarded per (paper, statement) pair, before the margin
+pre_retrieval_top_k = int(os.getenv("pre_retrieval_top_k", 8))
+# Recall safety margin: top k is widened by this fraction
+pre_retrieval_margin = float(os.getenv("pre_retrieval_margin", 0.5))
+# Chunks whose score, rescaled to [0, 1] within the paper, reaches this are forwarded as well
+pre_retrieval_threshold = float(os.getenv("pre_retrieval_threshold", 0.8))
+# Share of pairs sieved in full to measure the recall of the pre-retrieval
+pre_retrieval_audit_fraction = float(os.getenv("pre_retrieval_audit_fraction", 0.05))
+
+bm25_k1 = 1.5
+bm25_b = 0.75
+_token_pattern = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return _token_pattern.findall(str(text).lower()) if isinstance(text, str) else []
+
+
+class BM25:
+    """
+    BM25 statistics of the chunks of one paper, built once and queried with every statement citing the paper.
+    """
+
+    def __init__(self, texts, k1=bm25_k1, b=bm25_b):
+        self.k1 = k1
+        self.b = b
+        self.documents = [Counter(tokenize(text)) for text in texts]
+        self.lengths = np.array([sum(document.values()) for document in self.documents], dtype=float)
+        self.average_length = self.lengths.mean() if self.lengths.size and self.lengths.mean() > 0 else 1.0
+        self.document_frequency = Counter(term for document in self.documents for term in document)
+
+    def scores(self, query):
+        scores = np.zeros(len(self.documents))
+        n = len(self.documents)
+        norm = self.k1 * (1 - self.b + self.b * self.lengths / self.average_length)
+        for term in set(tokenize(query)):
+            df = self.document_frequency.get(term, 0)
+            if not df:
+                continue
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            frequencies = np.array([document.get(term, 0) for document in self.documents], dtype=float)
+            scores += idf * frequencies * (self.k1 + 1) / (frequencies + norm)
+        return scores
+
+
+# Helper function to stack the stored embeddings of a paper, rows without one are NaN
+def embedding_matrix(embeddings):
+    vectors = [to_float32_vector(value) if isinstance(value, (list, tuple, np.ndarray, str)) else None for value in embeddings]
+    dimension = next((vector.size for vector in vectors if vector is not None), 0)
+    matrix = np.full((len(vectors), dimension), np.nan, dtype=np.float32)
+    for i, vector in enumerate(vectors):
+        if vector is not None and vector.size == dimension:
+            matrix[i] = vector
+    return normalize_rows(matrix)
+
+
+# Helper function to rescale scores to [0, 1] within a paper, NaN (unscored) is kept
+def rescale(scores):
+    finite = scores[np.isfinite(scores)]
+    if finite.size == 0:
+        return scores
+    low, high = finite.min(), finite.max()
+    if high == low:
+        # Nothing tells the chunks apart
+        return np.where(np.isfinite(scores), 1.0, np.nan)
+    return (scores - low) / (high - low)
+
+
+def select_chunks(scores, top_k=None, margin=None, threshold=None):
+    """
+    Picks the chunks to forward to the sieve.
+
+    Args:
+        scores (np.ndarray): Rescaled score of every chunk, NaN for chunks that could not be scored.
+        top_k (int): Chunks forwarded before the margin, pre_retrieval_top_k by default.
+        margin (float): Fraction top_k is widened by, pre_retrieval_margin by default.
+        threshold (float): Rescaled score above which a chunk is forwarded anyway, pre_retrieval_threshold by default.
+
+    Returns:
+        np.ndarray: Boolean mask of the forwarded chunks. Unscored chunks are always forwarded.
+    """
+    top_k = pre_retrieval_top_k if top_k is None else top_k
+    margin = pre_retrieval_margin if margin is None else margin
+    threshold = pre_retrieval_threshold if threshold is None else threshold
+    keep = math.ceil(top_k * (1 + margin))
+    forwarded = ~np.isfinite(scores)
+    if scores.size <= keep:
+        return np.ones(scores.size, dtype=bool)
+    ranked = np.where(np.isfinite(scores), scores, -np.inf)
+    forwarded[np.argpartition(-ranked, keep - 1)[:keep]] = True
+    forwarded |= np.nan_to_num(scores, nan=0.0) >= threshold
+    return forwarded
+
+
+""" Call this function before sieving (paper chunks, statement) pairs. Output is a list of (chunks to sieve, code, audit mask) per pair."""
+def pre_retrieve(jobs, mode=None, audit_fraction=None, backend=None):
+    """
+    Args:
+        jobs (list): (df, code) tuples, df holds the chunks of one paper ('Text Content', optionally 'embed_v3')
+            and code is [text, name, year].
+        mode (str): One of pre_retrieval_modes, pre_retrieval_mode by default.
+        audit_fraction (float): Share of pairs sieved in full, pre_retrieval_audit_fraction by default.
+        backend (str): Encoder the stored chunk embeddings were made with (see call_mongodb.get_embedding_backend),
+            the process default if None. Statements are embedded with it.
+
+    Returns:
+        list: (df, code, forwarded) per pair. Audited pairs keep every chunk and forwarded marks the ones
+            the pre-retrieval would have kept, other pairs keep the forwarded chunks only and forwarded is None.
+    """
+    mode = mode or pre_retrieval_mode
+    if mode not in pre_retrieval_modes:
+        raise ValueError(f"Unknown pre-retrieval mode '{mode}', expected one of {pre_retrieval_modes}.")
+    if mode == 'off' or not jobs:
+        return [(df, code, None) for df, code in jobs]
+    audit_fraction = pre_retrieval_audit_fraction if audit_fraction is None else audit_fraction
+
+    statement_vectors = {}
+    if mode in ('embedding', 'hybrid'):
+        # One batched (and cached) request for every statement
+        statements = list(dict.fromkeys(str(code[0]) for _, code in jobs))
+        statement_vectors = dict(zip(statements, normalize_rows(np.asarray(embed_texts(statements, desc="Embedding statements", backend=backend), dtype=np.float32))))
+
+    # Papers are cited by many statements, their statistics are built once
+    papers = {}
+    # Papers already warned about (once per paper, not per statement)
+    warned = set()
+    rng = np.random.default_rng()
+    selected = []
+    total = forwarded_count = 0
+    for df, code in jobs:
+        key = tuple(df.index)
+        if key not in papers:
+            papers[key] = (
+                BM25(df['Text Content'].tolist()) if mode in ('bm25', 'hybrid') else None,
+                embedding_matrix(df['embed_v3']) if mode in ('embedding', 'hybrid') and 'embed_v3' in df else None,
+            )
+        bm25, matrix = papers[key]
+
+        scores = []
+        if bm25 is not None:
+            scores.append(rescale(bm25.scores(code[0])))
+        if mode in ('embedding', 'hybrid'):
+            vector = statement_vectors[str(code[0])]
+            if matrix is not None and matrix.shape[1] == vector.size:
+                scores.append(rescale(matrix @ vector))
+            else:
+                # No comparable embeddings, the chunks are unscored (forwarded) unless BM25 scored them
+                if key not in warned:
+                    warned.add(key)
+                    if matrix is None:
+                        logging.warning(f"Pre-retrieval: no stored embeddings for '{code[1]}', its chunks are not scored by embedding.")
+                    else:
+                        logging.warning(f"Pre-retrieval: stored embeddings of '{code[1]}' have {matrix.shape[1]} dimensions but the "
+                                        f"'{resolve_backend(backend)}' statement embeddings have {vector.size}, its chunks are not scored by embedding.")
+                scores.append(np.full(len(df), np.nan))
+        if len(scores) == 1:
+            combined = scores[0]
+        else:
+            stacked = np.vstack(scores)
+            counts = np.isfinite(stacked).sum(axis=0)
+            # Mean of the available scores
+            combined = np.where(counts > 0, np.nansum(stacked, axis=0) / np.maximum(counts, 1), np.nan)
+
+        forwarded = select_chunks(combined)
+        total += len(df)
+        forwarded_count += int(forwarded.sum())
+        if rng.random() < audit_fraction:
+            selected.append((df, code, forwarded))
+        else:
+            selected.append((df[forwarded], code, None))
+
+    logging.info(f"Pre-retrieval ({mode}) forwards {forwarded_count} of {total} chunks "
+                 f"({total / max(forwarded_count, 1):.1f}x fewer sieve calls).")
+    return selected
+
+
+""" Call this function after sieving the audited pairs. Output is the recall of the pre-retrieval, None if nothing was audited."""
+def pre_retrieval_recall(audited):
+    """
+    Args:
+        audited (list): (forwarded, relevant) per chunk of the audited pairs, relevant meaning the sieve
+            found support or opposition in it.
+
+    Returns:
+        float: Share of the relevant chunks the pre-retrieval forwards.
+    """
+    relevant = [forwarded for forwarded, is_relevant in audited if is_relevant]
+    if not relevant:
+        if audited:
+            logging.info(f"Pre-retrieval audit: {len(audited)} chunks sieved in full, none relevant.")
+        return None
+    recall = sum(relevant) / len(relevant)
+    logging.info(f"Pre-retrieval recall: {recall:.3f} ({sum(relevant)} of {len(relevant)} relevant chunks "
+                 f"in {len(audited)} audited chunks). Raise pre_retrieval_top_k if it is too low.")
+    return recall
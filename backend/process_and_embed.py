@@ -9,121 +9,179 @@ from .embedding import *
 from .call_mongodb import *
 from .semantic_chunking import *
 from .mongo_client import MongoDBClient
+from .vector_index import move_vector_index, drop_vector_index, remove_from_vector_index
+from bson import ObjectId
 load_dotenv()
 client = MongoDBClient.get_client()
 db = client['data']
 uri = os.getenv("uri_mongo")
+# Number of papers extracted, chunked and written together. Memory is bounded by one batch, not the corpus
+ingest_batch_size = int(os.getenv("ingest_batch_size", 20))
+
+
+#helper function to group an iterable into lists of at most size items
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+#Stream chunked papers batch by batch: PDFs are extracted in parallel, cleaned and chunked in memory (no doc/ temp files,
+#so several jobs can run at once). Papers are named by gpt 4o from their text or by their file name (paper id)
+#Every chunk records the file it came from ('Source File') so that incremental ingestion can replace or remove it
+#encoder_backend picks the encoder of the chunker for this job ('azure' or 'local', the encoder_backend env variable by default)
+def stream_chunked_papers(files_directory, name_with_gpt=False, batch_size=ingest_batch_size, pdf_list=None, encoder_backend=None):
+    if pdf_list is None:
+        pdf_list = read_pdf_file_list(files_directory)
+    for batch in batched(stream_pdf_texts(pdf_list), batch_size):
+        if name_with_gpt:
+            names = [get_name(text) for _, text in batch]
+        else:
+            names = [os.path.splitext(os.path.basename(pdf_path))[0] for pdf_path, _ in batch]
+        df = pd.DataFrame({
+            'PDF File': names,
+            'Text Content': [text for _, text in batch],
+            'Source File': [os.path.basename(pdf_path) for pdf_path, _ in batch]
+        })
+        df = process_dataframe_sc1(df, backend=encoder_backend)
+
+        df_exploded = df.explode(['text_chunks', 'chunk_embeddings']).drop(columns=['Text Content'])
+        # Rename the columns for clarity, the chunk embedding is stored with the chunk for retrieval
+        df_exploded.rename(columns={'text_chunks': 'Text Content', 'chunk_embeddings': 'embed_v3'}, inplace=True)
+        # The encoder is recorded with the vectors, retrieval embeds its queries with the same one
+        df_exploded['embed_backend'] = resolve_backend(encoder_backend)
+        yield df_exploded
+
+#Write one batch of records, to the staging collection when the collection is being replaced (see start_collection_replace)
+def write_batch(collection_name, records, staging_name=None):
+    if staging_name is not None:
+        insert_in_batches(db[staging_name], records)
+    else:
+        insert_documents(uri, db.name, collection_name, records)
+    print(f"Data sent to MongoDB Atlas for collection: {collection_name}")
+
+#Chunk, embed and send PDFs to the two collections (chunks, embedded chunks) and index the embeddings.
+#Both collections (and the vector index) are built aside and swapped in at the end, readers never see a partial corpus
+def process_pdfs_to_mongodb_embedded(files_directory, collection1, collection2, name_with_gpt, encoder_backend=None):
+    staging1 = start_collection_replace(uri, db.name, collection1)
+    staging2 = start_collection_replace(uri, db.name, collection2)
+    try:
+        # Id, paper and embedding of every chunk, indexed once all batches are written
+        indexed_chunks = []
+        for df_exploded in stream_chunked_papers(files_directory, name_with_gpt=name_with_gpt, encoder_backend=encoder_backend):
+            # Embed (only chunks that did not get an embedding from semantic chunking)
+            split_df = splitting(df_exploded, 'Text Content')
+            token_df = tokenize(split_df, 'Text Content')
+            chunki = chunking(token_df, 'Text Content', 8190)
+
+            emb=embed(chunki, backend=encoder_backend)
+            # Ids are set here so that the vector index can point at the stored chunks
+            emb['_id'] = [ObjectId() for _ in range(len(emb))]
+
+            # Convert DataFrames to records
+            records1 = df_exploded.to_dict(orient='records')
+            records2 = emb.to_dict(orient='records')
+
+            # Save data to MongoDB
+            print("Sending data to MongoDB Atlas...")
+            write_batch(collection1, records1, staging1)
+            write_batch(collection2, records2, staging2)
+
+            indexed_chunks.extend({'_id': record['_id'], 'PDF File': record.get('PDF File'), 'embed_v3': record.get('embed_v3')} for record in records2)
+
+        # Build the on-disk vector index of the embedded chunks in one go (empty if there was no valid PDF)
+        index_chunks(staging2, indexed_chunks, rebuild=True, backend=encoder_backend)
+    except Exception:
+        abort_collection_replace(uri, db.name, staging1)
+        abort_collection_replace(uri, db.name, staging2)
+        drop_vector_index(staging2)
+        raise
+    finish_collection_replace(uri, db.name, staging1, collection1)
+    finish_collection_replace(uri, db.name, staging2, collection2)
+    move_vector_index(staging2, collection2)
+
+#Chunk and send PDFs to one collection (without embeddings). Ingestion is incremental: the SHA-256 of every PDF and the
+#chunker version are kept in the ingestion manifest, unchanged files are skipped, new or changed files are chunked and
+#the chunks of changed or deleted files are removed. A collection without manifest entries is rebuilt from scratch
+#in a staging collection that replaces it at the end
+def process_pdfs_to_mongodb_chunked(files_directory, collection1, name_with_gpt, change_to_add=False, encoder_backend=None):
+    # Chunks made with another encoder are different chunks
+    version = chunker_version if resolve_backend(encoder_backend) == 'azure' else f"{chunker_version}+{resolve_backend(encoder_backend)}"
+    pdf_list = read_pdf_file_list(files_directory)
+    hashes = {os.path.basename(pdf_path): file_sha256(pdf_path) for pdf_path in pdf_list}
+    manifest = get_ingestion_manifest(uri, db.name, collection1)
 
+    def up_to_date(file):
+        entry = manifest.get(file)
+        return entry is not None and entry.get('Source Hash') == hashes[file] and entry.get('chunker_version') == version
+
+    rebuild = not manifest and not change_to_add
+    # One collection holds the embeddings of one encoder: a full run with another encoder rebuilds it, an addition is refused
+    existing_backend = get_embedding_backend(uri, db.name, collection1)
+    if existing_backend is not None and existing_backend != resolve_backend(encoder_backend):
+        if change_to_add:
+            raise ValueError(f"'{collection1}' holds '{existing_backend}' embeddings, cannot add '{resolve_backend(encoder_backend)}' ones.")
+        rebuild = True
+    if not rebuild:
+        stale = [file for file in manifest if file in hashes and not up_to_date(file)]
+        if not change_to_add:
+            # The folder holds every paper, so files that disappeared are removed as well
+            stale += [file for file in manifest if file not in hashes]
+        removed = remove_ingested_files(uri, db.name, collection1, stale)
+        # An index extended by add_to_existing would otherwise keep returning the deleted chunks
+        remove_from_vector_index(collection1, removed)
+        pdf_list = [pdf_path for pdf_path in pdf_list if not up_to_date(os.path.basename(pdf_path))]
+        print(f"{len(hashes) - len(pdf_list)} unchanged PDFs skipped, {len(pdf_list)} to process.")
+
+    staging1 = start_collection_replace(uri, db.name, collection1) if rebuild else None
+    # A rebuild records its files once the new collection is in place
+    rebuilt_entries = []
+    try:
+        for df_exploded in stream_chunked_papers(files_directory, name_with_gpt=name_with_gpt, pdf_list=pdf_list, encoder_backend=encoder_backend):
+            records1 = df_exploded.to_dict(orient='records')
+
+            print("Sending data to MongoDB Atlas...")
+            write_batch(collection1, records1, staging1)
+
+            # Record the files of this batch only once their chunks are stored
+            papers = df_exploded.drop_duplicates('Source File')
+            entries = [
+                {'Source File': file, 'Source Hash': hashes[file], 'chunker_version': version, 'PDF File': name}
+                for file, name in zip(papers['Source File'], papers['PDF File'])
+            ]
+            if rebuild:
+                rebuilt_entries += entries
+            else:
+                update_ingestion_manifest(uri, db.name, collection1, entries)
+    except Exception:
+        if rebuild:
+            abort_collection_replace(uri, db.name, staging1)
+        raise
+
+    if rebuild:
+        finish_collection_replace(uri, db.name, staging1, collection1)
+        # None of the indexed chunks are left after a rebuild
+        drop_vector_index(collection1)
+        remove_ingested_files(uri, db.name, collection1, [], clear=True)
+        update_ingestion_manifest(uri, db.name, collection1, rebuilt_entries)
 
 #Embed and chunk PDFs of reference articles (initial, uploaded by user) and send these chunks to mongoDB
 def process_pdfs_to_mongodb(files_directory, collection1, collection2):
     """
     Process PDFs to MongoDB (Using embeddings for retrieval)
     """
-    
-    directory = 'doc'  # Fixed directory
-
-    pdf_list = read_pdf_file_list(files_directory)
-    
-    # Process and save PDFs
-    process_and_save_pdfs(pdf_list, directory)
-    filenames = get_txt_names(files_directory)
-
-    processed_texts = read_processed_texts(directory, filenames)
-    processed_name = get_names(filenames, directory)
-    
-
-    data = {'PDF File': processed_name, 'Text Content': processed_texts}
-    df = pd.DataFrame(data)
-    tqdm.pandas(desc="Processing Documents for Chunking")
-    df['text_chunks'] = df['Text Content'].apply(semantic_chunk)
-    
-    df_exploded = df.explode('text_chunks').drop(columns=['Text Content'])
-    
-    # Rename the columns for clarity
-    df_exploded.rename(columns={'text_chunks': 'Text Content'}, inplace=True)
-
-    # Embed
-    split_df = splitting(df_exploded, 'Text Content')
-    token_df = tokenize(split_df, 'Text Content')
-    chunki = chunking(token_df, 'Text Content', 8190)
-
-    emb=embed(chunki)
-
-    # Convert DataFrames to records
-    records1 = df_exploded.to_dict(orient='records')
-    records2 = emb.to_dict(orient='records')
-
-    # Save data to MongoDB
-    print("Sending data to MongoDB Atlas...")
-
-    # Send all records at once for collection1
-    replace_database_collection(uri, db.name, collection1, records1)
-    print(f"Data sent to MongoDB Atlas for collection: {collection1}")
-
-    # Send all records at once for collection2
-    replace_database_collection(uri, db.name, collection2, records2)
-    print(f"Data sent to MongoDB Atlas for collection: {collection2}")
-
-    delete_folder(directory)
+    process_pdfs_to_mongodb_embedded(files_directory, collection1, collection2, name_with_gpt=True)
 
 #Embed and chunk PDFs of new reference articles (found from searching semantic scholar api) and send these chunks to mongoDB
 def process_new_pdfs_to_mongodb(files_directory, collection1, collection2):
     """
     Process PDFs to MongoDB (Using embeddings for retrieval)
     """
-    directory = 'doc'  # Fixed directory
-
-    pdf_list = read_pdf_file_list(files_directory)
-    #filenames = get_txt_names(files_directory)
-    
-    # Process and save PDFs
-    process_invalid_pdfs(pdf_list)
-    pdf_list = read_pdf_file_list(files_directory)
-    #print(pdf_list)
-    process_and_save_pdfs(pdf_list, directory)
-    filenames= get_txt_names(files_directory)
-
-
-    processed_texts = read_processed_texts(directory, filenames)
-    #processed_name = get_names(filenames, directory)
-    processed_name=list_pdf_bases('papers')
-    
-    
-
-    data = {'PDF File': processed_name, 'Text Content': processed_texts}
-    df = pd.DataFrame(data)
-    tqdm.pandas(desc="Processing Documents for Chunking")
-    df['text_chunks'] = df['Text Content'].apply(semantic_chunk)
-    
-    df_exploded = df.explode('text_chunks').drop(columns=['Text Content'])
-    
-    # Rename the columns for clarity
-    df_exploded.rename(columns={'text_chunks': 'Text Content'}, inplace=True)
-
-    # Embed
-    split_df = splitting(df_exploded, 'Text Content')
-    token_df = tokenize(split_df, 'Text Content')
-    chunki = chunking(token_df, 'Text Content', 8190)
-
-    emb=embed(chunki)
-
-    # Convert DataFrames to records
-    records1 = df_exploded.to_dict(orient='records')
-    records2 = emb.to_dict(orient='records')
-
-    # Save data to MongoDB
-    print("Sending data to MongoDB Atlas...")
-
-    # Send all records at once for collection1
-    replace_database_collection(uri, db.name, collection1, records1)
-    print(f"Data sent to MongoDB Atlas for collection: {collection1}")
-
-    # Send all records at once for collection2
-    replace_database_collection(uri, db.name, collection2, records2)
-    print(f"Data sent to MongoDB Atlas for collection: {collection2}")
-
-    delete_folder(directory)
+    process_pdfs_to_mongodb_embedded(files_directory, collection1, collection2, name_with_gpt=False)
 
 #Embed and chunk PDFs of reference articles (initial, uploaded by user) and send these chunks to mongoDB
 def process_pdfs_to_mongodb_noembed(files_directory, collection1):
@@ -131,34 +189,7 @@ def process_pdfs_to_mongodb_noembed(files_directory, collection1):
     Process PDFs into MongoDB (without using embeddings for retrieval).
     """
     try:
-        directory = 'doc'  # Fixed directory
-        delete_folder(directory)
-        pdf_list = read_pdf_file_list(files_directory)
-
-        # Example: show a simple progress bar for PDF processing
-        with tqdm(total=len(pdf_list), desc="Processing PDFs") as pbar:
-            process_and_save_pdfs(pdf_list, directory)
-            pbar.update(len(pdf_list))
-
-        filenames = get_txt_names(files_directory)
-        processed_texts = read_processed_texts(directory, filenames)
-        processed_name = get_names(filenames, directory)
-
-        data = {'PDF File': processed_name, 'Text Content': processed_texts}
-        df = pd.DataFrame(data)
-        df = process_dataframe_sc1(df)
-
-        df_exploded = df.explode('text_chunks').drop(columns=['Text Content'])
-        df_exploded.rename(columns={'text_chunks': 'Text Content'}, inplace=True)
-
-        records1 = df_exploded.to_dict(orient='records')
-
-        print("Sending data to MongoDB Atlas...")
-        replace_database_collection(uri, db.name, collection1, records1)
-        print(f"Data sent to MongoDB Atlas for collection: {collection1}")
-
-        delete_folder(directory)
-
+        process_pdfs_to_mongodb_chunked(files_directory, collection1, name_with_gpt=True)
     finally:
         # Force clear any leftover tqdm instances
         tqdm._instances.clear()
@@ -169,46 +200,7 @@ def process_pdfs_to_mongodb_noembed_new(files_directory, collection1, change_to_
     Process new PDFs into MongoDB (without using embeddings for retrieval).
     """
     try:
-        directory = 'doc'  # Fixed directory
-        delete_folder(directory)
-        pdf_list = read_pdf_file_list(files_directory)
-
-        # Process invalid PDFs (whatever that entails)
-        process_invalid_pdfs(pdf_list)
-
-        # Refresh PDF list after invalid ones are removed
-        pdf_list = read_pdf_file_list(files_directory)
-
-        # Example: show a simple progress bar for PDF processing
-        with tqdm(total=len(pdf_list), desc="Processing NEW PDFs") as pbar:
-            process_and_save_pdfs(pdf_list, directory)
-            pbar.update(len(pdf_list))
-
-        filenames = get_txt_names(files_directory)
-
-        processed_texts = read_processed_texts(directory, filenames)
-        processed_name = list_pdf_bases(files_directory)
-
-        data = {'PDF File': processed_name, 'Text Content': processed_texts}
-        df = pd.DataFrame(data)
-        df = process_dataframe_sc1(df)
-
-        df_exploded = df.explode('text_chunks').drop(columns=['Text Content'])
-        df_exploded.rename(columns={'text_chunks': 'Text Content'}, inplace=True)
-
-        records1 = df_exploded.to_dict(orient='records')
-
-        print("Sending data to MongoDB Atlas...")
-
-        if change_to_add:
-            insert_documents(uri, db.name, collection1, records1)
-        else:
-            replace_database_collection(uri, db.name, collection1, records1)
-
-        print(f"Data sent to MongoDB Atlas for collection: {collection1}")
-
-        delete_folder(directory)
-
+        process_pdfs_to_mongodb_chunked(files_directory, collection1, name_with_gpt=False, change_to_add=change_to_add)
     finally:
         # Force clear any leftover tqdm instances
         tqdm._instances.clear()
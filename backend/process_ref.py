@@ -11,6 +11,9 @@ import certifi
 from .gpt_rag_asyncio import *
 import asyncio
 from .mongo_client import MongoDBClient
+from .similarity import SimilarityIndex
+from .vector_index import VectorIndex, vector_index_path
+from bson import ObjectId
 
 #Please note that os.getenv(PDF) is sort of depreciated (not in use anymore)
 #Hence, I removed the PDF in my .env file. U will need to manually put in the PDF name in the following format:
@@ -24,29 +27,62 @@ uri = os.getenv("uri_mongo")
 client = MongoDBClient.get_client()
 db = client['data']
 
+chunk_projection = {'_id': 1, 'PDF File': 1, 'Text Content': 1, 'n_tokens': 1, 'Text Chunks': 1, 'embed_v3': 1}
+
+#top chunks of each statement within its paper(s), using the vector index of the collection so only the matched chunks are fetched
+#collections ingested before the index existed fall back to scanning the whole collection
+def retrieve_statement_chunks(collection_processed_name, statements, papers, top_n=10, threshold=0.5):
+    """
+    Args:
+        collection_processed_name (str): Collection of embedded chunks.
+        statements (list): Texts to search for.
+        papers (list): Per statement, the paper name (or list of names) to search in.
+
+    Returns:
+        list[pd.DataFrame]: Per statement, the matching chunks with a 'similarities_text' column, best first.
+    """
+    collection_processed = db[collection_processed_name]
+    papers = [[normalize_string(p) for p in paper] if isinstance(paper, list) else normalize_string(paper) for paper in papers]
+    index = VectorIndex.load(vector_index_path(collection_processed_name))
+    # Statements are embedded with the encoder of the stored chunks, vectors of different encoders do not compare
+    backend = index.backend if index is not None else get_embedding_backend(uri, db.name, collection_processed_name)
+    statement_embeddings = embed_texts(statements, desc="Embedding statements", backend=backend)
+    if index is None:
+        # Only the chunks of the searched papers are kept while the collection is streamed
+        wanted = {name for paper in papers for name in (paper if isinstance(paper, list) else [paper])}
+        df = read_filtered_dataframe(uri, db.name, collection_processed_name,
+                                     lambda batch: batch['PDF File'].astype(str).map(normalize_string).isin(wanted), chunk_projection)
+        return SimilarityIndex(df, group_column='PDF File', group_key=normalize_string).search_many(statement_embeddings, top_n, threshold, papers)
+
+    hits = index.search_many(statement_embeddings, top_n, threshold, papers)
+    ids = {chunk_id for chunk_ids, _ in hits for chunk_id in chunk_ids}
+    projection = {field: 1 for field in chunk_projection if field != 'embed_v3'}
+    documents = collection_processed.find({'_id': {'$in': [ObjectId(i) if ObjectId.is_valid(i) else i for i in ids]}}, projection)
+    by_id = {str(document['_id']): document for document in documents}
+    columns = list(projection) + ['similarities_text']
+    return [
+        pd.DataFrame(
+            [dict(by_id[chunk_id], similarities_text=float(score)) for chunk_id, score in zip(chunk_ids, scores) if chunk_id in by_id],
+            columns=columns
+        )
+        for chunk_ids, scores in hits
+    ]
+
 #chunked and embedded original refs database, new database name to store output
 #extracts statements and citations from main article then retrieves relevant chunks from embedded and chunked db using cos sim
 def process_old_references(collection_processed_name, collection_name):
     pdf_to_check = os.getenv("PDF")
     
-    # Get collections from MongoDB
-    collection_processed = db[collection_processed_name]
-
-    # Fetch documents from MongoDB
-    documents = list(collection_processed.find({}, {
-        '_id': 1, 'PDF File': 1, 'Text Content': 1, 'n_tokens': 1, 'Text Chunks': 1, 'embed_v3': 1
-    }))
-    df = pd.DataFrame(documents)
-    
     # Perform full cycle and get references
     text = full_cycle(pdf_to_check, filename="extracted")
     output = get_references(text)
     codable = ast.literal_eval(output)
 
+    # Every statement is embedded in one batch and searched against its paper only
+    matches = retrieve_statement_chunks(collection_processed_name, [code[0] for code in codable], [code[1] for code in codable], 10, 0.5)  # return top n, >0.5 cosine similarity of each pdf name
+
     dfs = []
-    for code in tqdm(codable, desc="Processing cosine similarity, re-ranking and pruning"):
-        pdf = retrieve_pdf(df, code)
-        similiar = retrieve_similar_text_threshold_old(pdf, code, 10, 0.5)  # return top n, >0.5 cosine similarity of each pdf name
+    for code, similiar in tqdm(zip(codable, matches), total=len(codable), desc="Processing cosine similarity, re-ranking and pruning"):
         lstchunk = similiar['Text Content'].tolist()
         date = int(code[2])
         index_reassigned = ast.literal_eval(rank_and_check(code[0], lstchunk))
@@ -93,16 +129,12 @@ def process_new_references(collection_processed_name, new_collection_name, colle
     output_directory = 'backend'  # Fixed output directory
     
     # Get collections from MongoDB
-    collection_processed = db[collection_processed_name]
-    collection_f=db[collection_found]
     # Fetch documents from MongoDB
-    documents1 = list(collection_processed.find({}, {'_id': 1, 'PDF File': 1, 'Text Content': 1, 'n_tokens': 1, 'Text Chunks': 1, 'embed_v3': 1 }))
-    df = pd.DataFrame(documents1)
-
-    documents2=list(collection_f.find({},{'_id': 1, 'Title of original reference article': 1, 'Text in main article referencing reference article': 1, 'Year reference article released': 1, 'Keywords for graph paper search': 1, 'Paper Id of new reference article found': 1, 'Title of new reference article found': 1, 'Year new reference article found published': 1, 'downloadable': 1, 'externalId_of_undownloadable_paper': 1, 'reason_for_failure': 1, 'pdf_url':1}))
-
-    df_found=pd.DataFrame(documents2)
-    df=replace_pdf_file_with_title(df, df_found)
+    df_found=read_dataframe(uri, db.name, collection_found, {'_id': 1, 'Title of original reference article': 1, 'Text in main article referencing reference article': 1, 'Year reference article released': 1, 'Keywords for graph paper search': 1, 'Paper Id of new reference article found': 1, 'Title of new reference article found': 1, 'Year new reference article found published': 1, 'downloadable': 1, 'externalId_of_undownloadable_paper': 1, 'reason_for_failure': 1, 'pdf_url':1})
+    # Chunks are stored under the paper id, a statement searches every paper with the title it was found under
+    title_to_papers = {}
+    for paper_id, title in zip(df_found['Paper Id of new reference article found'], df_found['Title of new reference article found']):
+        title_to_papers.setdefault(normalize_string(str(title)), []).append(str(paper_id))
     df_found=update_downloadable_status_invalid(df_found)
     df_found = df_found[df_found['downloadable'] != 'no']
     df_found = df_found[df_found['Paper Id of new reference article found'] != '']
@@ -113,16 +145,16 @@ def process_new_references(collection_processed_name, new_collection_name, colle
         title=row['Title of new reference article found']
         year=row['Year new reference article found published']
         codable.append([text,title,year])
-        dfs = []
-    for code in tqdm(codable, desc="Processing cosine similarity, re-ranking and pruning"):
-        pdf = retrieve_pdf(df, code)
+    dfs = []
+
+    # Retrieve similar texts with threshold, all statements at once
+    papers = [[code[1]] + title_to_papers.get(normalize_string(code[1]), []) for code in codable]
+    matches = retrieve_statement_chunks(collection_processed_name, [code[0] for code in codable], papers, 10, 0.5)
+    for code, similiar in tqdm(zip(codable, matches), total=len(codable), desc="Processing cosine similarity, re-ranking and pruning"):
         print(code[1])
         
-        # Retrieve similar texts with threshold
-        similiar = retrieve_similar_text_threshold(pdf, code, 10, 0.5)
-        
-        # Only proceed if similiar is not None and contains 'Text Content'
-        if similiar is not None and 'Text Content' in similiar.columns:
+        # Only proceed if the paper has chunks (an empty result means it was not downloaded)
+        if not similiar.empty and 'Text Content' in similiar.columns:
             lstchunk = similiar['Text Content'].tolist()
             date = int(code[2])
             index_reassigned = ast.literal_eval(rank_and_check(code[0], lstchunk))
@@ -0,0 +1,134 @@
+import asyncio
+import time
+import threading
+import logging
+
+#process-wide token bucket rate limiter for Azure OpenAI quotas (requests per minute and tokens per minute)
+logging.basicConfig(level=logging.INFO)
+
+
+class RateLimiter:
+    """
+    Token bucket limiter for Azure OpenAI deployments.
+
+    Two buckets are kept: one for requests (RPM) and one for tokens (TPM). Both refill continuously.
+    State is guarded by a threading lock instead of asyncio primitives because the pipeline runs
+    coroutines on several event loops (asyncio.run in worker threads), and waiting is done with
+    asyncio.sleep outside the lock so no loop is ever blocked.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, name='azure'):
+        self.name = name
+        self.requests_per_minute = float(requests_per_minute)
+        self.tokens_per_minute = float(tokens_per_minute)
+        self._requests_available = self.requests_per_minute
+        self._tokens_available = self.tokens_per_minute
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests_available = min(
+            self.requests_per_minute,
+            self._requests_available + elapsed * self.requests_per_minute / 60
+        )
+        self._tokens_available = min(
+            self.tokens_per_minute,
+            self._tokens_available + elapsed * self.tokens_per_minute / 60
+        )
+
+    def _reserve(self, tokens):
+        """Try to take capacity for one request. Returns 0 on success, otherwise seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if self._requests_available >= 1 and self._tokens_available >= tokens:
+                self._requests_available -= 1
+                self._tokens_available -= tokens
+                return 0
+            request_wait = max(0.0, (1 - self._requests_available) * 60 / self.requests_per_minute)
+            token_wait = max(0.0, (tokens - self._tokens_available) * 60 / self.tokens_per_minute)
+            return max(request_wait, token_wait, 0.01)
+
+    async def acquire(self, tokens=0):
+        """
+        Wait until one request costing `tokens` tokens fits in the quota.
+
+        Args:
+            tokens (int): Estimated tokens of the request (prompt + expected completion).
+        """
+        # A request larger than the whole bucket could otherwise never be dispatched
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            wait = self._reserve(tokens)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def acquire_blocking(self, tokens=0):
+        """Synchronous version of acquire for code paths that are not async."""
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            wait = self._reserve(tokens)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    def update_from_headers(self, headers):
+        """
+        Adapt to the quota the server reports so that other processes sharing the deployment are accounted for.
+
+        Args:
+            headers (Mapping): Response headers (x-ratelimit-remaining-*, Retry-After).
+        """
+        if headers is None:
+            return
+        remaining_requests = _to_float(headers.get('x-ratelimit-remaining-requests'))
+        remaining_tokens = _to_float(headers.get('x-ratelimit-remaining-tokens'))
+        with self._lock:
+            self._refill(time.monotonic())
+            if remaining_requests is not None:
+                self._requests_available = min(self._requests_available, remaining_requests)
+            if remaining_tokens is not None:
+                self._tokens_available = min(self._tokens_available, remaining_tokens)
+        retry_after = retry_after_seconds(headers)
+        if retry_after:
+            self.block_for(retry_after)
+
+    def block_for(self, seconds):
+        """Stop dispatching for `seconds` (used on 429 responses) and empty the buckets."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._blocked_until = max(self._blocked_until, now + seconds)
+            self._requests_available = 0.0
+            self._tokens_available = 0.0
+        logging.warning(f"Rate limiter '{self.name}' paused for {seconds:.1f} seconds.")
+
+
+def _to_float(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_seconds(headers):
+    """
+    Read the retry delay from response headers (retry-after-ms takes precedence over Retry-After).
+
+    Returns:
+        float: Seconds to wait, or None if no usable header is present.
+    """
+    if headers is None:
+        return None
+    retry_after_ms = _to_float(headers.get('retry-after-ms'))
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    return _to_float(headers.get('Retry-After'))
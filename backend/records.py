@@ -0,0 +1,100 @@
+from dataclasses import dataclass, fields
+from typing import Any, ClassVar
+import pandas as pd
+
+#lightweight result records of the async LLM fan-outs: one slotted object per answer instead of a one-row DataFrame,
+#collected column by column and turned into a DataFrame (or Mongo records) once at the end
+
+
+# Result of sieving one chunk against one statement (gpt_retrievesieve.process_row_async)
+@dataclass(slots=True)
+class SieveResult:
+    article_name: Any
+    statement: Any
+    sieved: Any
+    chunk: Any
+    date: Any
+
+    columns: ClassVar[tuple] = ('Reference article name', 'Reference text in main article', 'Sieving by gpt 4o', 'Chunk', 'Date')
+
+
+# Statement rewritten for a replaced reference (expert_decision.process_row_async_final)
+@dataclass(slots=True)
+class ReplaceResult:
+    original_statement: Any
+    statement: Any
+    reference: Any
+
+    columns: ClassVar[tuple] = ('statement', 'Statement', 'Reference')
+
+
+# Citation created for an edited statement (expert_decision.process_row_async_edit)
+@dataclass(slots=True)
+class EditResult:
+    statement: Any
+    edit: Any
+    reference: Any
+
+    columns: ClassVar[tuple] = ('statement', 'Edit', 'Reference')
+
+
+# Summary of an old top 5 row, no authors (expert_decision.process_row_async_summary)
+@dataclass(slots=True)
+class SummaryResult:
+    sentiment: Any
+    sieved: Any
+    chunk: Any
+    article_name: Any
+    statement: Any
+    summary: Any
+    date: Any
+
+    columns: ClassVar[tuple] = ('Sentiment', 'Sieving by gpt 4o', 'Chunk', 'Reference article name',
+                                'Reference text in main article', 'Summary', 'Date')
+
+
+# Summary of a new top 5 row, with its authors and paper id
+@dataclass(slots=True)
+class AuthoredSummaryResult:
+    sentiment: Any
+    sieved: Any
+    chunk: Any
+    article_name: Any
+    statement: Any
+    summary: Any
+    authors: Any
+    date: Any
+    paper_id: Any
+
+    columns: ClassVar[tuple] = ('Sentiment', 'Sieving by gpt 4o', 'Chunk', 'Reference article name',
+                                'Reference text in main article', 'Summary', 'authors', 'Date', 'Paper Id')
+
+
+class RecordColumns:
+    """
+    Columnar accumulator of result records of one type: every append adds one value to a list per column,
+    the DataFrame is built once from the lists.
+    """
+    __slots__ = ('names', 'values')
+
+    def __init__(self, record_type):
+        self.names = tuple(field.name for field in fields(record_type))
+        self.values = {column: [] for column in record_type.columns}
+
+    def append(self, record):
+        for name, values in zip(self.names, self.values.values()):
+            values.append(getattr(record, name))
+
+    def __len__(self):
+        return len(next(iter(self.values.values()), ()))
+
+    def to_dataframe(self):
+        """Returns the records as a DataFrame, an empty DataFrame if there are none."""
+        if not len(self):
+            return pd.DataFrame()
+        return pd.DataFrame(self.values)
+
+    def to_records(self):
+        """Returns the records as a list of dicts, the Mongo batch for insert_documents and replace_database_collection."""
+        columns = list(self.values)
+        return [dict(zip(columns, row)) for row in zip(*self.values.values())]
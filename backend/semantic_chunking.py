@@ -1,16 +1,22 @@
-from semantic_router.encoders import AzureOpenAIEncoder
 from dotenv import load_dotenv
 import os
 import logging
+import threading
 from semantic_chunkers import StatisticalChunker
 import asyncio
-from tqdm.asyncio import tqdm_asyncio
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import random
 from openai import AuthenticationError
-from .token_manager import get_or_refresh_token 
+from .token_manager import get_or_refresh_token
+from .embedding import embed_texts, get_tokenizer, resolve_backend
+from .local_encoder import local_encoder_name
+
+try:
+    from semantic_router.encoders import DenseEncoder
+except ImportError:  # older semantic-router releases
+    from semantic_router.encoders import BaseEncoder as DenseEncoder
 
 # Load environment variables from .env file
 load_dotenv()
@@ -19,47 +25,91 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
 # Azure configurations from environment variables
-az_path = os.getenv("az_path")  # Path to Azure CLI
-endpoint = os.getenv("endpoint")  # Azure OpenAI endpoint
-api_version = os.getenv("ver")  # Azure API version
 embed_model = os.getenv("embed_model")  # Model name for embeddings
+# Documents whose splits are embedded together before they are chunked
+chunk_batch_size = int(os.getenv("chunk_batch_size", 20))
+# How chunk embeddings are made: 'mean' (token-weighted mean of the split embeddings the chunker already computed)
+# or 'reembed' (embed the chunk text again)
+chunk_embedding_mode = os.getenv("chunk_embedding_mode", "mean")
 
-# Global variables
-encoder = None
-iteration_count = 0  # Keeps track of the number of iterations
-max_iterations_before_reset = 50  # Adjust this number based on your observations and use case
+# Bump when chunking changes so that incremental ingestion re-chunks every file
+chunker_version = "statistical-1"
 
-# Loading bar so you won't wait blindly
-async def async_delay_with_loading_bar(delay_seconds):
-    """
-    Asynchronously delay for a given number of seconds while displaying a loading bar.
+# Global variables: one encoder per encoder backend for the lifetime of the process. Chunkers are not shared,
+# StatisticalChunker keeps the statistics and threshold of the document it is splitting on the instance
+encoders = {}
+encoder_lock = threading.Lock()
 
-    Args:
-        delay_seconds (int): Number of seconds to wait with the loading bar.
+
+class BatchedEncoder(DenseEncoder):
+    """
+    Encoder for the StatisticalChunker that goes through embedding.embed_texts, so split embeddings
+    share the embedding rate limiter, token refresh, request packing and cache with the rest of the pipeline
+    (or are computed on the CPU with the local backend).
     """
-    for _ in tqdm_asyncio(range(delay_seconds), desc=f"Waiting for {delay_seconds} seconds", unit="s"):
-        await asyncio.sleep(1)
+    name: str = embed_model or "text-embedding-3-large"
+    score_threshold: float = 0.82
+    type: str = "azure"
+
+    def __call__(self, docs):
+        return embed_texts(docs, model=self.name, desc="Embedding splits", backend=self.type)
+
+
+def get_encoder(backend=None):
+    backend = resolve_backend(backend)
+    with encoder_lock:
+        if backend not in encoders:
+            encoders[backend] = BatchedEncoder(type=backend) if backend == 'azure' else BatchedEncoder(name=local_encoder_name, type=backend)
+            logging.info(f"Split encoder initialized successfully ({backend} encoder).")
+    return encoders[backend]
+
+# A new chunker for every document (cheap, it only holds the shared encoder and a regex splitter)
+def new_chunker(backend=None):
+    return StatisticalChunker(encoder=get_encoder(backend))
 
 async def initialize_encoder():
-    global encoder
-    encoder = None
     await get_or_refresh_token()  # Ensure token is valid
-    access_token = os.environ.get('AZURE_OPENAI_API_KEY')
-    if access_token:
-        encoder = AzureOpenAIEncoder(
-            deployment_name=embed_model,
-            model='text-embedding-3-large',
-            api_key=access_token,
-            azure_endpoint=endpoint,
-            api_version=api_version
-        )
-        logging.info("Azure OpenAI Encoder initialized successfully.")
-    else:
-        logging.error("Failed to initialize encoder due to token refresh issues.")
+    await asyncio.to_thread(get_encoder)
+
+# Helper function to split a document into sentences the way the chunker does before embedding them.
+# StatisticalChunker._split is private to semantic_chunkers: a release without it (or with another signature)
+# returns None and only turns the prefetch off
+def chunker_splits(chunker, text):
+    splitter = getattr(chunker, '_split', None)
+    if splitter is None:
+        return None
+    try:
+        splits = splitter(text)
+    except TypeError:
+        return None
+    if not isinstance(splits, list) or not all(isinstance(split, str) for split in splits):
+        return None
+    return splits
+
+# Helper function to embed the splits of many documents in a few large requests.
+# The chunker then finds every split in the embedding cache instead of sending one small request per document.
+def prefetch_split_embeddings(texts, backend=None):
+    chunker = new_chunker(backend)
+    if chunker.encoder.type == 'local':
+        return
+    try:
+        splits = []
+        for text in texts:
+            if not isinstance(text, str) or not text:
+                continue
+            text_splits = chunker_splits(chunker, text)
+            if text_splits is None:
+                logging.warning("This semantic_chunkers release does not expose the chunker's splitter, splits are not prefetched.")
+                return
+            splits += text_splits
+        if splits:
+            chunker.encoder(splits)
+    except Exception as e:
+        # Not fatal, the chunker embeds whatever is missing on its own
+        logging.warning(f"Prefetching split embeddings failed: {e}")
 
 # Function to retry operations with token refresh on Unauthorized error
 async def retry_on_exception(func, *args, max_retries=3, retry_delay=10, **kwargs):
-    global iteration_count
     attempt = 0
     base_delay = retry_delay
     while attempt < max_retries:
@@ -67,22 +117,14 @@ async def retry_on_exception(func, *args, max_retries=3, retry_delay=10, **kwarg
             logging.info(f"Attempting {func.__name__} (Attempt {attempt + 1}/{max_retries})...")
             await get_or_refresh_token()  # Ensure the access token is valid before each attempt
 
-            # Reset client if too many iterations have been reached
-            await check_and_reset_encoder()
-
             # Try executing the async function
-            result = await func(*args, **kwargs)
-
-            # Increment iteration count on successful execution
-            iteration_count += 1
-            return result
+            return await func(*args, **kwargs)
 
         except AuthenticationError as auth_err:
             logging.error(f"Authentication error occurred: {auth_err}")
             if 'statusCode' in auth_err.error and auth_err.error['statusCode'] == 401:
                 logging.warning("Unauthorized error detected. Refreshing access token and retrying...")
                 await get_or_refresh_token()
-                await initialize_encoder()
 
         except Exception as e:
             error_message = str(e)
@@ -91,7 +133,6 @@ async def retry_on_exception(func, *args, max_retries=3, retry_delay=10, **kwarg
             if "401" in error_message or "Unauthorized" in error_message:
                 logging.warning("Unauthorized error detected. Forcefully fetching a new access token and retrying...")
                 await get_or_refresh_token()
-                await initialize_encoder()
             elif "429" in error_message or "Too Many Requests" in error_message:
                 logging.warning("Rate limit error detected. Checking for Retry-After header...")
                 retry_after = extract_retry_after(e)  # Extract the Retry-After delay if available
@@ -112,14 +153,6 @@ async def retry_on_exception(func, *args, max_retries=3, retry_delay=10, **kwarg
     logging.error(f"All {max_retries} attempts failed for {func.__name__}. Returning None.")
     return None
 
-async def check_and_reset_encoder():
-    global iteration_count
-
-    if iteration_count >= max_iterations_before_reset:
-        logging.info("Resetting encoder due to high number of iterations to prevent resource leaks.")
-        await initialize_encoder()  # Re-initialize the client
-        iteration_count = 0
-
 def extract_retry_after(exception):
     """
     Extracts the Retry-After delay from an exception or response headers.
@@ -138,51 +171,86 @@ def extract_retry_after(exception):
                 return None
     return None
 
-# Function to perform semantic chunking using the initialized encoder
-async def semantic_chunk(content):
-    global encoder
-    if encoder is None:
-        await initialize_encoder()
-
+# Function to perform semantic chunking with a chunker of its own, each chunk is returned as its list of splits
+async def semantic_chunk_splits(content, backend=None):
     try:
         # Run the StatisticalChunker in a separate thread to avoid blocking the event loop
-        chunker = await asyncio.to_thread(StatisticalChunker, encoder=encoder)
-
-        # Call the chunker and process the content
-        chunks_async = await asyncio.to_thread(chunker, docs=[content])
-
-        # Process and return the chunked content
-        chunked = []
-        for chunk in chunks_async[0]:
-            c = chunk.splits
-            k = ''.join(c)
-            chunked.append(k)
+        chunks_async = await asyncio.to_thread(new_chunker(backend), docs=[content])
 
         logging.info("Chunking completed for one document.")
-        return chunked
-
-    except AuthenticationError as auth_err:
-        logging.error(f"Authentication error occurred in StatisticalChunker: {auth_err}")
-        if 'statusCode' in auth_err.error and auth_err.error['statusCode'] == 401:
-            logging.warning("Unauthorized error detected. Forcefully fetching a new access token and retrying...")
-
-            await get_or_refresh_token()
-            await initialize_encoder()
-
-            # Retry the chunking operation after re-initialization
-            return await semantic_chunk(content)
+        return [list(chunk.splits) for chunk in chunks_async[0]]
 
     except Exception as e:
         # Catch any other errors, log them, and handle retry if needed
         logging.error(f"Error occurred in StatisticalChunker: {e}")
         raise  # Re-raise the exception or handle it based on the scenario
 
+# Function to perform semantic chunking
+async def semantic_chunk(content, backend=None):
+    return [''.join(splits) for splits in await semantic_chunk_splits(content, backend)]
+
+# Helper function to embed the chunks of many documents.
+# In 'mean' mode no request is made: the splits were embedded by the chunker and are read back from the cache.
+def chunk_embeddings(docs_splits, mode=chunk_embedding_mode, backend=None):
+    """
+    Args:
+        docs_splits (list): Per document, its chunks as lists of splits (None for a document that failed).
+        mode (str): 'mean' or 'reembed', see chunk_embedding_mode.
+        backend (str): Encoder backend the documents were chunked with.
+
+    Returns:
+        list: Per document, one embedding (list of floats) per chunk (None for a document that failed).
+    """
+    chunks = [splits for doc in docs_splits if doc is not None for splits in doc]
+    if not chunks:
+        return [None if doc is None else [] for doc in docs_splits]
+    try:
+        vectors = _chunk_vectors(chunks, mode, backend)
+    except Exception as e:
+        # Chunks without an embedding are embedded later by the retrieval paths that need one
+        logging.warning(f"Chunk embeddings could not be computed: {e}")
+        vectors = [None] * len(chunks)
+
+    results = []
+    position = 0
+    for doc in docs_splits:
+        if doc is None:
+            results.append(None)
+        else:
+            results.append(vectors[position:position + len(doc)])
+            position += len(doc)
+    return results
+
+#helper function: one vector per chunk (a chunk is its list of splits)
+def _chunk_vectors(chunks, mode, backend=None):
+    encoder = get_encoder(backend)
+    if mode == 'reembed':
+        vectors = encoder([''.join(splits) for splits in chunks])
+    else:
+        splits = [split for chunk in chunks for split in chunk]
+        split_vectors = np.asarray(encoder(splits), dtype=np.float32)
+        if encoder.type == 'local':
+            # Stay offline: words instead of tokens
+            weights = np.array([max(len(split.split()), 1) for split in splits], dtype=np.float32)
+        else:
+            tokenizer = get_tokenizer()
+            weights = np.array([max(len(tokenizer.encode(split)), 1) for split in splits], dtype=np.float32)
+        # Sum the weighted split vectors of every chunk in one pass
+        owners = np.repeat(np.arange(len(chunks)), [len(chunk) for chunk in chunks])
+        sums = np.zeros((len(chunks), split_vectors.shape[1]), dtype=np.float32)
+        np.add.at(sums, owners, split_vectors * weights[:, None])
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        # Unit length like the vectors returned by the API
+        vectors = (sums / norms).tolist()
+    return vectors
+
 MAX_RETRIES = 3
 
 # Wrapper async function for semantic chunking with error handling
-async def semanchunk(text, doc_index, failed_docs, retries=0):
+async def semanchunk(text, doc_index, failed_docs, retries=0, backend=None):
     try:
-        return await retry_on_exception(semantic_chunk, text)  # Call the async semantic_chunk function
+        return await retry_on_exception(semantic_chunk_splits, text, backend)  # Call the async semantic_chunk_splits function
     except Exception as e:
         logging.error(f"Error in semanchunk for document index {doc_index}: {e}")
 
@@ -194,17 +262,18 @@ async def semanchunk(text, doc_index, failed_docs, retries=0):
         return None
 
 # Async function to process each batch of the DataFrame
-async def process_batch(batch_df, semaphore, failed_docs):
+async def process_batch(batch_df, semaphore, failed_docs, backend=None):
     async with semaphore:
         # Use asyncio.gather to run all document chunking operations in parallel
-        tasks = [semanchunk(row['Text Content'], idx, failed_docs) for idx, row in batch_df.iterrows()]
+        tasks = [semanchunk(row['Text Content'], idx, failed_docs, backend=backend) for idx, row in batch_df.iterrows()]
         results = await asyncio.gather(*tasks, return_exceptions=True)  # Run all tasks concurrently
         return results
 
 # Async function to process the DataFrame in batches
-async def process_dataframe_in_batches_async(df, batch_size=5, batch_delay=5):
+async def process_dataframe_in_batches_async(df, batch_size=chunk_batch_size, backend=None):
     """
-    Process the DataFrame in batches asynchronously.
+    Process the DataFrame in batches asynchronously. The splits of the next batch are embedded
+    while the current batch is chunked, pacing is left to the embedding rate limiter.
     """
     num_batches = int(np.ceil(len(df) / batch_size))
     batch_dfs = [df[i * batch_size:(i + 1) * batch_size] for i in range(num_batches)]
@@ -213,23 +282,29 @@ async def process_dataframe_in_batches_async(df, batch_size=5, batch_delay=5):
     failed_docs = []  # List to keep track of failed documents for retry
     semaphore = asyncio.Semaphore(3)  # Limit the number of concurrent batches processed
 
+    await asyncio.to_thread(get_encoder, backend)
+    prefetch = None
+    if batch_dfs:
+        prefetch = asyncio.create_task(asyncio.to_thread(prefetch_split_embeddings, batch_dfs[0]['Text Content'].tolist(), backend))
+
     # Use standard tqdm for processing batches
     for i, batch in enumerate(tqdm(batch_dfs, desc="Processing Batches", unit="batch", total=num_batches)):
-        batch_results = await process_batch(batch, semaphore, failed_docs)
+        await prefetch
+        if i + 1 < num_batches:
+            prefetch = asyncio.create_task(asyncio.to_thread(prefetch_split_embeddings, batch_dfs[i + 1]['Text Content'].tolist(), backend))
+        batch_results = await process_batch(batch, semaphore, failed_docs, backend)
         # Store results in the original DataFrame's order
         for idx, result in zip(batch.index, batch_results):
             all_results[idx] = result
-        await initialize_encoder()
-        logging.info(f"Chunking completed for one batch. Added a {batch_delay}-second delay before next operation.")
-        await async_delay_with_loading_bar(batch_delay)
+        logging.info("Chunking completed for one batch.")
 
     # Retry failed documents after processing all batches
-    await retry_failed_documents(failed_docs, all_results)
+    await retry_failed_documents(failed_docs, all_results, backend)
 
     return all_results
 
 # Async function to retry failed documents after initial processing
-async def retry_failed_documents(failed_docs, all_results):
+async def retry_failed_documents(failed_docs, all_results, backend=None):
     retry_count = 0
 
     # Continue retrying until all documents are processed or max retries are reached
@@ -242,7 +317,7 @@ async def retry_failed_documents(failed_docs, all_results):
         for doc_index, text, retries in tqdm(current_failed_docs, desc=f"Retrying Failed Documents (Attempt {retry_count + 1})"):
             # Retry processing the failed document
             try:
-                result = await semanchunk(text, doc_index, failed_docs, retries=retries)
+                result = await semanchunk(text, doc_index, failed_docs, retries=retries, backend=backend)
                 if result is not None:
                     all_results[doc_index] = result  # Update result in the main results list
             except Exception as e:
@@ -251,9 +326,10 @@ async def retry_failed_documents(failed_docs, all_results):
         retry_count += 1
 
 # Synchronous wrapper function to process the DataFrame
-def process_dataframe_sc1(df, batch_size=5, batch_delay=5):
+def process_dataframe_sc1(df, batch_size=chunk_batch_size, backend=None):
     # Run the async function synchronously
-    results = asyncio.run(process_dataframe_in_batches_async(df, batch_size=batch_size, batch_delay=batch_delay))
-    # Assign results back to the DataFrame
-    df['text_chunks'] = results
+    results = asyncio.run(process_dataframe_in_batches_async(df, batch_size=batch_size, backend=backend))
+    # Assign results back to the DataFrame, with the embedding of every chunk next to it
+    df['text_chunks'] = [None if splits is None else [''.join(chunk) for chunk in splits] for splits in results]
+    df['chunk_embeddings'] = chunk_embeddings(results, backend=backend)
     return df
@@ -0,0 +1,154 @@
+import ast
+import json
+import numpy as np
+import pandas as pd
+
+#vectorised cosine similarity search over chunk embeddings (one matrix product per paper instead of a python call per row)
+
+
+# Helper function to parse a stored embedding (list, array or its string form) without eval
+def to_float32_vector(obj, dtype=np.float32):
+    if isinstance(obj, str):
+        try:
+            obj = json.loads(obj)
+        except ValueError:
+            obj = ast.literal_eval(obj)
+    return np.asarray(obj, dtype=dtype)
+
+
+# Helper function to scale rows to unit length so that a dot product is the cosine similarity
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+# Helper function to pick the rows to return for one query, same rules as search_docs_text_threshold
+def select_top(similarities, top_n, threshold=None):
+    """
+    Args:
+        similarities (np.ndarray): Cosine similarity of every candidate row.
+        top_n (int): Maximum number of rows to return.
+        threshold (float): Only rows above it are returned. If none are, every row with the top similarity is.
+
+    Returns:
+        np.ndarray: Positions into `similarities`, best first.
+    """
+    if similarities.size == 0:
+        return np.empty(0, dtype=np.intp)
+    if threshold is None:
+        candidates = np.arange(similarities.size)
+    else:
+        candidates = np.flatnonzero(similarities > threshold)
+        if candidates.size == 0:
+            return np.flatnonzero(similarities == similarities.max())
+    if candidates.size > top_n:
+        # argpartition finds the top n in linear time, only those are sorted
+        candidates = candidates[np.argpartition(-similarities[candidates], top_n - 1)[:top_n]]
+    return candidates[np.argsort(-similarities[candidates], kind='stable')]
+
+
+class SimilarityIndex:
+    """
+    Chunk embeddings of a DataFrame kept as one pre-normalised, contiguous float32 matrix.
+    Rows are grouped by paper so that the chunks of a paper are a contiguous slice of the matrix,
+    and a query against one paper is a single matrix-vector (or matrix-matrix for many queries) product.
+    """
+
+    def __init__(self, df, embedding_column='embed_v3', group_column=None, group_key=None):
+        """
+        Args:
+            df (pd.DataFrame): Chunks with an embedding column.
+            embedding_column (str): Column holding the embeddings.
+            group_column (str): Column to group rows by (e.g. 'PDF File'), None for a single group.
+            group_key (callable): Applied to group values and queried groups before matching (e.g. normalize_string).
+        """
+        self.group_key = group_key or (lambda value: value)
+        df = df.reset_index(drop=True)
+        # Group -> (start, stop) of its slice in the matrix
+        self.groups = {}
+        if group_column is not None and not df.empty:
+            keys = df[group_column].map(self.group_key).astype(str)
+            order = np.argsort(keys.to_numpy(), kind='stable')
+            df = df.iloc[order].reset_index(drop=True)
+            for position, key in enumerate(keys.to_numpy()[order]):
+                start, _ = self.groups.get(key, (position, position))
+                self.groups[key] = (start, position + 1)
+        self.df = df
+        self.matrix = self._build_matrix(df[embedding_column] if embedding_column in df else pd.Series(dtype=object))
+
+    @staticmethod
+    def _build_matrix(embeddings):
+        vectors = [to_float32_vector(value) if isinstance(value, (list, tuple, np.ndarray, str)) else None for value in embeddings]
+        dimension = next((vector.size for vector in vectors if vector is not None), 0)
+        matrix = np.zeros((len(vectors), dimension), dtype=np.float32)
+        for i, vector in enumerate(vectors):
+            # Rows without an embedding stay zero and never match
+            if vector is not None and vector.size == dimension:
+                matrix[i] = vector
+        return np.ascontiguousarray(normalize_rows(matrix))
+
+    def ranges(self, group=None):
+        """
+        (start, stop) slices of the matrix holding a group, or several groups if a list is given
+        (the whole matrix if no group is given).
+        """
+        if group is None:
+            return ((0, len(self.df)),)
+        groups = group if isinstance(group, (list, tuple, set)) else [group]
+        keys = dict.fromkeys(str(self.group_key(g)) for g in groups)
+        return tuple(self.groups[key] for key in keys if key in self.groups)
+
+    def _result(self, rows, positions, similarities):
+        res = self.df.iloc[rows[positions]].copy()
+        res["similarities_text"] = similarities[positions].astype(float)
+        return res
+
+    def search(self, query_vector, top_n, threshold=None, group=None):
+        """
+        Find the chunks most similar to one query.
+
+        Returns:
+            pd.DataFrame: Matching rows with a 'similarities_text' column, best first.
+        """
+        return self.search_many([query_vector], top_n, threshold, [group])[0]
+
+    def search_many(self, query_vectors, top_n, threshold=None, groups=None):
+        """
+        Find the chunks most similar to many queries, each optionally restricted to one or more groups.
+        Queries that target the same group are answered with one matrix-matrix product.
+
+        Args:
+            query_vectors (list): Query embeddings.
+            top_n (int): Maximum number of rows per query.
+            threshold (float): See select_top.
+            groups (list): Group (or list of groups) of every query, None to search every row.
+
+        Returns:
+            list[pd.DataFrame]: One result per query, in order.
+        """
+        if groups is None:
+            groups = [None] * len(query_vectors)
+        results = [None] * len(query_vectors)
+        if len(query_vectors) == 0:
+            return results
+        queries = normalize_rows(np.vstack([to_float32_vector(vector) for vector in query_vectors]))
+
+        # Queries that target the same rows share one product
+        by_ranges = {}
+        for i, group in enumerate(groups):
+            by_ranges.setdefault(self.ranges(group), []).append(i)
+
+        for ranges, query_ids in by_ranges.items():
+            rows = np.concatenate([np.arange(start, stop) for start, stop in ranges]) if ranges else np.empty(0, dtype=np.intp)
+            if rows.size == 0 or self.matrix.shape[1] == 0:
+                for i in query_ids:
+                    results[i] = self._result(rows, np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32))
+                continue
+            # A single group is a contiguous slice, so no copy of the matrix is made
+            block = self.matrix[ranges[0][0]:ranges[0][1]] if len(ranges) == 1 else self.matrix[rows]
+            similarities = block @ queries[query_ids].T
+            for column, i in enumerate(query_ids):
+                scores = similarities[:, column]
+                results[i] = self._result(rows, select_top(scores, top_n, threshold), scores)
+        return results
@@ -2,6 +2,7 @@ import os
 import pandas as pd
 from dotenv import load_dotenv
 from pymongo import MongoClient
+from .mongo_client import MongoDBClient
 from tqdm import tqdm
 from .pdf import *
 from .gpt_rag import *
@@ -20,7 +21,7 @@ database='data'
 def main():
     # Get MongoDB URI from environment variables
     uri = os.getenv("uri_mongo")
-    client = MongoClient(uri, tls=True, tlsCAFile=certifi.where())
+    client = MongoDBClient.get_client(uri)
     db = client['data']
     
     # Get collections from MongoDB
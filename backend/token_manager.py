@@ -1,9 +1,11 @@
 # token_manager.py
 
 import asyncio
+import concurrent.futures
 import os
 import time
 import logging
+import threading
 from dotenv import load_dotenv
 import subprocess
 """Universal token manager"""
@@ -16,76 +18,194 @@ endpoint = os.getenv("endpoint")
 api_version = os.getenv("ver")
 az_path = os.getenv("az_path", "az")  # Default to 'az' if not specified
 
-class TokenManager:
-    def __init__(self):
-        self.access_token = None
-        self.token_expiry_time = None
-        self.token_lock = asyncio.Lock()  # Use asyncio.Lock
-        self.refresh_in_progress = asyncio.Event()
-        self.refresh_in_progress.clear()
-        self.azure_endpoint = endpoint
-        self.api_version = api_version
+# Tokens are treated as valid for 25 minutes and refreshed 5 minutes before that
+token_lifetime = 1500
+refresh_margin = 300
+
+
+class AzureCliCredentialProvider:
+    """
+    Fetches Azure OpenAI access tokens with the Azure CLI.
+    The async path uses asyncio.create_subprocess_exec so the event loop keeps serving requests
+    while the CLI runs.
+    """
+
+    def __init__(self, az_path=az_path, resource='https://cognitiveservices.azure.com'):
         self.az_path = az_path
+        self.resource = resource
 
-    def get_azure_access_token(self):
-        """
-        Synchronously fetches a new Azure access token using the Azure CLI.
-        """
+    def _command(self):
+        return [
+            self.az_path, 'account', 'get-access-token',
+            '--resource', self.resource,
+            '--query', 'accessToken', '-o', 'tsv'
+        ]
+
+    async def get_token(self):
         try:
             logging.info("Fetching Azure OpenAI access token...")
-            result = subprocess.run(
-                [
-                    self.az_path, 'account', 'get-access-token',
-                    '--resource', 'https://cognitiveservices.azure.com',
-                    '--query', 'accessToken', '-o', 'tsv'
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
+            process = await asyncio.create_subprocess_exec(
+                *self._command(),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
             )
+            stdout, stderr = await process.communicate()
+            if process.returncode != 0:
+                logging.error(f"Failed to fetch access token: {stderr.decode('utf-8')}")
+                return None
+            return stdout.decode('utf-8').strip() or None
+        except Exception as e:
+            logging.error(f"Error fetching access token: {e}")
+            return None
+
+    def get_token_blocking(self):
+        """Synchronous fetch for code paths that have no event loop."""
+        try:
+            logging.info("Fetching Azure OpenAI access token...")
+            result = subprocess.run(self._command(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             if result.returncode != 0:
                 logging.error(f"Failed to fetch access token: {result.stderr.decode('utf-8')}")
                 return None
-            return result.stdout.decode('utf-8').strip()
+            return result.stdout.decode('utf-8').strip() or None
         except Exception as e:
             logging.error(f"Error fetching access token: {e}")
             return None
 
-    async def refresh_token(self):
+
+class StaticTokenProvider:
+    """Returns a fixed token. Use it as a local stub to run the pipeline offline or in tests."""
+
+    def __init__(self, token='offline-token'):
+        self.token = token
+
+    async def get_token(self):
+        return self.token
+
+    def get_token_blocking(self):
+        return self.token
+
+
+class TokenManager:
+    def __init__(self, provider=None):
+        self.provider = provider or AzureCliCredentialProvider()
+        self.access_token = None
+        self.token_expiry_time = None
+        self.token_refreshed_time = None
+        self.azure_endpoint = endpoint
+        self.api_version = api_version
+        self.az_path = az_path
+        # Coroutines on any event loop (stages run with asyncio.run in worker threads) wait on one shared
+        # concurrent future, which asyncio.wrap_future can await from whichever loop they run on
+        self._lock = threading.Lock()
+        self._pending = None
+        self._listeners = []
+        self._refresh_task = None
+
+    def set_provider(self, provider):
+        """Replace the credential provider (e.g. with StaticTokenProvider) and drop the cached token."""
+        with self._lock:
+            self.provider = provider
+            self.access_token = None
+            self.token_expiry_time = None
+
+    def add_listener(self, callback):
+        """Register a callback that receives every new token (used to swap it into live clients)."""
+        self._listeners.append(callback)
+
+    def needs_refresh(self):
+        return self.access_token is None or time.time() > self.token_expiry_time - refresh_margin
+
+    def _store_token(self, new_token):
+        self.access_token = new_token
+        self.token_refreshed_time = time.time()
+        self.token_expiry_time = self.token_refreshed_time + token_lifetime
+        os.environ['AZURE_OPENAI_API_KEY'] = new_token
+        for callback in self._listeners:
+            try:
+                callback(new_token)
+            except Exception as e:
+                logging.warning(f"Token listener failed: {e}")
+        logging.info("Token refreshed successfully.")
+
+    async def refresh_token(self, force=False):
         """
-        Asynchronously refreshes the Azure access token.
+        Asynchronously refreshes the Azure access token. Only one refresh runs at a time, every other
+        caller awaits its result.
+
+        Args:
+            force (bool): Refresh even if the cached token is not about to expire (e.g. after a 401).
         """
-        async with self.token_lock:  # Correct usage with asyncio.Lock
-            if self.refresh_in_progress.is_set():
-                logging.info("Token refresh already in progress. Waiting...")
-                await self.refresh_in_progress.wait()
-                return
+        with self._lock:
+            recently_refreshed = self.token_refreshed_time is not None and time.time() - self.token_refreshed_time < 30
+            if not self.needs_refresh() and (not force or recently_refreshed):
+                return self.access_token
+            pending = self._pending
+            owner = pending is None
+            if owner:
+                pending = self._pending = concurrent.futures.Future()
 
-            self.refresh_in_progress.set()
-            try:
-                logging.info("Refreshing Azure access token...")
-                new_token = self.get_azure_access_token()
-                if new_token:
-                    self.access_token = new_token
-                    # Set token to expire in 25 minutes (1500 seconds)
-                    self.token_expiry_time = time.time() + 1500
-                    os.environ['AZURE_OPENAI_API_KEY'] = self.access_token
-                    logging.info("Token refreshed successfully.")
-                else:
-                    logging.error("Failed to refresh Azure access token.")
-            finally:
-                self.refresh_in_progress.clear()
+        if not owner:
+            logging.info("Token refresh already in progress. Waiting...")
+            return await asyncio.wrap_future(pending)
+
+        try:
+            logging.info("Refreshing Azure access token...")
+            new_token = await self.provider.get_token()
+            if new_token:
+                self._store_token(new_token)
+            else:
+                logging.error("Failed to refresh Azure access token.")
+        finally:
+            with self._lock:
+                self._pending = None
+            pending.set_result(self.access_token)
+        return self.access_token
+
+    def get_token_blocking(self, force=False):
+        """Synchronous variant of ensure_valid_token for code that does not run on an event loop."""
+        if force or self.needs_refresh():
+            new_token = self.provider.get_token_blocking()
+            if new_token:
+                with self._lock:
+                    self._store_token(new_token)
+            else:
+                logging.error("Failed to refresh Azure access token.")
+        return self.access_token
 
     async def ensure_valid_token(self):
         """
         Ensures that the Azure access token is valid and refreshes it if necessary.
         """
-        if self.access_token is None or time.time() > self.token_expiry_time - 300:
+        if self.needs_refresh():
             logging.info("Access token is expired or about to expire. Triggering refresh...")
             await self.refresh_token()
 
+    async def _refresh_loop(self, retry_interval=30):
+        while True:
+            if self.token_expiry_time is not None:
+                delay = self.token_expiry_time - refresh_margin - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self.refresh_token()
+            if self.needs_refresh():
+                # Refresh failed, try again shortly instead of spinning
+                await asyncio.sleep(retry_interval)
+
+    def start_background_refresh(self):
+        """Refresh the token ahead of expiry on the running event loop so requests never wait for the CLI."""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.get_running_loop().create_task(self._refresh_loop())
+        return self._refresh_task
+
 # Instantiate a global TokenManager
 token_manager = TokenManager()
 
+def set_credential_provider(provider):
+    """
+    Public function to swap how tokens are obtained (e.g. StaticTokenProvider for offline runs).
+    """
+    token_manager.set_provider(provider)
+
 async def get_or_refresh_token():
     """
     Public function to get or refresh the Azure access token.
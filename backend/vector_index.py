@@ -0,0 +1,312 @@
+import os
+import json
+import shutil
+import logging
+import numpy as np
+from dotenv import load_dotenv
+from .similarity import normalize_rows, select_top, to_float32_vector
+
+#persistent IVF-flat vector index over chunk embeddings, memory-mapped from disk and filterable by paper
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+
+vector_index_dir = os.getenv("vector_index_dir", "vector_index")
+# Number of clusters scanned by a query that is not restricted to a paper
+vector_index_nprobe = int(os.getenv("vector_index_nprobe", 8))
+
+
+def vector_index_path(collection_name):
+    return os.path.join(vector_index_dir, collection_name)
+
+
+# Helper function to make the index built for a staging collection the index of the collection it replaced
+def move_vector_index(source_collection_name, target_collection_name):
+    source = vector_index_path(source_collection_name)
+    if os.path.exists(source):
+        _swap(source, vector_index_path(target_collection_name))
+
+
+def drop_vector_index(collection_name):
+    shutil.rmtree(vector_index_path(collection_name), ignore_errors=True)
+
+
+# Helper function to drop chunks deleted from a collection from its index, if it has one
+def remove_from_vector_index(collection_name, ids):
+    index = VectorIndex.load(vector_index_path(collection_name))
+    if index is not None and len(ids):
+        index.remove(ids)
+
+
+# Helper function to assign vectors to their closest centroid without materialising the whole score matrix
+def assign_clusters(vectors, centroids, batch_size=65536):
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), batch_size):
+        block = np.asarray(vectors[start:start + batch_size], dtype=np.float32)
+        assignments[start:start + batch_size] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+# Helper function to train centroids with spherical k-means on a sample of the vectors
+def train_centroids(vectors, nlist, n_iter=10, sample_per_list=64, seed=0):
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), nlist * sample_per_list)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=nlist)
+        # Empty clusters keep their previous centroid
+        centroids = np.where(counts[:, None] > 0, normalize_rows(sums), centroids).astype(np.float32)
+    return centroids
+
+
+class VectorIndex:
+    """
+    IVF-flat index stored in a directory:
+
+    - vectors.npy: unit-length float32 vectors, memory-mapped. The chunks of a paper are stored
+      contiguously, so a query restricted to papers is an exact scan of a few slices.
+    - centroids.npy / assignments.npy: k-means clusters used to scan only a few clusters when a
+      query is not restricted to a paper.
+    - meta.json: row ids (Mongo _id as string), paper -> row ranges, training statistics and the encoder
+      backend the vectors were made with (queries must be embedded with the same one).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        self.ids = meta['ids']
+        self.papers = {paper: [tuple(r) for r in ranges] for paper, ranges in meta['papers'].items()}
+        self.trained_count = meta['trained_count']
+        # Indexes built before the backend was recorded hold Azure embeddings
+        self.backend = meta.get('backend', 'azure')
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        self.assignments = np.load(os.path.join(path, 'assignments.npy'))
+        # Inverted lists: rows of cluster c are list_order[list_offsets[c]:list_offsets[c + 1]]
+        self.list_order = np.argsort(self.assignments, kind='stable')
+        self.list_offsets = np.searchsorted(self.assignments[self.list_order], np.arange(len(self.centroids) + 1))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, path):
+        """Open an index, or return None if it was never built."""
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            return None
+        return cls(path)
+
+    @classmethod
+    def build(cls, path, vectors, ids, papers, backend='azure'):
+        """
+        Build (or rebuild) the index from scratch.
+
+        Args:
+            path (str): Directory of the index.
+            vectors (list): Embeddings of the chunks.
+            ids (list): Id of every chunk (used to fetch it back from Mongo).
+            papers (list): Normalised paper name of every chunk.
+            backend (str): Encoder backend of the vectors (see embedding.resolve_backend).
+        """
+        ids = [str(i) for i in ids]
+        papers = [str(p) for p in papers]
+        order = np.argsort(np.asarray(papers, dtype=str), kind='stable')
+        matrix = _to_matrix([vectors[i] for i in order])
+        ids = [ids[i] for i in order]
+        ranges = {}
+        for position, i in enumerate(order):
+            _extend_ranges(ranges.setdefault(papers[i], []), position)
+        centroids = train_centroids(matrix, _nlist(len(matrix))) if len(matrix) else np.zeros((1, matrix.shape[1]), np.float32)
+        tmp = _tmp_path(path)
+        np.save(os.path.join(tmp, 'vectors.npy'), matrix)
+        _write(path, tmp, ids, ranges, centroids, assign_clusters(matrix, centroids), len(matrix), backend)
+        logging.info(f"Built vector index {path} with {len(ids)} chunks.")
+        return cls(path)
+
+    def add(self, vectors, ids, papers, backend=None):
+        """
+        Append chunks without retraining. New rows go to their closest existing cluster. The
+        clusters are retrained once the index has grown to four times the size they were trained on.
+        Vectors of another encoder backend than the index's are refused.
+        """
+        backend = backend or self.backend
+        if len(ids) == 0:
+            return self
+        if len(self.ids) == 0:
+            # An index built from no chunks has no dimension and no clusters to add to
+            return VectorIndex.build(self.path, vectors, ids, papers, backend)
+        if backend != self.backend:
+            raise ValueError(f"Cannot add '{backend}' embeddings to vector index {self.path} of '{self.backend}' embeddings.")
+        ids = [str(i) for i in ids]
+        papers = [str(p) for p in papers]
+        order = np.argsort(np.asarray(papers, dtype=str), kind='stable')
+        new_matrix = _to_matrix([vectors[i] for i in order])
+        if self.vectors.shape[1] and new_matrix.shape[1] != self.vectors.shape[1]:
+            raise ValueError(f"Embedding dimension {new_matrix.shape[1]} does not match index dimension {self.vectors.shape[1]}.")
+
+        count = len(self.ids)
+        total = count + len(new_matrix)
+        tmp = _tmp_path(self.path)
+        # Copy block by block so the existing vectors never have to fit in memory
+        merged = np.lib.format.open_memmap(os.path.join(tmp, 'vectors.npy'), mode='w+', dtype=np.float32,
+                                           shape=(total, new_matrix.shape[1]))
+        for start in range(0, count, 65536):
+            stop = min(start + 65536, count)
+            merged[start:stop] = self.vectors[start:stop]
+        merged[count:] = new_matrix
+
+        ranges = {paper: list(r) for paper, r in self.papers.items()}
+        for position, i in enumerate(order):
+            _extend_ranges(ranges.setdefault(papers[i], []), count + position)
+
+        if total > 4 * max(self.trained_count, 1):
+            centroids = train_centroids(merged, _nlist(total))
+            assignments = assign_clusters(merged, centroids)
+            trained_count = total
+        else:
+            centroids = self.centroids
+            assignments = np.concatenate([self.assignments, assign_clusters(new_matrix, centroids)])
+            trained_count = self.trained_count
+        merged.flush()
+        del merged
+        _write(self.path, tmp, self.ids + [ids[i] for i in order], ranges, centroids, assignments, trained_count, self.backend)
+        logging.info(f"Added {len(ids)} chunks to vector index {self.path}.")
+        return VectorIndex(self.path)
+
+    def remove(self, ids):
+        """
+        Drop chunks by id. The other rows keep their order and clusters, ids not in the index are ignored.
+        """
+        ids = {str(i) for i in ids}
+        keep = np.array([i not in ids for i in self.ids], dtype=bool)
+        if keep.all():
+            return self
+        kept = np.flatnonzero(keep)
+        tmp = _tmp_path(self.path)
+        # Copy block by block so the remaining vectors never have to fit in memory
+        remaining = np.lib.format.open_memmap(os.path.join(tmp, 'vectors.npy'), mode='w+', dtype=np.float32,
+                                              shape=(len(kept), self.vectors.shape[1]))
+        for start in range(0, len(kept), 65536):
+            remaining[start:start + 65536] = self.vectors[kept[start:start + 65536]]
+        remaining.flush()
+        del remaining
+
+        # Kept rows of a range stay contiguous, it starts at the number of kept rows before it
+        before = np.concatenate([[0], np.cumsum(keep)])
+        ranges = {}
+        for paper, paper_ranges in self.papers.items():
+            for start, stop in paper_ranges:
+                new_start, new_stop = int(before[start]), int(before[stop])
+                if new_stop == new_start:
+                    continue
+                new_ranges = ranges.setdefault(paper, [])
+                # Ranges that end up next to each other are merged
+                if new_ranges and new_ranges[-1][1] == new_start:
+                    new_ranges[-1] = (new_ranges[-1][0], new_stop)
+                else:
+                    new_ranges.append((new_start, new_stop))
+        _write(self.path, tmp, [self.ids[i] for i in kept], ranges, self.centroids, self.assignments[kept],
+               self.trained_count, self.backend)
+        logging.info(f"Removed {len(self.ids) - len(kept)} chunks from vector index {self.path}.")
+        return VectorIndex(self.path)
+
+    def _paper_rows(self, papers):
+        if isinstance(papers, str):
+            papers = [papers]
+        ranges = [r for paper in dict.fromkeys(papers) for r in self.papers.get(paper, [])]
+        if not ranges:
+            return np.empty(0, dtype=np.intp)
+        return np.concatenate([np.arange(start, stop) for start, stop in ranges])
+
+    def _probe_rows(self, query, nprobe):
+        scores = self.centroids @ query
+        nprobe = min(nprobe, len(scores))
+        lists = np.argpartition(-scores, nprobe - 1)[:nprobe]
+        return np.sort(np.concatenate([self.list_order[self.list_offsets[c]:self.list_offsets[c + 1]] for c in lists]))
+
+    def search_many(self, query_vectors, top_n, threshold=None, papers=None, nprobe=vector_index_nprobe):
+        """
+        Find the closest chunks of every query.
+
+        Args:
+            query_vectors (list): Query embeddings.
+            top_n (int): Maximum number of chunks per query.
+            threshold (float): See similarity.select_top.
+            papers (list): Per query, a normalised paper name or list of names to search exactly, or None
+                to search the whole corpus through the nprobe closest clusters.
+
+        Returns:
+            list[tuple[list, np.ndarray]]: Per query, ids of the chunks (best first) and their similarities.
+        """
+        if papers is None:
+            papers = [None] * len(query_vectors)
+        results = [([], np.empty(0, dtype=np.float32)) for _ in query_vectors]
+        if len(query_vectors) == 0 or len(self.ids) == 0:
+            return results
+        queries = normalize_rows(np.vstack([to_float32_vector(vector) for vector in query_vectors]))
+
+        # Queries against the same papers share one matrix-matrix product
+        # (queries that are not restricted to papers are keyed by their position and probed on their own)
+        by_papers = {}
+        for i, paper in enumerate(papers):
+            key = i if paper is None else tuple(sorted(set([paper] if isinstance(paper, str) else paper)))
+            by_papers.setdefault(key, []).append(i)
+
+        for key, query_ids in by_papers.items():
+            rows = self._probe_rows(queries[key], nprobe) if isinstance(key, int) else self._paper_rows(key)
+            if rows.size == 0:
+                continue
+            # Paper rows are a few contiguous runs, reading them from the memmap is sequential
+            similarities = np.asarray(self.vectors[rows], dtype=np.float32) @ queries[query_ids].T
+            for column, i in enumerate(query_ids):
+                scores = similarities[:, column]
+                positions = select_top(scores, top_n, threshold)
+                results[i] = ([self.ids[row] for row in rows[positions]], scores[positions])
+        return results
+
+
+def _nlist(count):
+    return int(min(4096, max(1, np.sqrt(count))))
+
+
+def _to_matrix(vectors):
+    if len(vectors) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.ascontiguousarray(normalize_rows(np.vstack([to_float32_vector(v) for v in vectors])), dtype=np.float32)
+
+
+def _extend_ranges(ranges, position):
+    # Grow the last range when the row follows it, otherwise start a new one
+    if ranges and ranges[-1][1] == position:
+        ranges[-1] = (ranges[-1][0], position + 1)
+    else:
+        ranges.append((position, position + 1))
+
+
+def _tmp_path(path):
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    return tmp
+
+
+def _write(path, tmp, ids, ranges, centroids, assignments, trained_count, backend):
+    np.save(os.path.join(tmp, 'centroids.npy'), centroids)
+    np.save(os.path.join(tmp, 'assignments.npy'), assignments)
+    with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'ids': ids, 'papers': ranges, 'trained_count': trained_count, 'backend': backend}, f)
+    _swap(tmp, path)
+
+
+def _swap(source, path):
+    # Swap directories so readers never see a half written index
+    old = path + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old)
+    os.replace(source, path)
+    shutil.rmtree(old, ignore_errors=True)
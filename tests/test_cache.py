@@ -0,0 +1,90 @@
+import pytest
+
+import backend.cache as cache
+from backend.cache import SQLiteCache, EmbeddingCache, make_cache_key
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(cache.time, 'time', clock)
+    return clock
+
+
+def test_make_cache_key_separates_parts():
+    assert make_cache_key('ab', 'c') != make_cache_key('a', 'bc')
+    assert make_cache_key('a', 1) == make_cache_key('a', '1')
+    assert len(make_cache_key('chunk', 'statement')) == 64
+
+
+def test_get_and_set(tmp_path, clock):
+    store = SQLiteCache(str(tmp_path / 'cache.sqlite3'), 'sieve')
+    assert store.get('k') is None
+    store.set('k', 'answer')
+    assert store.get('k') == 'answer'
+    store.set_many([('a', '1'), ('b', '2')])
+    assert store.get_many(['a', 'b', 'c', 'a']) == {'a': '1', 'b': '2'}
+
+
+def test_expired_entries_are_not_returned(tmp_path, clock):
+    store = SQLiteCache(str(tmp_path / 'cache.sqlite3'), 'sieve', ttl=60)
+    store.set('old', 'x')
+    clock.now += 30
+    store.set('new', 'y')
+    clock.now += 31
+    assert store.get_many(['old', 'new']) == {'new': 'y'}
+    assert store.get('old') is None
+    assert store.get('new') == 'y'
+
+
+def test_evict_drops_least_recently_used(tmp_path, clock):
+    store = SQLiteCache(str(tmp_path / 'cache.sqlite3'), 'sieve', max_entries=2)
+    for key in ('a', 'b', 'c'):
+        store.set(key, key)
+        clock.now += 1
+    # Reading 'a' makes 'b' the least recently used entry
+    assert store.get('a') == 'a'
+    store.evict()
+    assert store.get_many(['a', 'b', 'c']) == {'a': 'a', 'c': 'c'}
+
+
+def test_evict_drops_expired_entries(tmp_path, clock):
+    store = SQLiteCache(str(tmp_path / 'cache.sqlite3'), 'sieve', ttl=10)
+    store.set('a', 'a')
+    clock.now += 11
+    store.evict()
+    count = store._connect().execute("SELECT COUNT(*) FROM sieve").fetchone()[0]
+    assert count == 0
+
+
+def test_embedding_key_normalises_whitespace():
+    assert EmbeddingCache.key('a  statement\n here ', 'model') == EmbeddingCache.key('a statement here', 'model')
+    assert EmbeddingCache.key('a statement', 'model') != EmbeddingCache.key('a statement', 'other-model')
+    assert EmbeddingCache.key('A statement', 'model') != EmbeddingCache.key('a statement', 'model')
+
+
+def test_embedding_cache_round_trip(tmp_path):
+    embeddings = EmbeddingCache(SQLiteCache(str(tmp_path / 'cache.sqlite3'), 'embeddings'), memory_size=2)
+    embeddings.set_many(['one', 'two', 'three'], [[1.0, 0.0], [0.0, 1.0], [0.5, 0.5]], 'model')
+    # Only the two most recent vectors stay in memory
+    assert len(embeddings._memory) == 2
+    found = embeddings.get_many(['one', ' two ', 'four', 'three'], 'model')
+    assert found == {0: [1.0, 0.0], 1: [0.0, 1.0], 3: [0.5, 0.5]}
+    assert embeddings.get_many(['one'], 'other-model') == {}
+
+
+def test_embedding_memory_is_least_recently_used(tmp_path):
+    store = SQLiteCache(str(tmp_path / 'cache.sqlite3'), 'embeddings')
+    embeddings = EmbeddingCache(store, memory_size=2)
+    embeddings.set_many(['a', 'b'], [[1.0], [2.0]], 'model')
+    embeddings.get_many(['a'], 'model')
+    embeddings.set_many(['c'], [[3.0]], 'model')
+    assert set(embeddings._memory) == {EmbeddingCache.key('a', 'model'), EmbeddingCache.key('c', 'model')}
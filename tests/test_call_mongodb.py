@@ -0,0 +1,107 @@
+import pytest
+
+pytest.importorskip('pymongo')
+
+import backend.call_mongodb as call_mongodb
+import pandas as pd
+
+from backend.call_mongodb import merge_collection, merge_pipeline, read_dataframe, stream_dataframes
+
+
+# Just enough of a MongoDB database to run merge_pipeline: $project, $unset '_id' and an inserting $merge
+class _Collection:
+    def __init__(self, db):
+        self.db = db
+        self.documents = []
+
+    def find(self, query, projection=None, batch_size=None):
+        return iter([dict(document) for document in self.documents])
+
+    def count_documents(self, query):
+        return len(self.documents)
+
+    def delete_many(self, query):
+        self.documents = []
+
+    def aggregate(self, pipeline):
+        documents = [dict(document) for document in self.documents]
+        for stage in pipeline:
+            (operator, spec), = stage.items()
+            if operator == '$project':
+                documents = [{field: document[field] for field in ['_id', *spec] if field in document} for document in documents]
+            elif operator == '$unset':
+                documents = [{field: value for field, value in document.items() if field != spec} for document in documents]
+            elif operator == '$merge':
+                target = self.db[spec['into']]
+                existing = {document['_id'] for document in target.documents}
+                for document in documents:
+                    if '_id' not in document:
+                        self.db.next_id += 1
+                        document['_id'] = self.db.next_id
+                    elif document['_id'] in existing:
+                        assert spec['whenMatched'] == 'fail'
+                        raise RuntimeError('duplicate _id')
+                    target.documents.append(document)
+            else:
+                raise NotImplementedError(operator)
+
+
+class _Database(dict):
+    next_id = 100
+
+    def __missing__(self, name):
+        collection = self[name] = _Collection(self)
+        return collection
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = _Database()
+    monkeypatch.setattr(call_mongodb.MongoDBClient, 'get_client', lambda uri: {'db': db})
+    return db
+
+
+def test_merge_pipeline_drops_id():
+    pipeline = merge_pipeline('target', ['a', 'b'])
+    assert pipeline[0] == {'$project': {'a': 1, 'b': 1}}
+    assert pipeline[1] == {'$unset': '_id'}
+    assert pipeline[2]['$merge']['into'] == 'target'
+    assert pipeline[2]['$merge']['whenNotMatched'] == 'insert'
+    assert merge_pipeline('target')[0] == {'$unset': '_id'}
+
+
+def test_merging_copied_documents_again_appends_them(db):
+    db['source'].documents = [{'_id': 1, 'a': 'x', 'b': 1}, {'_id': 2, 'a': 'y', 'b': 2}]
+    assert merge_collection('uri', 'db', 'source', 'target', ['a']) == 2
+    # The same documents (same _id) merged a second time are appended again, as copies
+    assert merge_collection('uri', 'db', 'source', 'target', ['a'], clear_source=True) == 2
+    assert [document['a'] for document in db['target'].documents] == ['x', 'y', 'x', 'y']
+    assert len({document['_id'] for document in db['target'].documents}) == 4
+    assert all('b' not in document for document in db['target'].documents)
+    assert db['source'].documents == []
+
+
+def test_merging_into_a_target_holding_the_same_ids(db):
+    db['source'].documents = [{'_id': 1, 'a': 'new'}]
+    db['target'].documents = [{'_id': 1, 'a': 'old'}]
+    merge_collection('uri', 'db', 'source', 'target')
+    assert sorted(document['a'] for document in db['target'].documents) == ['new', 'old']
+
+
+def test_read_dataframe_matches_a_dataframe_of_the_documents(db):
+    # Fields appear, disappear and change type across batch boundaries
+    db['source'].documents = [
+        {'_id': 1, 'a': 'x'},
+        {'_id': 2, 'a': 'y', 'b': 2},
+        {'_id': 3, 'b': 3.5},
+        {'_id': 4, 'a': 'z', 'c': [1, 2]},
+        {'_id': 5, 'a': None},
+    ]
+    expected = pd.DataFrame(db['source'].documents)
+    for batch_size in (1, 2, 5, 10):
+        assert [len(batch) for batch in stream_dataframes('uri', 'db', 'source', batch_size=batch_size)][0] == min(batch_size, 5)
+        pd.testing.assert_frame_equal(read_dataframe('uri', 'db', 'source', batch_size=batch_size), expected)
+
+
+def test_read_dataframe_of_an_empty_collection(db):
+    assert read_dataframe('uri', 'db', 'source').empty
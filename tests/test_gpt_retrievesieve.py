@@ -0,0 +1,66 @@
+import re
+
+import pandas as pd
+import pytest
+
+# Skipped where the OpenAI/PDF dependencies of the module are not installed
+gpt_retrievesieve = pytest.importorskip('backend.gpt_retrievesieve')
+from backend.gpt_retrievesieve import extract_classifications, chunk_hash
+
+
+# The per-row parser extract_classifications replaced
+def _baseline_extract(text):
+    if not isinstance(text, str) or not text.strip():
+        return []
+    pattern = r"\s*(support|oppose)\s*\((\d+)\):\s*(.*?)\s*(?=\s*support|\s*oppose|\Z)"
+    return [(match[0], int(match[1]), match[2].strip()) for match in re.findall(pattern, text, re.DOTALL | re.IGNORECASE)]
+
+
+OUTPUTS = [
+    'Support (85): the chunk says so',
+    'support (80): first quote\n\n OPPOSE (20):  second quote  ',
+    'Support (70):',
+    'oppose (10):   \n',
+    'Support (90): quoted Oppose (5):',
+    'no classification here',
+    '',
+    '   ',
+    None,
+    float('nan'),
+    42,
+]
+
+
+def _sieved(outputs):
+    return pd.DataFrame({
+        'Reference article name': [f'Paper {i}' for i in range(len(outputs))],
+        'Reference text in main article': [f'statement {i}' for i in range(len(outputs))],
+        'Sieving by gpt 4o': pd.Series(outputs, dtype=object),
+        'Chunk': [f'chunk {i}' for i in range(len(outputs))],
+        'Date': list(range(2000, 2000 + len(outputs))),
+    })
+
+
+def test_extract_classifications_matches_the_per_row_parser():
+    df = _sieved(OUTPUTS)
+    valid_df, invalid_df = extract_classifications(df)
+
+    expected = [(i, *match) for i, text in enumerate(OUTPUTS) for match in _baseline_extract(text)]
+    found = list(zip(valid_df['Reference article name'].str.slice(6).astype(int), valid_df['Sentiment'],
+                     valid_df['Confidence Score'], valid_df['Sieving by gpt 4o']))
+    assert found == expected
+    assert invalid_df.index.tolist() == [i for i, text in enumerate(OUTPUTS) if not _baseline_extract(text)]
+
+
+def test_empty_classification_text_is_an_empty_string():
+    valid_df, _ = extract_classifications(_sieved(['Support (70):', 'oppose (10):   \n']))
+    assert valid_df['Sieving by gpt 4o'].tolist() == ['', '']
+    assert valid_df['Sieved hash'].tolist() == [chunk_hash('')] * 2
+    assert valid_df['Chunk hash'].tolist() == [chunk_hash('chunk 0'), chunk_hash('chunk 1')]
+
+
+def test_extract_classifications_without_any_match():
+    df = _sieved(['nothing', None, 3])
+    valid_df, invalid_df = extract_classifications(df)
+    assert valid_df.empty
+    assert invalid_df.index.tolist() == [0, 1, 2]
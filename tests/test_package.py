@@ -0,0 +1,21 @@
+import sys
+
+import pytest
+
+import backend
+
+
+def test_names_resolve_to_their_owning_submodule():
+    assert backend._owner('retrieve_sieve_references') == 'gpt_retrievesieve'
+    assert backend._owner('process_dataframe_sc1') == 'semantic_chunking'
+    # Names of "import *" entries come from the submodule source
+    assert backend._owner('process_pdfs_to_mongodb_chunked') == 'process_and_embed'
+    # Names a submodule does not declare for the package are not exported
+    assert backend._owner('make_cache_key') is None
+
+
+def test_undeclared_name_imports_nothing():
+    before = {name for name in sys.modules if name.startswith('backend.')}
+    with pytest.raises(AttributeError):
+        backend.no_such_name
+    assert {name for name in sys.modules if name.startswith('backend.')} == before
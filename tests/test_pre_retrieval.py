@@ -0,0 +1,136 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Skipped where the OpenAI dependencies of backend.embedding are not installed
+pre_retrieval = pytest.importorskip('backend.pre_retrieval')
+from backend.pre_retrieval import BM25, tokenize, rescale, select_chunks, pre_retrieve, pre_retrieval_recall
+
+
+CORPUS = [
+    'Coral reefs bleach when ocean temperature rises.',
+    'The survey counted fish species on the reef.',
+    'Ocean temperature records from buoys, 1990 to 2020.',
+    'Funding was provided by the national science agency.',
+    'Bleaching of coral reefs follows marine heatwaves and ocean warming.',
+    'Acknowledgements.',
+]
+STATEMENT = 'Rising ocean temperature bleaches coral reefs'
+
+
+def _paper(embeddings=None):
+    df = pd.DataFrame({'Text Content': CORPUS})
+    if embeddings is not None:
+        df['embed_v3'] = embeddings
+    return df
+
+
+def test_tokenize():
+    assert tokenize('Coral-reefs, 2020!') == ['coral', 'reefs', '2020']
+    assert tokenize(None) == [] and tokenize(float('nan')) == []
+
+
+def test_bm25_matches_the_formula():
+    bm25 = BM25(CORPUS)
+    documents = [tokenize(text) for text in CORPUS]
+    average = sum(map(len, documents)) / len(documents)
+    expected = []
+    for document in documents:
+        score = 0.0
+        for term in set(tokenize(STATEMENT)):
+            df = sum(term in other for other in documents)
+            if not df:
+                continue
+            idf = math.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+            frequency = document.count(term)
+            score += idf * frequency * 2.5 / (frequency + 1.5 * (0.25 + 0.75 * len(document) / average))
+        expected.append(score)
+    assert np.allclose(bm25.scores(STATEMENT), expected)
+
+
+def test_bm25_ranks_the_relevant_chunks_first():
+    scores = BM25(CORPUS).scores(STATEMENT)
+    assert set(np.argsort(-scores)[:3]) == {0, 2, 4}
+    assert scores[3] == scores[5] == 0
+    assert not BM25(CORPUS).scores('unrelated words only').any()
+    assert BM25([]).scores(STATEMENT).size == 0
+
+
+def test_rescale():
+    assert np.allclose(rescale(np.array([2.0, 4.0, 3.0])), [0.0, 1.0, 0.5])
+    assert np.array_equal(rescale(np.array([5.0, np.nan, 5.0])), [1.0, np.nan, 1.0], equal_nan=True)
+    assert np.isnan(rescale(np.array([np.nan, np.nan]))).all()
+
+
+def test_select_chunks_top_k_and_margin():
+    scores = np.array([0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7])
+    # ceil(2 * 1.5) = 3 chunks, none reaches the threshold
+    assert np.flatnonzero(select_chunks(scores, top_k=2, margin=0.5, threshold=1.1)).tolist() == [5, 6, 7]
+    assert np.flatnonzero(select_chunks(scores, top_k=2, margin=0.0, threshold=1.1)).tolist() == [6, 7]
+
+
+def test_select_chunks_threshold_widens_the_selection():
+    scores = np.array([0.0, 0.85, 0.9, 0.95, 1.0, 0.1])
+    assert np.flatnonzero(select_chunks(scores, top_k=1, margin=0.0, threshold=0.8)).tolist() == [1, 2, 3, 4]
+
+
+def test_select_chunks_forwards_unscored_chunks():
+    scores = np.array([np.nan, 0.1, 0.2, np.nan, 1.0, 0.0])
+    assert np.flatnonzero(select_chunks(scores, top_k=1, margin=0.0, threshold=1.1)).tolist() == [0, 3, 4]
+
+
+def test_select_chunks_keeps_everything_when_few_chunks():
+    assert select_chunks(np.array([0.0, 1.0, np.nan]), top_k=2, margin=0.5, threshold=1.1).all()
+    assert select_chunks(np.empty(0), top_k=2).size == 0
+
+
+def test_pre_retrieve_off_forwards_everything():
+    df = _paper()
+    jobs = [(df, [STATEMENT, 'Paper', 2020])]
+    assert pre_retrieve(jobs, mode='off') == [(df, jobs[0][1], None)]
+    assert pre_retrieve([], mode='bm25') == []
+    with pytest.raises(ValueError):
+        pre_retrieve(jobs, mode='unknown')
+
+
+def test_pre_retrieve_bm25(monkeypatch):
+    monkeypatch.setattr(pre_retrieval, 'pre_retrieval_top_k', 2)
+    monkeypatch.setattr(pre_retrieval, 'pre_retrieval_margin', 0.5)
+    monkeypatch.setattr(pre_retrieval, 'pre_retrieval_threshold', 1.1)
+    df = _paper()
+    code = [STATEMENT, 'Paper', 2020]
+
+    (selected, selected_code, forwarded), = pre_retrieve([(df, code)], mode='bm25', audit_fraction=0)
+    assert forwarded is None and selected_code is code
+    assert sorted(selected.index) == [0, 2, 4]
+
+    # Audited pairs keep every chunk and mark the ones the pre-retrieval would forward
+    (audited, _, forwarded), = pre_retrieve([(df, code)], mode='bm25', audit_fraction=1)
+    assert audited is df
+    assert np.flatnonzero(forwarded).tolist() == [0, 2, 4]
+
+
+def test_pre_retrieve_hybrid_with_missing_embeddings(monkeypatch):
+    monkeypatch.setattr(pre_retrieval, 'pre_retrieval_top_k', 1)
+    monkeypatch.setattr(pre_retrieval, 'pre_retrieval_margin', 0.0)
+    monkeypatch.setattr(pre_retrieval, 'pre_retrieval_threshold', 1.1)
+    monkeypatch.setattr(pre_retrieval, 'embed_texts', lambda texts, desc=None, backend=None: [[1.0, 0.0] for _ in texts])
+    # Chunk 3 is closest to the statement by embedding, chunk 5 has no stored embedding
+    embeddings = [[0.0, 1.0], [0.0, 1.0], [0.1, 1.0], [1.0, 0.0], [0.0, 1.0], None]
+    code = [STATEMENT, 'Paper', 2020]
+
+    (selected, _, _), = pre_retrieve([(_paper(embeddings), code)], mode='embedding', audit_fraction=0)
+    assert sorted(selected.index) == [3, 5]
+    # Hybrid averages both rescaled scores: chunk 0 (best by BM25) and chunk 3 (best by embedding) both reach 0.5,
+    # the chunk without an embedding keeps its BM25 score alone and is no longer forwarded unscored
+    monkeypatch.setattr(pre_retrieval, 'pre_retrieval_top_k', 2)
+    (_, _, forwarded), = pre_retrieve([(_paper(embeddings), code)], mode='hybrid', audit_fraction=1)
+    assert np.flatnonzero(forwarded).tolist() == [0, 3]
+
+
+def test_pre_retrieval_recall():
+    assert pre_retrieval_recall([]) is None
+    assert pre_retrieval_recall([(True, False), (False, False)]) is None
+    assert pre_retrieval_recall([(True, True), (False, True), (True, False), (True, True)]) == pytest.approx(2 / 3)
@@ -0,0 +1,84 @@
+import pytest
+
+import backend.rate_limiter as rl
+from backend.rate_limiter import RateLimiter, retry_after_seconds
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(rl.time, 'monotonic', clock)
+    return clock
+
+
+def test_buckets_drain_and_refill(clock):
+    limiter = RateLimiter(60, 600)
+    for _ in range(60):
+        assert limiter._reserve(10) == 0
+    # Out of requests: one request refills every second
+    assert limiter._reserve(10) == pytest.approx(1.0)
+    clock.now += 0.5
+    assert limiter._reserve(10) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert limiter._reserve(10) == 0
+
+
+def test_token_bucket_limits_large_requests(clock):
+    limiter = RateLimiter(100, 600)
+    assert limiter._reserve(500) == 0
+    # 100 tokens left, 400 more refill in 40 seconds at 10 tokens per second
+    assert limiter._reserve(500) == pytest.approx(40.0)
+    clock.now += 40
+    assert limiter._reserve(500) == 0
+
+
+def test_refill_is_capped_at_the_quota(clock):
+    limiter = RateLimiter(60, 600)
+    clock.now += 3600
+    limiter._refill(clock.now)
+    assert limiter._requests_available == 60
+    assert limiter._tokens_available == 600
+
+
+def test_update_from_headers_lowers_the_buckets(clock):
+    limiter = RateLimiter(60, 600)
+    limiter.update_from_headers({'x-ratelimit-remaining-requests': '2', 'x-ratelimit-remaining-tokens': 'bad'})
+    assert limiter._requests_available == 2
+    assert limiter._tokens_available == 600
+    # The server only ever lowers what is available
+    limiter.update_from_headers({'x-ratelimit-remaining-requests': '50'})
+    assert limiter._requests_available == 2
+    limiter.update_from_headers(None)
+    assert limiter._requests_available == 2
+
+
+def test_block_for_pauses_dispatch(clock):
+    limiter = RateLimiter(60, 600)
+    limiter.block_for(5)
+    assert limiter._reserve(1) == pytest.approx(5.0)
+    clock.now += 5
+    # The buckets were emptied by the block and refilled for 5 seconds since
+    assert limiter._reserve(1) == 0
+    assert limiter._requests_available == pytest.approx(4.0)
+
+
+def test_update_from_headers_blocks_on_retry_after(clock):
+    limiter = RateLimiter(60, 600)
+    limiter.update_from_headers({'retry-after-ms': '2500'})
+    assert limiter._reserve(1) == pytest.approx(2.5)
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds({'retry-after-ms': '1500', 'Retry-After': '9'}) == 1.5
+    assert retry_after_seconds({'Retry-After': '3'}) == 3.0
+    assert retry_after_seconds({'Retry-After': 'soon'}) is None
+    assert retry_after_seconds({}) is None
+    assert retry_after_seconds(None) is None
@@ -0,0 +1,37 @@
+from backend.records import RecordColumns, SieveResult, EditResult
+
+
+def test_empty_columns():
+    rows = RecordColumns(SieveResult)
+    assert len(rows) == 0
+    assert rows.to_dataframe().empty
+    assert rows.to_records() == []
+
+
+def test_columns_follow_the_record_type():
+    rows = RecordColumns(SieveResult)
+    rows.append(SieveResult('Paper A', 'statement 1', 'Support (80): text', 'chunk 1', 2020))
+    rows.append(SieveResult('Paper B', 'statement 2', 'Oppose (60): other', 'chunk 2', None))
+    assert len(rows) == 2
+
+    df = rows.to_dataframe()
+    assert list(df.columns) == list(SieveResult.columns)
+    assert df['Reference article name'].tolist() == ['Paper A', 'Paper B']
+    assert df['Date'].tolist()[0] == 2020
+
+    records = rows.to_records()
+    assert records[0] == {
+        'Reference article name': 'Paper A',
+        'Reference text in main article': 'statement 1',
+        'Sieving by gpt 4o': 'Support (80): text',
+        'Chunk': 'chunk 1',
+        'Date': 2020,
+    }
+    # Values are passed through untouched, None stays None instead of becoming NaN
+    assert records[1]['Date'] is None
+
+
+def test_dataframe_and_records_agree():
+    rows = RecordColumns(EditResult)
+    rows.append(EditResult('old', 'new', 'ref'))
+    assert rows.to_dataframe().to_dict(orient='records') == rows.to_records()
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend.similarity import SimilarityIndex, select_top
+
+
+# The selection of search_docs_text_threshold before it was vectorised
+def _baseline_select(similarities, top_n, threshold):
+    df = pd.DataFrame({'similarities_text': similarities})
+    filtered_df = df[df['similarities_text'] > threshold]
+    if filtered_df.empty:
+        return df[df['similarities_text'] == df['similarities_text'].max()]['similarities_text'].to_numpy()
+    return filtered_df.sort_values('similarities_text', ascending=False).head(top_n)['similarities_text'].to_numpy()
+
+
+@pytest.mark.parametrize('top_n', [1, 3, 10, 200])
+@pytest.mark.parametrize('threshold', [-1.0, 0.2, 0.5, 0.99])
+def test_select_top_matches_baseline(top_n, threshold):
+    rng = np.random.default_rng(top_n)
+    # Rounded so that ties are common, including at the top n boundary
+    similarities = np.round(rng.uniform(-1, 1, size=100), 1)
+    positions = select_top(similarities, top_n, threshold)
+    assert np.array_equal(similarities[positions], _baseline_select(similarities, top_n, threshold))
+    assert len(set(positions.tolist())) == positions.size
+
+
+def test_select_top_returns_every_tie_below_threshold():
+    similarities = np.array([0.1, 0.3, 0.3, 0.2])
+    assert select_top(similarities, 1, 0.5).tolist() == [1, 2]
+
+
+def test_select_top_without_threshold_and_k_above_n():
+    similarities = np.array([0.1, 0.9, 0.5])
+    assert select_top(similarities, 10).tolist() == [1, 2, 0]
+    assert select_top(similarities, 2).tolist() == [1, 2]
+
+
+def test_select_top_empty():
+    assert select_top(np.empty(0), 5, 0.5).size == 0
+    assert select_top(np.empty(0), 5).size == 0
+
+
+def _index(rng):
+    vectors = rng.normal(size=(6, 4))
+    df = pd.DataFrame({
+        'PDF File': ['A', 'B', 'A', 'B', 'A', 'C'],
+        'Text Content': [f'chunk {i}' for i in range(6)],
+        'embed_v3': [vector.tolist() for vector in vectors],
+    })
+    return SimilarityIndex(df, group_column='PDF File'), vectors
+
+
+def test_search_many_matches_a_per_row_scan():
+    rng = np.random.default_rng(0)
+    index, vectors = _index(rng)
+    queries = rng.normal(size=(3, 4))
+    results = index.search_many(list(queries), top_n=2, threshold=-1.0, groups=['A', ['B', 'C'], None])
+    for query, result, allowed in zip(queries, results, [{'A'}, {'B', 'C'}, {'A', 'B', 'C'}]):
+        assert set(result['PDF File']) <= allowed
+        rows = [i for i, paper in enumerate(['A', 'B', 'A', 'B', 'A', 'C']) if paper in allowed]
+        expected = sorted((vectors[i] @ query / np.linalg.norm(vectors[i]) / np.linalg.norm(query) for i in rows), reverse=True)[:2]
+        assert np.allclose(result['similarities_text'].to_numpy(), expected, atol=1e-5)
+
+
+def test_search_many_k_above_n_and_unknown_group():
+    rng = np.random.default_rng(1)
+    index, vectors = _index(rng)
+    result, missing = index.search_many([vectors[5], vectors[0]], top_n=10, groups=['C', 'D'])
+    assert result['Text Content'].tolist() == ['chunk 5']
+    assert missing.empty
+
+
+def test_search_many_on_an_empty_matrix():
+    index = SimilarityIndex(pd.DataFrame(columns=['PDF File', 'embed_v3']), group_column='PDF File')
+    results = index.search_many([[1.0, 0.0]], top_n=3, threshold=0.5)
+    assert len(results) == 1 and results[0].empty
+    assert index.search_many([], top_n=3) == []
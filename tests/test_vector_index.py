@@ -0,0 +1,90 @@
+import pytest
+import numpy as np
+
+from backend.vector_index import VectorIndex
+
+
+def _chunks(rng, count, papers, start=0):
+    vectors = rng.normal(size=(count, 8)).astype(np.float32)
+    ids = [f"id{start + i}" for i in range(count)]
+    return vectors, ids, [papers[i % len(papers)] for i in range(count)]
+
+
+def test_build_add_search_many(tmp_path):
+    rng = np.random.default_rng(0)
+    path = str(tmp_path / 'index')
+    vectors, ids, papers = _chunks(rng, 50, ['a', 'b'])
+    index = VectorIndex.build(path, vectors, ids, papers)
+
+    new_vectors, new_ids, new_papers = _chunks(rng, 5, ['c', 'a'], start=50)
+    index = index.add(new_vectors, new_ids, new_papers)
+    assert len(index) == 55
+
+    # Every chunk, old or new, is its own best match within its paper
+    queries = [vectors[3], new_vectors[0], new_vectors[1]]
+    results = index.search_many(queries, top_n=1, papers=['b', 'c', 'a'])
+    assert [found[0] for found, _ in results] == ['id3', 'id50', 'id51']
+    assert np.allclose([scores[0] for _, scores in results], 1.0, atol=1e-5)
+
+    # Reopened from disk, the added rows are still there
+    assert VectorIndex.load(path).search_many([new_vectors[4]], top_n=1, papers=['c'])[0][0] == ['id54']
+
+
+def test_add_to_empty_index(tmp_path):
+    rng = np.random.default_rng(1)
+    path = str(tmp_path / 'index')
+    index = VectorIndex.build(path, [], [], [])
+    vectors, ids, papers = _chunks(rng, 3, ['a'])
+    index = index.add(vectors, ids, papers)
+    assert len(index) == 3
+    assert index.search_many([vectors[2]], top_n=1)[0][0] == ['id2']
+
+
+def test_backend_is_recorded_and_not_mixed(tmp_path):
+    rng = np.random.default_rng(2)
+    path = str(tmp_path / 'index')
+    vectors, ids, papers = _chunks(rng, 10, ['a'])
+    VectorIndex.build(path, vectors, ids, papers, backend='local')
+    index = VectorIndex.load(path)
+    assert index.backend == 'local'
+
+    new_vectors, new_ids, new_papers = _chunks(rng, 2, ['a'], start=10)
+    with pytest.raises(ValueError):
+        index.add(new_vectors, new_ids, new_papers, backend='azure')
+    assert len(index.add(new_vectors, new_ids, new_papers)) == 12
+
+
+def test_remove_drops_ids_and_keeps_ranges(tmp_path):
+    rng = np.random.default_rng(3)
+    path = str(tmp_path / 'index')
+    vectors, ids, papers = _chunks(rng, 30, ['a', 'b', 'c'])
+    index = VectorIndex.build(path, vectors, ids, papers)
+    new_vectors, new_ids, new_papers = _chunks(rng, 6, ['a', 'b'], start=30)
+    index = index.add(new_vectors, new_ids, new_papers)
+
+    # Every chunk of 'b' and a few of 'a'
+    removed = {i for i, paper in zip(ids + new_ids, papers + new_papers) if paper == 'b'} | {'id0', 'id30', 'missing'}
+    index = index.remove(removed)
+    assert len(index) == 36 - len(removed) + 1
+    assert 'b' not in index.papers
+    assert VectorIndex.load(path).ids == index.ids
+
+    all_vectors = np.vstack([vectors, new_vectors])
+    for i, (chunk_id, paper) in enumerate(zip(ids + new_ids, papers + new_papers)):
+        found, _ = index.search_many([all_vectors[i]], top_n=1, papers=[paper])[0]
+        if paper == 'b':
+            assert found == []
+        elif chunk_id in removed:
+            assert found and found[0] not in removed
+        else:
+            assert found == [chunk_id]
+    assert index.remove(['missing']) is index
+
+
+def test_remove_everything(tmp_path):
+    rng = np.random.default_rng(4)
+    vectors, ids, papers = _chunks(rng, 4, ['a'])
+    index = VectorIndex.build(str(tmp_path / 'index'), vectors, ids, papers).remove(ids)
+    assert len(index) == 0
+    assert index.search_many([vectors[0]], top_n=1)[0][0] == []
+    assert len(index.add(vectors[:2], ids[:2], papers[:2])) == 2